@@ -9,8 +9,12 @@
 # Install lbt_recipes pip install lbt-recipes
 
 
-import rhinoinside
-rhinoinside.load()
+# Rhino is only needed by the Rhino geometry backend
+try:
+    import rhinoinside
+    rhinoinside.load()
+except ImportError:
+    rhinoinside = None
 
 import pathlib
 import json
@@ -27,10 +31,11 @@ from pollination_streamlit.api.client import ApiClient
 from pollination_streamlit.interactors import NewJob, Recipe
 
 # The main dependency is lbt-honeybee
-from herp.geo_gen_canvas_wneigh import Neighbourhood
+from herp.geo_gen_canvas_wneigh import Neighbourhood, CachedNeighbourhood
+from herp.q_store import TraceStore
 from herp.honeybee_geom import NewConstSet, OpaqueFromKwords, WindowFromKwords,\
     ConstSetClimate, SearchPType, NewProgramme, WeeklySch, ConstantSch, RoomSolid\
-    ,SolveAdjacency, ApertByRatio, Shd, Mdl, ModToOSM, getEUI, OpaqueConst, WindConst
+    ,SolveAdjacency, ApertByRatio, Shd, Mdl, ModToOSM, getEUI, OpaqueConst, WindConst, voxel_to_polyface3d
 from herp.honeybee_model import SimOut, SimPars, ShadCalc
 from herp.pollination_interact import upload_models, check_study_status,\
     download_study_results, read_jsons, _download_results
@@ -55,6 +60,13 @@ def clear_folder(fold_name):
                 shutil.rmtree(file_path)
         except Exception as e:
             print('Failed to delete %s. Reason: %s' % (file_path, e))
+
+# Geometry of an agent for the energy models, voxel agents go directly to a
+# ladybug Polyface3D (no Rhino meshing)
+def ModelGeometry(agent):
+    if agent.Backend == "Voxel":
+        return voxel_to_polyface3d(agent.Occupancy, (agent.LotOrigX, agent.LotOrigY), agent.Module)
+    return agent.OutBrep
             
 #####
 # BASIC INPUTS
@@ -75,6 +87,28 @@ recom_tolerances = {"Cooperative":0.01, "Competitive":0.01}
 
 tolerance = recom_tolerances[mode]
 
+# Geometry of the agents. Rhino extrudes Breps, Voxel grows boolean arrays of
+# modules (much faster, but its action numbers do not match the Rhino ones)
+poss_backends = ["Rhino", "Voxel"]
+geom_backend = poss_backends[0]
+
+# Encoding of the joint states (keys of the q-tables). String joins the "T"/"F"
+# states of the agents, Bits keeps a tuple with their integer bitmasks (smaller
+# and faster keys). The csv files always get the String version
+poss_encodings = ["String", "Bits"]
+state_encoding = poss_encodings[1]
+
+# Save the Voxel neighbourhood once built and load it on the next runs with the
+# same settings. Voxel only: with the Rhino backend it is built on every run
+cache_neigh = False
+
+# Key the own state of each agent in the q-values by the smallest of its mirrors within the lot
+# (only the mirrors keeping the core, Voxel backend only) and let the lots of the same dimensions
+# share their q-values and performance records, so mirrored and translated buildings learn
+# together. Performances and csv states stay those of the real buildings, which do not face
+# the same neighbours and sun
+use_symmetry = False
+
 # Location
 poss_locations = ["Arequipa", "Piura", "Juliaca", "Tarapoto"]
 my_location = poss_locations[3]
@@ -143,6 +177,9 @@ model_fld_2 = str(up_folder_pth) + '/LOCAL'
 # The DOWN folder contains all the results of the cloud process
 down_folder = pathlib.Path(root_fold.joinpath('DOWN')) # get resulting jsons from here
 
+# The NEIGH folder keeps the saved neighbourhoods
+neigh_folder = str(root_fold.joinpath('NEIGH'))
+
 ######
 # Recovery Mode
 ######
@@ -583,11 +620,17 @@ my_streetwith = 11
 # That is the number of lots on one side
 # always set doubleside to true
 
-my_neigh = Neighbourhood(lotorigx, lotorigy, my_nrblocksX, my_nrblocksY, my_streetwith, 
-                         lotsizex, lotsizey, my_module, coreorigx, coreorigy, coresizex,
-                         coresizey, maxheight, NrlotsOnSide, doubleside, 
-                         mainsideXorY, radius_neighid, space_needed, my_wcost,
-                         my_rcost)   
+neigh_inputs = (lotorigx, lotorigy, my_nrblocksX, my_nrblocksY, my_streetwith, 
+                lotsizex, lotsizey, my_module, coreorigx, coreorigy, coresizex,
+                coresizey, maxheight, NrlotsOnSide, doubleside, 
+                mainsideXorY, radius_neighid, space_needed, my_wcost,
+                my_rcost, geom_backend)
+
+if cache_neigh:
+    my_neigh = CachedNeighbourhood(neigh_folder, *neigh_inputs, state_encoding=state_encoding,
+                                   symmetry=use_symmetry)
+else:
+    my_neigh = Neighbourhood(*neigh_inputs, state_encoding=state_encoding, symmetry=use_symmetry)
 
 #####
 # Finally set learning settings
@@ -693,12 +736,7 @@ if not avoid_learn:
                 # Save
                 exp_size[ag_sysID] = thiy_szs
     
-        # Get sizes and agents
-        act_sizes = {} #  Size at the beggining of the year
-        spaces_needed = {} # How much we need to meet need
-        particip2 = [] # who needs at least one space this year
-        
-        # Modify geometry to start the learning process and save coords in csv           
+        # Modify geometry to start the learning process
         for agent_ID in my_neigh.AgInNeigh:
             this_agent = my_neigh.GetAgentbyID(agent_ID)
             
@@ -719,21 +757,20 @@ if not avoid_learn:
             if len(sum_acts) > 0:
                 for act in sum_acts:
                     this_agent.Extend(act)
+        
+        # Sizes at the beggining of the year and how much we need to meet need, for all the agents
+        act_sizes = my_neigh.GetOccupiedPN()
+        spaces_needed = my_neigh.NeedsN(exp_size)
+        if min(spaces_needed.values()) < 0: # Error, not possible
+            print ("expected size is lower than actual size")
+        # who needs at least one space this year
+        particip2 = [agent_ID for agent_ID, need in spaces_needed.items() if need > 0]
+        
+        # Save coords in csv
+        for agent_ID in my_neigh.AgInNeigh:
+            this_agent = my_neigh.GetAgentbyID(agent_ID)
+            need = spaces_needed[agent_ID]
             
-            # Record size at the beggining of the year
-            act_sizes[agent_ID] = this_agent.NOccupiedPts
-    
-            # Determine size of space needed and if participating (>0)
-            need = exp_size[agent_ID] - this_agent.NOccupiedPts
-            if need < 0: # Error, not possible
-                print ("expected size is lower than actual size")
-                break 
-            elif need == 0: # Agent does not grow, but record the figure
-                spaces_needed[agent_ID] = need 
-            else: # Agent grows this yy, keep how much and store ID in a list
-                particip2.append(agent_ID)
-                spaces_needed[agent_ID] = need
-                
             # Save coordinates and construction activity per year
             # PUT PART OF THIS IN A MODULE IMPORT
             ######
@@ -760,7 +797,7 @@ if not avoid_learn:
             this_line["Width"] = str(maxx - minx)
             this_line["Heigth"] = str(maxy - miny)
             this_line["Agent_Id"] = agent_ID
-            this_line["Socec_Id"] = my_neigh.AgInNeigh.index(agent_ID)
+            this_line["Socec_Id"] = my_neigh.AgIndex[agent_ID]
             this_line["Year"] = year
             this_line["Build"] = need
             this_line["Mode"] = mode
@@ -776,6 +813,8 @@ if not avoid_learn:
                 fc.writerow(this_line)
             #####
             
+        # Geometry at the start of the year, every episode restarts from here
+        year_snapshot = my_neigh.SnapshotN()
     
         # Get all neighbours for participating agents (to build q tables)
         all_neighs2 = [value for key, value in every_n.items() if key in particip2]
@@ -812,6 +851,22 @@ if not avoid_learn:
             EPS_DECAY = (lowest_ep / EPSILON) ** (1 / max_tot_iters)  # depends on the number of steps
             LR_DECAY = (lowest_lr / LEARNING_RATE) ** (1 / max_tot_iters)  # depends on the number of steps
             
+            # Participants in groups that never interact this year (through neighbours of neighbours
+            # in coop mode). Each group decays its own epsilon and learning rate and stops on its own,
+            # then its agents stay static until the end of the year
+            # A neighbour that does not participate can see participants of several groups, so it
+            # has no group (no epsilon or learning rate in its csv lines)
+            groups = my_neigh.InteractionGroupsN(particip2, mode == mode_keyw[0])
+            ag_group = {}  # group of each participant
+            for group_nr, group in enumerate(groups):
+                for agent_ID in group:
+                    ag_group[agent_ID] = group_nr
+            epsilons = [EPSILON for group in groups]
+            rates = [LEARNING_RATE for group in groups]
+            stopped = [False for group in groups]
+            winyears = [None for group in groups]  # best episode of each group
+            print ("Interaction groups this year: {}".format(len(groups)))
+            
             # episode results (winning or losing, triggers auto-stop)
             results = {}
             
@@ -831,7 +886,8 @@ if not avoid_learn:
             poss_acts_0 = my_neigh.GetInitPossActsN(particip3) # Must include neighbours as q table asks
             jstates_0 = my_neigh.GetInitJStatesN(particip3) # Must include neighbours as q table asks
     
-            qtables, st_ja_tab = my_neigh.GetMultiQtablesN(poss_acts_0, jstates_0, particip2)  # Get selected q-tables
+            # The q-tables of all the participants, with the visits of their joint actions
+            qstore = my_neigh.GetQStoreN(poss_acts_0, jstates_0, particip2)  # Get selected q-tables
             
             # Because we do not start from 0, use this to retrieve current state
             # GET NEW STATES AND POSSIBLE ACTIONS
@@ -839,11 +895,12 @@ if not avoid_learn:
             poss_acts_add = my_neigh.GetAvailActsN(particip3) # Must include all agents as q table asks for neighbours
     
             # CHECK IF NEW STATE AND POSSIBLE ACTIONS EXIST IN CURRENT Q-TABLE. IF NOT, ADD
-            qtables, st_ja_tab = my_neigh.CheckQtableN(qtables, st_ja_tab, states_add, poss_acts_add, particip2)
+            my_neigh.CheckQStoreN(qstore, states_add, poss_acts_add, particip2)
     
-            # Performance record dictionaries
+            # Performance record dictionaries (one per KeyOwner, shared by its agents)
             #my_rdicts = {agent_num:{} for agent_num in my_neigh.AgInNeigh}
-            my_rdicts = {agent_num:{} for agent_num in particip2}
+            owner_rdicts = {}
+            my_rdicts = {agent_num:owner_rdicts.setdefault(my_neigh.KeyOwner(agent_num), {}) for agent_num in particip2}
             
             # time
             inner_start = time.time()
@@ -862,31 +919,9 @@ if not avoid_learn:
             # RE-START THE GEOMETRIES (APPLIES TO ALL AGENTS IN THE NEIGHBOURHOOD)
             # On episode 0, the geometry is restarted when the steps are calculated
             if episode != 0:
-                # on year 0 we only need to set the geometry to its initial state
-                # Including neighs of neighs in coop mode              
-                for agent_ID in particip4:
-                    # restart agent to 1 cube
-                    this_agent = my_neigh.GetAgentbyID(agent_ID)
-                    this_agent.Extend(-1)
-                    
-                    # Extend to the basic module size
-                    for init_actn in basic_mod_stps:
-                        this_agent.Extend(init_actn)
-                
-                    # if this year is not the initial, we need to perform additional tasks
-                    if year != 0:                        
-                        # Add actions selected in previous years
-                        sum_acts = []
-                        for this_yy in range(year): # visits all past years
-                            if this_yy in winact_rec[agent_ID]:
-                                if len(winact_rec[agent_ID][this_yy]) > 0:
-                                    # add latest winning policy to current list
-                                    sum_acts += winact_rec[agent_ID][this_yy]
-                        print ("The recovered actions to apply to agent {} are {}".format(agent_ID, sum_acts))
-                        
-                        if len(sum_acts) > 0:
-                            for act in sum_acts:
-                                this_agent.Extend(act)        
+                # Including neighs of neighs in coop mode, back to the geometry at the start
+                # of the year (basic module plus past years' actions) without replaying it
+                my_neigh.RestoreN(year_snapshot, particip4)
                                  
             # APPLY THE FOLLOWING ONLY TO THE AGENTS THAT PARTICIPATE THIS YEAR
             # Temporary dict to store policies
@@ -895,8 +930,8 @@ if not avoid_learn:
             # Teporary dict to store performances
             temp_perfs = {agent_num:{} for agent_num in particip2}
     
-            # Replace traces dicts with clean ones for the new episode
-            traces_dicts = {agent_num:{} for agent_num in particip2}
+            # Replace traces with clean ones for the new episode (those of all the agents)
+            traces = TraceStore()
            
             # Set a list of dictionaries to collect individual rewards to discrimiante
             # non-participants from early goal achievers
@@ -963,7 +998,9 @@ if not avoid_learn:
                     for agent_ID in particip3:
                         for row_line in visited_ag_dat:
                             if row_line["Agent_Id"] == agent_ID:
-                                recov_perfs[agent_ID] = float(row_line['Indv_perf'])
+                                # Empty for non-manifold states, which are not simulated
+                                if row_line['Indv_perf']:
+                                    recov_perfs[agent_ID] = float(row_line['Indv_perf'])
                                 if row_line['Part'] == "Participant":
                                     actions[agent_ID] = int(row_line['Action'])
                                     flags[agent_ID] = row_line['Flag']                            
@@ -973,6 +1010,7 @@ if not avoid_learn:
                     actions = {key:0 if value is None else value for key, value in actions.items()}
                     flags = {key:"Static" if value is None else value for key, value in flags.items()}
                     poss_acts = {agent_num:None for agent_num in particip3}
+                    key_acts = {} # actions as numbered in the q-tables (see KeyAction)
                     
                     #print (actions)
                     
@@ -982,6 +1020,7 @@ if not avoid_learn:
                         
                         # Apply actions to agents
                         action = actions[agent_ID]
+                        key_acts[agent_ID] = this_agent.KeyAction(action)
                         this_agent.Extend(action)
                         
                         # Get possible future actions
@@ -992,10 +1031,10 @@ if not avoid_learn:
                     states_1 = my_neigh.GetJStatesN(part_plus_neigh)
                         
                     # Save performance in the usual local dictionary
-                    # NOW KEYS HAVE DOUBLE UNDERSCORE
+                    # Keys are (agent id, joint state)
                     for agent_ID in part_plus_neigh:
                         my_newst = states_1[agent_ID]
-                        key_to_fill = str(agent_ID) + "_" + str(my_newst) #NOW TWO _
+                        key_to_fill = (agent_ID, my_newst)
                         
                         if key_to_fill not in avoid_sim:
                             avoid_sim[key_to_fill] = recov_perfs[agent_ID]
@@ -1012,19 +1051,32 @@ if not avoid_learn:
                     actions = {agent_num:None for agent_num in particip3}
                     flags = {agent_num:None for agent_num in particip3}
                     poss_acts = {agent_num:None for agent_num in particip3}
-                    geoms = {agent_num:None for agent_num in particip4} # I need the geoms of neighs of neighs
+                    key_acts = {} # actions as numbered in the q-tables (see KeyAction)
+                    # I need the geoms of neighs of neighs, the agents are kept and their geometries are only
+                    # built when a model is evaluated (OutBrep is lazy)
+                    geoms = {agent_num:None for agent_num in particip4}
                     non_part = [] # non participating agents IDs
                     
+                    # Actions of the agents of the groups still learning, chosen together
+                    # On the very first episode, they will be random (epsilon = 1)
+                    growing = [agent_ID for agent_ID in particip2 if not stopped[ag_group[agent_ID]]]
+                    if episode == 0 and step == 0:
+                        grow_epsilons = {agent_ID:1 for agent_ID in growing}
+                    else:
+                        grow_epsilons = {agent_ID:epsilons[ag_group[agent_ID]] for agent_ID in growing}
+                    selected = my_neigh.GetActionsQStoreN(qstore, grow_epsilons, states_0, growing)
+                    
                     #for agent_ID in my_neigh.AgInNeigh:
                     for agent_ID in particip2:
                         this_agent = my_neigh.GetAgentbyID(agent_ID)
                         
-                        # On the very first episode, this will be random (epsilon = 1)
-                        if episode == 0 and step == 0:
-                            action, flag = this_agent.GetActionMulti2(1)
-                        else:
-                            action, flag = this_agent.GetActionMulti2(EPSILON, qtables[agent_ID],
-                                                                      st_ja_tab[agent_ID], states_0[agent_ID])
+                        # The group of this agent has stopped learning, it does not grow anymore
+                        if stopped[ag_group[agent_ID]]:
+                            actions[agent_ID], flags[agent_ID] = 0, "Stopped"
+                            non_part.append(agent_ID)
+                            continue
+                        
+                        action, flag = selected[agent_ID]
                         
                         # When the selected action is 0, override (so growers always grow)
                         if action == 0:
@@ -1048,6 +1100,7 @@ if not avoid_learn:
         
                         # Apply action to current state
                         print ("Agent {} selected action {}".format(agent_ID, action))
+                        key_acts[agent_ID] = this_agent.KeyAction(action)
                         this_agent.Extend(action)
                         
                     # When on individual mode, do all at once
@@ -1060,8 +1113,7 @@ if not avoid_learn:
                             poss_acts[agent_ID] = fut_acts
                             
                             # get geometries
-                            my_geometry = this_agent.OutBrep
-                            geoms[agent_ID] = my_geometry
+                            geoms[agent_ID] = this_agent
                     # When on coop mode, do it in two steps
                     else:
                         # Possible actions are only needed for particip agents and inmediate neighbours
@@ -1077,8 +1129,7 @@ if not avoid_learn:
                             this_agent = my_neigh.GetAgentbyID(agent_ID)
                             
                             # get geometries
-                            my_geometry = this_agent.OutBrep
-                            geoms[agent_ID] = my_geometry
+                            geoms[agent_ID] = this_agent
                         
                     # We need inmediate neighs (because the q table demands neighbours)
                     states_1 = my_neigh.GetJStatesN(particip3)
@@ -1134,7 +1185,7 @@ if not avoid_learn:
                             my_newst = states_1[agent_ID]
                             
                             # Check if agent_num+joint_state key exist in the dict
-                            key_to_search = agent_ID + "_" + my_newst
+                            key_to_search = (agent_ID, my_newst)
                             if key_to_search in avoid_sim:
                                 # if so, add the agent num to the exclusion list
                                 excl_lst.append(agent_ID)     
@@ -1147,6 +1198,17 @@ if not avoid_learn:
                         else:
                             ids_to_send = part_plus_neigh
                         
+                        # Non-manifold states are known from the state, without building or simulating
+                        # their models. They get no performance (None) and the penalty of their reward
+                        # (see HHagent.NonManifold, with Rhino only the null state is not simulated)
+                        nonmani_ids = [agent_ID for agent_ID in ids_to_send
+                                       if my_neigh.GetAgentbyID(agent_ID).NonManifold]
+                        if len(nonmani_ids) > 0:
+                            for agent_ID in nonmani_ids:
+                                avoid_sim[(agent_ID, states_1[agent_ID])] = None
+                            ids_to_send = [agent_ID for agent_ID in ids_to_send if agent_ID not in nonmani_ids]
+                            print ("Non-manifold states not simulated: {}".format(', '.join(nonmani_ids)))
+                        
                         print ("Number of evaluated agents: {}".format(len(ids_to_send)))
                             
                     # Delete all the previous files in the upload and download folders
@@ -1165,7 +1227,7 @@ if not avoid_learn:
                         for agent_ID in ids_to_send:
                                            
                             # current geometry
-                            my_geom = [geoms[agent_ID]]
+                            my_geom = [ModelGeometry(geoms[agent_ID])]
             
                             # Generate context (with all the neighbours of all agents)
                             # context_ = [value for key, value in geoms.items()
@@ -1174,7 +1236,7 @@ if not avoid_learn:
                             # Generate context only with my neighbours INDIVIDUAL
                             # Because neighs are included on ids to send
                             # in coop mode their are automatically included
-                            context_ = [value for key, value in geoms.items()
+                            context_ = [ModelGeometry(value) if value is not None else None for key, value in geoms.items()
                                         if key in every_n[agent_ID]]                        
                             
             
@@ -1234,7 +1296,7 @@ if not avoid_learn:
                                 
                                 # Append to collector
                                 my_newst = states_1[agent_ID]
-                                key_to_fill = agent_ID + "_" + my_newst
+                                key_to_fill = (agent_ID, my_newst)
                                 avoid_sim[key_to_fill] = this_perf
                             
                         if execution == poss_execution[0]: # Only on cloud mode
@@ -1275,7 +1337,7 @@ if not avoid_learn:
                             # save the new perfs in the perfs dictionary
                             for agent_ID in ids_to_send:
                                 my_newst = states_1[agent_ID]
-                                key_to_fill = agent_ID + "_" + my_newst
+                                key_to_fill = (agent_ID, my_newst)
                                 avoid_sim[key_to_fill] = perfs[agent_ID]
     
                 #####
@@ -1289,19 +1351,22 @@ if not avoid_learn:
                 nonmanies = {agent_num:None for agent_num in particip3}            
                 fill_spaces = {agent_num:None for agent_num in particip3}
                 
+                # Current individual sizes and filled needs (space) of all of them at once
+                all_sizes = my_neigh.GetOccupiedPN()
+                all_ocpts.update((agent_ID, all_sizes[agent_ID]) for agent_ID in part_plus_neigh)
+                filled = my_neigh.FilledN(part_plus_neigh, [exp_size[agent_ID] for agent_ID in part_plus_neigh])
+                fill_spaces.update(zip(part_plus_neigh, filled.tolist()))
+                
                 # For cooperative mode, we need to recover the perfs and size of part
                 # and Neighs, not only particip
                 for agent_ID in part_plus_neigh:
                     this_agent = my_neigh.GetAgentbyID(agent_ID)
-                    # Get current individual size
-                    oc_pts = this_agent.NOccupiedPts
-                    all_ocpts[agent_ID] = oc_pts
                     
                     # Get current joint state
                     my_newst = states_1[agent_ID]               
     
                     # Get search key to recover performance
-                    key_to_search = agent_ID + "_" + my_newst
+                    key_to_search = (agent_ID, my_newst)
                     
                     # Get performance
                     if key_to_search in avoid_sim:
@@ -1311,22 +1376,8 @@ if not avoid_learn:
                         print ("Something else is happening with agent {}".format(agent_ID))
                         
                     # In this iter we also need to colect if there are non manies and fill spaces
-                    # Reproduce the non-manifold state
-                    NM_STR = this_agent.GetNullState()
-    
-                    # Detect non manifold state
-                    if this_agent.C_state == NM_STR:
-                        nonmani = True
-                    else:
-                        nonmani = False
-                    nonmanies[agent_ID] = nonmani
-    
-                    # Filled the need (space)
-                    if int(spaces_needed[agent_ID]) + act_sizes[agent_ID] <= int(all_ocpts[agent_ID]):
-                        filled_space = True
-                    else:
-                        filled_space = False
-                    fill_spaces[agent_ID] = filled_space
+                    # Detect non manifold state (the null state or an invalid occupancy)
+                    nonmanies[agent_ID] = this_agent.NonManifold
     
                     # Still within budget
                     ext_cost = this_agent.WallAreaExtCost + this_agent.RoofAreaExtCost
@@ -1350,7 +1401,10 @@ if not avoid_learn:
                     # When on competitive mode assign individual reward
                     if mode != mode_keyw[0]:
                         # Check if we have broken performance record (within tolerance)
-                        if all_ocpts[agent_ID] not in my_rdicts[agent_ID]: # The first time we visit this
+                        # Non-manifold states are not simulated, they leave the records as they are
+                        if nonmanies[agent_ID]:
+                            agent_record = my_rdicts[agent_ID].get(all_ocpts[agent_ID])
+                        elif all_ocpts[agent_ID] not in my_rdicts[agent_ID]: # The first time we visit this
                             my_rdicts[agent_ID][all_ocpts[agent_ID]] = all_perfs[agent_ID]
                             agent_record = all_perfs[agent_ID]
                         else:
@@ -1373,7 +1427,10 @@ if not avoid_learn:
                         # toler_lines[agent_ID] = upper_limit
                         
                         # Maximise
-                        upper_limit = agent_record - (agent_record * tolerance)
+                        if agent_record is None:
+                            upper_limit = None # No record yet
+                        else:
+                            upper_limit = agent_record - (agent_record * tolerance)
                         toler_lines[agent_ID] = upper_limit
                         
                         # Minimise
@@ -1383,7 +1440,7 @@ if not avoid_learn:
                         #     record_broken = False
                             
                         # Maximise
-                        if all_perfs[agent_ID] >= upper_limit and not nonmanies[agent_ID]:
+                        if not nonmanies[agent_ID] and all_perfs[agent_ID] >= upper_limit:
                             record_broken = True  # Reeplace record on dictionary on the next loop
                         else:
                             record_broken = False
@@ -1485,7 +1542,10 @@ if not avoid_learn:
                         # coop agent to compare with records
                         
                         # Check if we have broken performance record (within tolerance)
-                        if tot_oc_pts not in my_rdicts[agent_ID]: # The first time we visit this
+                        # Non-manifold states are not simulated, they leave the records as they are
+                        if nonmani:
+                            local_record = my_rdicts[agent_ID].get(tot_oc_pts)
+                        elif tot_oc_pts not in my_rdicts[agent_ID]: # The first time we visit this
                             my_rdicts[agent_ID][tot_oc_pts] = tot_perf
                             local_record = tot_perf
                         else:
@@ -1508,7 +1568,10 @@ if not avoid_learn:
                         # toler_lines[agent_ID] = upper_limit
                         
                         # Maximise
-                        upper_limit = local_record - (local_record * tolerance)
+                        if local_record is None:
+                            upper_limit = None # No record yet
+                        else:
+                            upper_limit = local_record - (local_record * tolerance)
                         toler_lines[agent_ID] = upper_limit
                          
                         # Minimise
@@ -1518,7 +1581,7 @@ if not avoid_learn:
                         #     record_broken = False
                             
                         # Maximise
-                        if tot_perf >= upper_limit and not nonmani:
+                        if not nonmani and tot_perf >= upper_limit:
                             record_broken = True
                         else:
                             record_broken = False
@@ -1580,117 +1643,42 @@ if not avoid_learn:
                 # UPDATE Q TABLE AND OTHER RECORDS
                 ####            
                 # CHECK IF NEW STATE AND POSSIBLE ACTIONS EXIST IN CURRENT Q-TABLE. IF NOT, ADD
-                qtables, st_ja_tab = my_neigh.CheckQtableN(qtables, st_ja_tab, states_1, poss_acts, particip)
+                my_neigh.CheckQStoreN(qstore, states_1, poss_acts, particip)
     
-                # ASSIGN VALUES TO Q-TABLES AND OTHER DATA RECORDS
-                for agent_ID in particip:
-                    # Get agent
-                    this_agent = my_neigh.GetAgentbyID(agent_ID)
+                # ASSIGN VALUES TO Q-TABLES OF ALL PARTICIPANTS AT ONCE
+                # Neighbour's actions (tuples) of every participant, for the csv
+                all_jacts = my_neigh.JointActionsN(actions, particip)
+                
+                # Rows of the states and joint actions in the q-store, the actions as numbered in
+                # the q-table (as the key of state0 might be its mirror), rewards and group rates
+                sids0 = my_neigh.StateIdsN(qstore, states_0, particip)
+                sids1 = my_neigh.StateIdsN(qstore, states_1, particip)
+                jaids = qstore.JointActionIds(sids0, my_neigh.JointActionArrayN(actions, particip))
+                step_rewards = [i_rewards[agent_ID][step] for agent_ID in particip]
+                step_rates = [rates[ag_group[agent_ID]] for agent_ID in particip]
+                
+                # Kill action 0, update the q-values and the traces (nan future q when lost)
+                old_qs, future_qs, new_qs = qstore.LearnMany(particip, sids0, jaids,
+                                                             [key_acts[agent_ID] for agent_ID in particip],
+                                                             step_rewards, sids1, step_rates, traces,
+                                                             GOAL_REWARD, DISCOUNT)
+                
+                # OTHER DATA RECORDS
+                for nr, agent_ID in enumerate(particip):
+                    # Learning rate of my group
+                    lr = step_rates[nr]
                     
-                    # My initial state
+                    # My initial and final states, my selected action and my neighbour's actions
                     state0 = states_0[agent_ID]
-    
-                    # my selected action
-                    action = actions[agent_ID]
-    
-                    # My neighbour's actions (tuple)
-                    jactions = []
-                    neighbours_ids = every_n[agent_ID]
-                    neighbours_ids.sort()
-                    
-                    for id_n in neighbours_ids:
-                        ja = actions[id_n]
-                        ja = 0 if ja is None else ja
-                        jactions.append(ja)
-                    jactions = tuple(jactions)
-    
-                    # My final state
                     state1 = states_1[agent_ID]
-    
-                    # Get the current q-value
-                    current_q = qtables[agent_ID][state0][jactions][action]                    
-    
-                    # Get reward
-                    reward = i_rewards[agent_ID][step]
-                    
-                    # Kill action 0
-                    qtables[agent_ID][state0][jactions][0] = -GOAL_REWARD * 4
+                    action = actions[agent_ID]
+                    jactions = all_jacts[agent_ID]
                     
-                    # Assign values to q table and so
-                    # First when fallen on losing state
-                    if reward == -GOAL_REWARD:
-                        new_qvalue = reward
-                        future_q = None
-                        qtables[agent_ID][state0][jactions][action] = new_qvalue
-                        
-                    # Otherwise
-                    else:
-                        # When still searching
-                        if -GOAL_REWARD < reward < GOAL_REWARD:                        
-                            # Get future q (WHEN MAX_REWARD OR -MAX_REWARD, ALL ARE 0S!)
-                            future_q = this_agent.GetMaxFutureQ(qtables[agent_ID], st_ja_tab[agent_ID],
-                                                                              state1)
-    
-                            # Calculate new q value
-                            new_qvalue = (1 - LEARNING_RATE) * current_q + LEARNING_RATE * (
-                                    reward + DISCOUNT * future_q)
-    
-                            # Replace q value on qtable
-                            qtables[agent_ID][state0][jactions][action] = new_qvalue
-                            
-                            # Save on traces dictionary
-                            # Turn tuple to string (joint actions)
-                            j_act_str = []
-                            for act in jactions:
-                                stt = str(act)
-                                j_act_str.append(stt)
-                            jactstr = '_'.join(j_act_str)
-    
-                            # Get the identifier for the traces dictionary
-                            traces_id = state0 + ':' + jactstr + ':' + str(action)
-    
-                            # if the identifier does not exist on elegibility dict, create
-                            if traces_id not in traces_dicts[agent_ID]:
-                                traces_dicts[agent_ID][traces_id] = 0.0
-    
-                            # If it does exist, add a 1
-                            for key, old_value in traces_dicts[agent_ID].items():
-                                trace_state, trace_jact, trace_act = key.split(":")
-                                trace_jact = tuple(map(int, trace_jact.split('_')))
-    
-                                # trace_act must go from str to int
-                                trace_act = int(trace_act)
-    
-                                # Update the q-value and traces dictionary for currently visited state:jaction:action
-                                if state0 == trace_state and jactions == trace_jact and action == trace_act:
-                                    # Update traces dict
-                                    traces_dicts[agent_ID][key] = old_value + 1
-    
-                        # When we have found a solution
-                        elif reward >= GOAL_REWARD:
-                            # Current q-value is reward
-                            new_qvalue = reward
-                            qtables[agent_ID][state0][jactions][action] = new_qvalue
-    
-                            # Because function give 0 on max or min reward, just assign 0
-                            future_q = 0
-    
-                            # Get the value of the new-qs formula that derives from present values
-                            from_current_state = (reward + (DISCOUNT * future_q)) - current_q
-    
-                            # Update previous q_values
-                            for key, old_value in traces_dicts[agent_ID].items():
-                                trace_state, trace_jact, trace_act = key.split(":")
-                                trace_jact = tuple(map(int, trace_jact.split('_')))
-                                trace_act = int(trace_act)
-    
-                                old_qvalues = qtables[agent_ID][trace_state][trace_jact][trace_act]
-                                new_qvalues = old_qvalues + LEARNING_RATE * traces_dicts[agent_ID][
-                                    key] * from_current_state
-                                qtables[agent_ID][trace_state][trace_jact][trace_act] = new_qvalues
-                            
-                    # Update state-joint action count table
-                    st_ja_tab[agent_ID][state0][jactions] += 1                        
+                    # Reward and q-values
+                    reward = step_rewards[nr]
+                    current_q = float(old_qs[nr])
+                    future_q = None if math.isnan(future_qs[nr]) else float(future_qs[nr])
+                    new_qvalue = float(new_qs[nr])
                         
                     # Save all relevant data on the correspondent dictionary
                     # DATA MUST BE SAVED FOR ALL AGENTS THAT WERE EVALUATED IN THIS STEP
@@ -1704,30 +1692,31 @@ if not avoid_learn:
                     my_dictone["Countdown"] = c_iter
                     my_dictone["Episode"] = episode
                     my_dictone["Step"] = step
-                    my_dictone["State_0"] = state0
+                    my_dictone["State_0"] = my_neigh.JStateString(agent_ID, state0)
                     my_dictone["Action"] = action
                     my_dictone["Joint_act"] = jactions
-                    my_dictone["Epsilon"] = EPSILON
+                    my_dictone["Epsilon"] = epsilons[ag_group[agent_ID]]
                     my_dictone["Flag"] = flags[agent_ID]
                     my_dictone["Old_q"] = current_q
-                    my_dictone["State_1"] = state1
+                    my_dictone["State_1"] = my_neigh.JStateString(agent_ID, state1)
                     my_dictone["Reward"] = reward
                     my_dictone["Max_future_q"] = future_q
                     my_dictone["New_q"] = new_qvalue
-                    key_to_search = agent_ID + "_" + state1
+                    key_to_search = (agent_ID, state1)
                     my_dictone["Indv_perf"] = avoid_sim[key_to_search]
+                    my_dictone["Non_manifold"] = nonmanies[agent_ID] # not simulated when True
                     my_dictone["Indv_mod_occupied"] = all_ocpts[agent_ID]
                     my_dictone["Tolerance_line"] = toler_lines[agent_ID]
                     if mode != mode_keyw[0]: # on indv mode 
                         my_dictone["Eval_perf"] = avoid_sim[key_to_search]
                         my_dictone["Eval_mod_occupied"] = all_ocpts[agent_ID]
-                        my_dictone["Record_Perf"] = my_rdicts[agent_ID][all_ocpts[agent_ID]]
+                        my_dictone["Record_Perf"] = my_rdicts[agent_ID].get(all_ocpts[agent_ID])
                     else: # on coop mode
                         my_dictone["Eval_perf"] = local_perf[agent_ID] # takes in account growing and non-growing
                         my_dictone["Eval_mod_occupied"] = local_ptocc[agent_ID]
-                        my_dictone["Record_Perf"] = my_rdicts[agent_ID][local_ptocc[agent_ID]]
+                        my_dictone["Record_Perf"] = my_rdicts[agent_ID].get(local_ptocc[agent_ID])
                     # my_dictone["Remaining_Budget"] = balances[agent_num] # BALANCES IS NOT USED IN THIS CSV
-                    my_dictone["LR"] = LEARNING_RATE
+                    my_dictone["LR"] = lr
                     my_dictone["Mode"] = mode
                     my_dictone["Location"] = my_location
                     my_dictone["Year"] = year
@@ -1778,15 +1767,16 @@ if not avoid_learn:
                         my_dictone["State_0"] = None
                         my_dictone["Action"] = None
                         my_dictone["Joint_act"] = None
-                        my_dictone["Epsilon"] = EPSILON
+                        my_dictone["Epsilon"] = None # no group (see ag_group)
                         my_dictone["Flag"] = None
                         my_dictone["Old_q"] = None
-                        my_dictone["State_1"] = states_1[ng]
+                        my_dictone["State_1"] = my_neigh.JStateString(ng, states_1[ng])
                         my_dictone["Reward"] = None
                         my_dictone["Max_future_q"] = None
                         my_dictone["New_q"] = None
-                        key_to_search = ng + "_" + states_1[ng]
+                        key_to_search = (ng, states_1[ng])
                         my_dictone["Indv_perf"] = avoid_sim[key_to_search]
+                        my_dictone["Non_manifold"] = nonmanies[ng] # not simulated when True
                         my_dictone["Indv_mod_occupied"] = all_ocpts[ng]
                         my_dictone["Tolerance_line"] = None
                         
@@ -1794,7 +1784,7 @@ if not avoid_learn:
                         my_dictone["Eval_mod_occupied"] = None
                         my_dictone["Record_Perf"] = None
                         
-                        my_dictone["LR"] = LEARNING_RATE
+                        my_dictone["LR"] = None
                         my_dictone["Mode"] = mode
                         my_dictone["Location"] = my_location
                         my_dictone["Year"] = year
@@ -1828,9 +1818,11 @@ if not avoid_learn:
                     print ("Kill_flag")
                     break
                 
-                # Decay epsilon and learning rate
-                EPSILON *= EPS_DECAY
-                LEARNING_RATE *= LR_DECAY
+                # Decay epsilon and learning rate of the groups still learning
+                for group_nr in range(len(groups)):
+                    if not stopped[group_nr]:
+                        epsilons[group_nr] *= EPS_DECAY
+                        rates[group_nr] *= LR_DECAY
                 
                 # Get the individual rewards for this step for all agents
                 # NOW IREWARDS IS A DICT OF DICTS
@@ -1864,91 +1856,99 @@ if not avoid_learn:
                 # add 1 because of 0s
                 last_episodes = [i for i in range(episode - (n_count_epis + 1), episode + 1)]
     
-                counts = {} # this is the prop of won episodes per agent
-                #for agent_ID in particip:
-                for recent_epi in last_episodes:             
-                    count = 0 # Counts how many agents have achieved the goal per episode
-                    any_nonmani = []
-                    for agent_ID in particip2: # Because we are outside of the step sub selection
-                        if recent_epi in count_wins[agent_ID]:
-                            # When winning episode, the record_perf + occ_pts at that time is saved
-                            # ADD A KEYWORD WHEN THE RESULT IS A NON-MANIFOLD STATE
-                            # SO HERE COMES AS AN EXCEPTION
-                            if count_wins[agent_ID][recent_epi] != "lose" and\
-                            count_wins[agent_ID][recent_epi] != -TIME_PENALTY:
-                                if count_wins[agent_ID][recent_epi] == "NONMANI":
-                                    # Tell the list that this agent was non manifold at the end of the episode
-                                    any_nonmani.append(True)
-                                else:
-                                    # Tell the list that this was a manifold state
-                                    any_nonmani.append(False)                           
+                # Every group still learning checks its own success rate
+                for group_nr, group in enumerate(groups):
+                    if stopped[group_nr]:
+                        continue
+                    
+                    counts = {} # this is the prop of won episodes per agent
+                    #for agent_ID in particip:
+                    for recent_epi in last_episodes:             
+                        count = 0 # Counts how many agents have achieved the goal per episode
+                        any_nonmani = []
+                        for agent_ID in group: # Because we are outside of the step sub selection
+                            if recent_epi in count_wins[agent_ID]:
+                                # When winning episode, the record_perf + occ_pts at that time is saved
+                                # ADD A KEYWORD WHEN THE RESULT IS A NON-MANIFOLD STATE
+                                # SO HERE COMES AS AN EXCEPTION
+                                if count_wins[agent_ID][recent_epi] != "lose" and\
+                                count_wins[agent_ID][recent_epi] != -TIME_PENALTY:
+                                    if count_wins[agent_ID][recent_epi] == "NONMANI":
+                                        # Tell the list that this agent was non manifold at the end of the episode
+                                        any_nonmani.append(True)
+                                    else:
+                                        # Tell the list that this was a manifold state
+                                        any_nonmani.append(False)                           
                                 
-                                    # Separate occupied points from record
-                                    occpts_perf = count_wins[agent_ID][recent_epi].split("_")
-                                    occptsr = int(occpts_perf[0])
-                                    perfrec = float(occpts_perf[1])
+                                        # Separate occupied points from record
+                                        occpts_perf = count_wins[agent_ID][recent_epi].split("_")
+                                        occptsr = int(occpts_perf[0])
+                                        perfrec = float(occpts_perf[1])
                                     
-                                    # Minimise
-                                    #recorded_record = my_rdicts[agent_ID][occptsr]
-                                    #upper_limit = recorded_record + (recorded_record * tolerance)
+                                        # Minimise
+                                        #recorded_record = my_rdicts[agent_ID][occptsr]
+                                        #upper_limit = recorded_record + (recorded_record * tolerance)
                                     
-                                    # Maximise
-                                    recorded_record = my_rdicts[agent_ID][occptsr]
-                                    upper_limit = recorded_record - (recorded_record * tolerance)
+                                        # Maximise
+                                        recorded_record = my_rdicts[agent_ID][occptsr]
+                                        upper_limit = recorded_record - (recorded_record * tolerance)
                                     
-                                    # Minimise
-                                    #if perfrec <= float(upper_limit):
-                                        #count += 1
+                                        # Minimise
+                                        #if perfrec <= float(upper_limit):
+                                            #count += 1
                                     
-                                    # Maximise
-                                    if perfrec >= float(upper_limit):
-                                        count += 1
+                                        # Maximise
+                                        if perfrec >= float(upper_limit):
+                                            count += 1
                                         
-                    # When non manifold state is found, the score for this episode is set to 0
-                    # In that way, its results will never be chosen
-                    if any(any_nonmani):
-                        counts[recent_epi] = 0
-                    else:
-                        #prop_win = count / len(last_episodes) # wins out of the number of latest episodes
-                        prop_win = count / len(particip2) # success agents out of the total participating this year
-                        counts[recent_epi] = prop_win
+                        # When non manifold state is found, the score for this episode is set to 0
+                        # In that way, its results will never be chosen
+                        if any(any_nonmani):
+                            counts[recent_epi] = 0
+                        else:
+                            #prop_win = count / len(last_episodes) # wins out of the number of latest episodes
+                            prop_win = count / len(group) # success agents out of the total of the group this year
+                            counts[recent_epi] = prop_win
                 
-                # Get the episode when the highest success was achieved!
-                episode_id = max(counts, key=counts.get)
+                    # Get the episode when the highest success was achieved!
+                    episode_id = max(counts, key=counts.get)
                 
-                # Replace the yearly actions record with the best performing episode            
-                if counts[episode_id] > 0:
-                    # Save the identity of the latest episode for winning policy
-                    winyear = {}
-                    winyear["episode"] = episode_id
-                    winyear["proportion"] = counts[episode_id]
-                    #for agent_ID in particip:
-                    for agent_ID in particip2:
-                        winact_rec[agent_ID][year] = part_winact[agent_ID][episode_id]
+                    # Replace the yearly actions record with the best performing episode            
+                    if counts[episode_id] > 0:
+                        # Save the identity of the latest episode for winning policy
+                        winyear = {}
+                        winyear["episode"] = episode_id
+                        winyear["proportion"] = counts[episode_id]
+                        winyears[group_nr] = winyear
+                        #for agent_ID in particip:
+                        for agent_ID in group:
+                            winact_rec[agent_ID][year] = part_winact[agent_ID][episode_id]
                     
                         
-                # If we are on the last episode and no winning selection, something went wrong
-                if episode + 1 == episodes and counts[episode_id] <= 0:
-                    print("Warning! last episode of the year and no winning epsiode selected/actions recorded")
-                    kill_flag = True
+                    # If we are on the last episode and no winning selection, something went wrong
+                    if episode + 1 == episodes and counts[episode_id] <= 0:
+                        print("Warning! last episode of the year and no winning epsiode selected/actions recorded")
+                        kill_flag = True
                 
-                # Get an average of success for the last episodes
-                tot_prop = sum(counts.values()) / len(counts)
+                    # Get an average of success for the last episodes
+                    tot_prop = sum(counts.values()) / len(counts)
                 
-                # Set auto-stop conditions
-                # If so, time to end the learning
-                autostop = False
-                # Check if the success rate has been stable for the amount of evaluated years
-                unique_success = list(set(list(counts.values()))) # get unique values
-                if len(unique_success) == 1 and unique_success[0] > 0: # One repeated value more than 0
-                    print ("AUTOSTOP because there is a unique success rate")
-                    autostop = True
-                # Check if the success average is equal or higher than expected
-                if tot_prop >= stop_prop:
-                    autostop = True
-                    print ("The Max agents win proportion in the evaluated episodes was {} at episode {}".format(counts[episode_id], episode_id))
-    
-                # stop the process
+                    # Set auto-stop conditions
+                    # If so, time to end the learning of the group
+                    autostop = False
+                    # Check if the success rate has been stable for the amount of evaluated years
+                    unique_success = list(set(list(counts.values()))) # get unique values
+                    if len(unique_success) == 1 and unique_success[0] > 0: # One repeated value more than 0
+                        print ("AUTOSTOP of group {} because there is a unique success rate".format(group_nr))
+                        autostop = True
+                    # Check if the success average is equal or higher than expected
+                    if tot_prop >= stop_prop:
+                        autostop = True
+                        print ("The Max agents win proportion in the evaluated episodes was {} at episode {}".format(counts[episode_id], episode_id))
+                    stopped[group_nr] = autostop
+    
+                # stop the process when every group has stopped
+                autostop = all(stopped)
                 if autostop:         
                     break    
     
@@ -1975,6 +1975,12 @@ if not avoid_learn:
             lines_to_write.append("Auto-stop triggered. Inputs: " + str(n_count_epis) + ", " + str(stop_prop))
         else:
             lines_to_write.append("Ran until max episodes")
+        lines_to_write.append("Interaction groups: " + str(len(groups)) + ", auto-stopped: " + str(sum(stopped)))
+
+        # Geometry transitions reused from the cache (or computed) this year
+        trans_hits, trans_misses = my_neigh.Transitions.PopCounters()
+        print ("Transitions reused: {}, computed: {}".format(trans_hits, trans_misses))
+        lines_to_write.append("Transitions reused: " + str(trans_hits) + ", computed: " + str(trans_misses))
     
         for agent_ID in winact_rec.keys():
             lines_to_write.append("For agent ID " + agent_ID + " the wining policy is:")
@@ -2002,8 +2008,8 @@ if not avoid_learn:
                 if key2 == year: # only write current year
                     as_str = '_'.join(str(i) for i in value2) # actions separated by _
                     new_dict = {"agent_id":key, "year":key2, "actions":as_str,
-                                "epsisode": winyear["episode"],
-                                "proportion": winyear["proportion"],
+                                "epsisode": winyears[ag_group[key]]["episode"],
+                                "proportion": winyears[ag_group[key]]["proportion"],
                                 "mode": mode, "location": my_location}
                     dict_list.append(new_dict)
     
@@ -2107,23 +2113,32 @@ if not avoid_learn:
 #####
 
 def RoofInfoAgent(agent_as_lot, ag_id, yyyy):            
-    # Get face indices of the roofs in the brep
-    roof_faceids = agent_as_lot.ClassifyFaces(agent_as_lot.OutBrep)[1]
+    # Get the vertices of the roofs, by face index
+    roof_faces = []
+    if agent_as_lot.Backend == "Voxel":
+        # Merged rectangles of the roofs (faces looking up, or down above the ground)
+        for idx, face in enumerate(ModelGeometry(agent_as_lot).faces):
+            if abs(face.normal.z) > 0.5 and face.min.z > 0:
+                roof_faces.append((idx, [(pt.x, pt.y, pt.z) for pt in face.vertices]))
+    else:
+        # Get face indices of the roofs in the brep
+        roof_faceids = agent_as_lot.ClassifyFaces(agent_as_lot.OutBrep)[1]
+        for idx in roof_faceids:
+            srf_brp = agent_as_lot.OutBrep.Faces[idx].ToBrep()
+            roof_faces.append((idx, [vtx.Location for vtx in srf_brp.Vertices]))
     
     this_agents_data = []
     
     # For each roof surface, get origin coordinates, hewight width and elevation
-    for idx in roof_faceids:
-        srf_brp = agent_as_lot.OutBrep.Faces[idx].ToBrep()
-        srf_vtx = srf_brp.Vertices
+    for idx, srf_vtx in roof_faces:
         xs = []
         ys = []
         zs = []
         
         for vtx in srf_vtx:
-            xs.append(vtx.Location[0])
-            ys.append(vtx.Location[1])
-            zs.append(vtx.Location[2])
+            xs.append(vtx[0])
+            ys.append(vtx[1])
+            zs.append(vtx[2])
         
         minx, maxx = min(xs), max(xs)
         miny, maxy = min(ys), max(ys)
@@ -2131,7 +2146,7 @@ def RoofInfoAgent(agent_as_lot, ag_id, yyyy):
         
         line_to_write = {}
         line_to_write["agent_id"] = ag_id
-        line_to_write["socec_id"] = my_neigh.AgInNeigh.index(agent_ID)
+        line_to_write["socec_id"] = my_neigh.AgIndex[agent_ID]
         line_to_write["year"] = yyyy
         line_to_write["roof_id"] = idx
         line_to_write["origin"] = str(minx) + "_" + str(miny)
@@ -2181,7 +2196,7 @@ for agent_ID in my_neigh.AgInNeigh:
         this_agent.Extend(init_actn)
         
     # save initial geometries and states
-    geoms[agent_ID] = this_agent.OutBrep
+    geoms[agent_ID] = ModelGeometry(this_agent)
     sizes[agent_ID] = this_agent.NOccupiedPts
         
     # record the very first state in the roofs csv
@@ -2205,7 +2220,7 @@ states = my_neigh.GetJStatesN(my_neigh.AgInNeigh)
 # Identify those that do not register a state yet
 excepmt_ids = []
 for agent_ID in my_neigh.AgInNeigh:
-    key_to_search = agent_ID + "_" + states[agent_ID]
+    key_to_search = (agent_ID, states[agent_ID])
     if key_to_search in avoid_sim:
         excepmt_ids.append(agent_ID)
 
@@ -2273,7 +2288,7 @@ for agent_ID in sim_ids:
         
         # Append to collector
         my_newst = states[agent_ID]
-        key_to_fill = agent_ID + "_" + my_newst
+        key_to_fill = (agent_ID, my_newst)
         avoid_sim[key_to_fill] = this_perf
     
 if execution == poss_execution[0]: # Only on cloud mode
@@ -2309,12 +2324,12 @@ if execution == poss_execution[0]: # Only on cloud mode
     
     for agent_ID in sim_ids:
         my_newst = states[agent_ID]
-        key_to_fill = agent_ID + "_" + my_newst
+        key_to_fill = (agent_ID, my_newst)
         avoid_sim[key_to_fill] = perfs[agent_ID]
     
 for agent_ID in my_neigh.AgInNeigh:
     # Recover data from collector
-    key_to_search = agent_ID + "_" + states[agent_ID]
+    key_to_search = (agent_ID, states[agent_ID])
     perfor = avoid_sim[key_to_search]
     
     # Prepare data for csv
@@ -2360,7 +2375,7 @@ for year in years:
     # Identify those that do not register a state yet
     excepmt_ids = []
     for agent_ID in my_neigh.AgInNeigh:
-        key_to_search = agent_ID + "_" + states[agent_ID]
+        key_to_search = (agent_ID, states[agent_ID])
         if key_to_search in avoid_sim:
             excepmt_ids.append(agent_ID)
     
@@ -2369,7 +2384,7 @@ for year in years:
     # add all geometries to dict (including those that not receive action)
     for agent_ID in my_neigh.AgInNeigh:
         this_agent = my_neigh.GetAgentbyID(agent_ID)
-        geoms[agent_ID] = this_agent.OutBrep
+        geoms[agent_ID] = ModelGeometry(this_agent)
         sizes[agent_ID] = this_agent.NOccupiedPts
         
         # record geometric state on the roofs csv
@@ -2445,7 +2460,7 @@ for year in years:
             
             # Append to collector
             my_newst = states[agent_ID]
-            key_to_fill = agent_ID + "_" + my_newst
+            key_to_fill = (agent_ID, my_newst)
             avoid_sim[key_to_fill] = this_perf
         
     if execution == poss_execution[0]: # Only on cloud mode
@@ -2485,12 +2500,12 @@ for year in years:
         
         for agent_ID in sim_ids:
             my_newst = states[agent_ID]
-            key_to_fill = agent_ID + "_" + my_newst
+            key_to_fill = (agent_ID, my_newst)
             avoid_sim[key_to_fill] = perfs[agent_ID]
         
     for agent_ID in my_neigh.AgInNeigh:
         # Recover data from collector
-        key_to_search = agent_ID + "_" + states[agent_ID]
+        key_to_search = (agent_ID, states[agent_ID])
         perfor = avoid_sim[key_to_search]
         
         # Prepare data for csv
@@ -1,21 +1,174 @@
 '''This module has the base geometrical classes for incremental 
 dwelling simulation. These are Blocks and Lots.'''
 
-import Rhino
-import System
 import random
 import itertools
+import bisect
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+from herp import voxel_geom
+from herp import spatial_index
+from herp import q_store
+
+try:
+    import Rhino
+    import System
+    Point3d = Rhino.Geometry.Point3d
+except (ImportError, AttributeError):  # rhinoinside not loaded, only the "Voxel" backend can be used
+    Rhino = None
+    System = None
+    Point3d = voxel_geom.Point3
 
 #### General functions #####
 def RemoveSubL(lst):
     return list(map(list, (set(map(lambda x: tuple(sorted(x)), lst)))))
 
+
+# Points as (x, y, z) tuples to save them (Rhino points can not be pickled) and back
+def PlainPoints(points):
+    return [(pt.X, pt.Y, pt.Z) for pt in points]
+
+
+def PointsFromPlain(coords):
+    return [Point3d(x, y, z) for x, y, z in coords]
+
+
+# Box (lowest and highest x, y, z) of a face with these vertices when it is a rectangle aligned
+# with the axes (4 vertices on a plane of constant x, y or z at the 4 corners of their box), so
+# the distance to the box is the distance to the face. None for any other face
+def AlignedRectangleBox(vertices, tolerance):
+    if len(vertices) != 4:
+        return None
+    coords = [(vertex.X, vertex.Y, vertex.Z) for vertex in vertices]
+    lows = [min(values) for values in zip(*coords)]
+    highs = [max(values) for values in zip(*coords)]
+    flat = [axis for axis in range(3) if highs[axis] - lows[axis] <= tolerance]
+    if len(flat) != 1:
+        return None
+    corners = set()
+    for coord in coords:
+        corner = []
+        for axis in range(3):
+            if axis == flat[0]:
+                continue
+            if abs(coord[axis] - lows[axis]) <= tolerance:
+                corner.append(0)
+            elif abs(coord[axis] - highs[axis]) <= tolerance:
+                corner.append(1)
+            else:
+                return None
+        corners.add(tuple(corner))
+    if len(corners) != 4:
+        return None
+    return (lows, highs)
+
+
+# Squared distance from a point to a box of AlignedRectangleBox
+def BoxDistance2(box, pt):
+    lows, highs = box
+    dx = max(lows[0] - pt.X, 0, pt.X - highs[0])
+    dy = max(lows[1] - pt.Y, 0, pt.Y - highs[1])
+    dz = max(lows[2] - pt.Z, 0, pt.Z - highs[2])
+    return dx * dx + dy * dy + dz * dz
+
 ##### Classes #####
+# Results of Extend by (lot template, state, action), shared by all the agents of the same template
+# The geometry is kept in lot coordinates and moved to the lot of the agent that reuses it
+class TransitionCache:
+    def __init__(self):
+        self.Transitions = {}
+        self.Hits = 0
+        self.Misses = 0
+
+    # Stored transition for the key (None if not computed yet)
+    def Get(self, key):
+        transition = self.Transitions.get(key)
+        if transition is None:
+            self.Misses += 1
+        else:
+            self.Hits += 1
+        return transition
+
+    def Put(self, key, transition):
+        self.Transitions[key] = transition
+
+    # Return (hits, misses) since the last call and start counting again (e.g. every year)
+    def PopCounters(self):
+        counters = (self.Hits, self.Misses)
+        self.Hits = 0
+        self.Misses = 0
+        return counters
+
+
+# Everything of a lot that only depends on its dimensions (shape in modules, module, core and
+# backend), shared by all the lots with the same dimensions, which only differ by a translation
+# The future states are enumerated the first time they are asked for
+class LotTemplate:
+    def __init__(self, shape, module, corex, corey, coresizex, coresizey, backend):
+        self.Key = (backend, shape, module, corex, corey, coresizex, coresizey)
+        self.Shape = shape
+        self.Neighbours = voxel_geom.Neighbours(shape)  # adjacency of the lattice of modules
+
+        # The core as a boolean array of modules
+        self.CoreOccupancy = voxel_geom.CoreOccupancy(shape[0], shape[1], shape[2],
+                                                      corex, corey, coresizex, coresizey)
+        self.CoreOccupancy.flags.writeable = False
+        self.CoreExposed = voxel_geom.ExposedFaces(self.CoreOccupancy)  # exposed (walls, roofs, floor)
+        self.CoreGrowFaces = tuple(voxel_geom.GrowableFaces(self.CoreOccupancy))
+        self.InitInsidePtIdx = tuple(voxel_geom.OccupiedIndices(self.CoreOccupancy))
+        self.InitState = voxel_geom.StateString(self.CoreOccupancy)
+        self.InitBits = voxel_geom.StateBits(self.InitState)
+        # Mirrors of the lot keeping the core, and the states already taken to the smallest mirror
+        self.Mirrors = tuple(voxel_geom.CoreMirrors(self.CoreOccupancy))
+        self.CanonicalStates = {}
+
+        self.FutStates = {}  # by number of generations
+        self.InitPossAct = None  # set by the first lot (Rhino numbers the faces of its brep)
+
+    # Saved by its dimensions and what was computed, so a loaded template is the registered one
+    def __reduce__(self):
+        backend, shape, module, corex, corey, coresizex, coresizey = self.Key
+        return (GetLotTemplate, (shape, module, corex, corey, coresizex, coresizey, backend),
+                {"FutStates": self.FutStates, "InitPossAct": self.InitPossAct})
+
+    def __setstate__(self, state):
+        for generations, states in state["FutStates"].items():
+            self.FutStates.setdefault(generations, states)
+        if self.InitPossAct is None:
+            self.InitPossAct = state["InitPossAct"]
+
+    # Same as voxel_geom.CanonicalState with the mirrors of this template, computed once per state
+    def CanonicalState(self, state):
+        canonical = self.CanonicalStates.get(state)
+        if canonical is None:
+            canonical = voxel_geom.CanonicalState(state, self.Mirrors)
+            self.CanonicalStates[state] = canonical
+        return canonical
+
+
+LotTemplates = {}
+
+
+# Template of the lots with these dimensions (created on the first call)
+def GetLotTemplate(shape, module, corex, corey, coresizex, coresizey, backend):
+    key = (backend, shape, module, corex, corey, coresizex, coresizey)
+    template = LotTemplates.get(key)
+    if template is None:
+        template = LotTemplate(shape, module, corex, corey, coresizex, coresizey, backend)
+        LotTemplates[key] = template
+    return template
+
+
 class Neighbourhood:
     def __init__(self, origx, origy, nr_blocksx, nr_blocksy, street_width,
                 lotsizex, lotsizey, module, coreorigx, coreorigy, coresizex,
                 coresizey, maxheight, NrlotsOnSide, doubleside, mainsideXorY,
-                radius_neigh, space_needed, w_cost, r_cost):
+                radius_neigh, space_needed, w_cost, r_cost, geom_backend="Rhino", transitions=None,
+                state_encoding="String", symmetry=False):
         
         # Origin of the neighbourhood
         self.NeigOrigX = origx
@@ -44,16 +197,70 @@ class Neighbourhood:
         self.SpaceNeed = space_needed
         self.WallsCost = w_cost
         self.RoofCost = r_cost
+        self.Backend = geom_backend  # "Rhino" (Brep extrusions) or "Voxel" (boolean arrays)
+        # Transitions shared by every agent of the neighbourhood
+        if transitions is None:
+            transitions = TransitionCache()
+        self.Transitions = transitions
+        # "String" joins the "T"/"F" states of the agents in a string, "Bits" puts their integer
+        # bitmasks in a tuple (smaller keys for the q-tables, faster to hash and compare)
+        self.StateEncoding = state_encoding
+        self.NullJState = (0,) if self.StateEncoding == "Bits" else 'F'  # THE ABSOLUTE NULL STATE
+        # With symmetry, the own state of the joint state keying the q-values (KeyJState) is the
+        # smallest of its mirrors within the lot, and the lots of the same dimensions share their
+        # q-values (KeyOwner), so mirrored and translated buildings learn on the same states (only
+        # "Voxel", which can number the actions of a mirror). The joint states themselves (and the
+        # simulated performances keyed by them) are always those of the real buildings
+        self.Symmetry = symmetry
         
         # Blocks
         self.Blocks = self.MultiplyBlocks()
         self.AgInNeigh = self.AgentIDs()
+        # Dense index of every agent (its row in the socio-economic csv) and the agents in that
+        # order, so "block_lot" ids are not parsed again on every GetAgentbyID
+        self.AgIndex = {ag_id: idx for idx, ag_id in enumerate(self.AgInNeigh)}
+        self.Agents = [self.AgentFromBlocks(ag_id) for ag_id in self.AgInNeigh]
         
-        # Show output (because is an attribute only shows initial breps)
-        self.BrepsN = self.GetBrepsN().values()
         
+        # Lots in the range of view of each lot, in the order of AgInNeigh
+        self.NeighIndex = self.BuildNeighIndex()
+
         # DICT WITH EVERY AGENT ID:AGENT NEIGHBOURS IDS AS LIST
         self.EveryNeigh = self.RangeViewN()
+
+        # Joint states are kept between calls and only built again when the state of the agent
+        # or of one of its neighbours changed. Extend adds the id of the agent to DirtyAgents
+        self.SortedNeigh = {ag_id: sorted(neighs) for ag_id, neighs in self.EveryNeigh.items()}
+        self.JStateReaders = {ag_id: [ag_id] for ag_id in self.AgInNeigh}  # joint states including each agent
+        for ag_id, neighs in self.SortedNeigh.items():
+            for id_n in neighs:
+                self.JStateReaders[id_n].append(ag_id)
+        self.JStates = {}
+        self.DirtyAgents = set()
+        # Rows (AgIndex) of the sorted neighbours of every agent, padded with the number of agents
+        max_neighs = max([len(neighs) for neighs in self.SortedNeigh.values()] + [0])
+        self.SortedNeighRows = np.full((len(self.AgInNeigh), max_neighs), len(self.AgInNeigh), dtype=np.int64)
+        for idx, ag_id in enumerate(self.AgInNeigh):
+            neighs = self.SortedNeigh[ag_id]
+            self.SortedNeighRows[idx, :len(neighs)] = [self.AgIndex[id_n] for id_n in neighs]
+
+        # Occupancy of every lot (agents, x, y, z) and the per-agent values, in AgIndex order
+        # The voxel agents grow their own slice of OccupancyN, Extend writes everything else
+        nagents = len(self.Agents)
+        self.OccupancyN = np.zeros((nagents,) + self.Agents[0].LotShape, dtype=bool)
+        self.OccupiedN = np.zeros(nagents, dtype=np.int64)  # NOccupiedPts
+        self.PossActN = np.zeros(nagents, dtype=np.int64)  # Poss_act
+        self.WallCostN = np.zeros(nagents)  # WallAreaExtCost
+        self.RoofCostN = np.zeros(nagents)  # RoofAreaExtCost
+        for idx, agent in enumerate(self.Agents):
+            agent.JoinNeighbourhood(self, idx)
+
+        if self.Symmetry:
+            if self.Backend == "Voxel":
+                for agent in self.Agents:
+                    agent.Mirrors = agent.Template.Mirrors
+            else:
+                print ("The symmetry of the lots is only used with the Voxel backend")
         
     def MultiplyBlocks(self):
         blocks = []
@@ -63,7 +270,8 @@ class Neighbourhood:
                                 self.CoreOrigX, self.CoreOrigY, self.CoreSizeX, 
                                 self.CoreSizeY, self.MaxHeight, self.SideLots, 
                                 self.DoubleLine, self.MainDir, self.NeighRadius, 
-                                self.SpaceNeed, self.WallsCost, self.WallsCost)
+                                self.SpaceNeed, self.WallsCost, self.WallsCost, self.Backend,
+                                self.Transitions)
         blocks.append(block0)
         
         initial_verts = block0.BlockVerts
@@ -82,7 +290,8 @@ class Neighbourhood:
                                         self.CoreOrigX, self.CoreOrigY, self.CoreSizeX, 
                                         self.CoreSizeY, self.MaxHeight, self.SideLots, 
                                         self.DoubleLine, self.MainDir, self.NeighRadius, 
-                                        self.SpaceNeed, self.WallsCost, self.WallsCost)
+                                        self.SpaceNeed, self.WallsCost, self.WallsCost, self.Backend,
+                                        self.Transitions)
                 blocks.append(blockx)
         # Determine the starting coordinates of blocks in y according to the number in y
         # AFTER COPYING ON X, MUST COPY THOSE ON Y
@@ -97,7 +306,8 @@ class Neighbourhood:
                                             self.CoreOrigX, self.CoreOrigY, self.CoreSizeX, 
                                             self.CoreSizeY, self.MaxHeight, self.SideLots, 
                                             self.DoubleLine, self.MainDir, self.NeighRadius, 
-                                            self.SpaceNeed, self.WallsCost, self.WallsCost)
+                                            self.SpaceNeed, self.WallsCost, self.WallsCost, self.Backend,
+                                            self.Transitions)
                     yblocks.append(blocky)
             blocks += yblocks
         return blocks
@@ -124,6 +334,10 @@ class Neighbourhood:
         
     # Get agent from ID input in string format
     def GetAgentbyID(self, agent_id):
+        return self.Agents[self.AgIndex[agent_id]]
+
+    # Find the agent of an ID in the blocks (to build the dense index)
+    def AgentFromBlocks(self, agent_id):
         sep_ids = self.IDAgtoList(agent_id)
         
         this_blk = self.Blocks[sep_ids[0]]
@@ -131,59 +345,53 @@ class Neighbourhood:
         
         return this_ag
         
-    # Identify the neighbours of one agent by ID string
-    def IDNeighNeighbours(self, ag_ng_id):        
-        # Dictionary with all vertices except mine
-        vertix = {}
-        
-        # Add vertices of all other agents
-        for ag_id in self.AgInNeigh:
-            if ag_id != ag_ng_id:
-                that_agent = self.GetAgentbyID(ag_id)
-                vertices = that_agent.VertixLots
-                vertix[ag_id] = vertices
-            
-        # Get a polyline with my vertices
-        this_agent = self.GetAgentbyID(ag_ng_id)
-        my_vertices = this_agent.VertixLots
-        points = System.Collections.Generic.List[Rhino.Geometry.Point3d]()
-        for vert in my_vertices:
-            points.Add(vert)
-        my_lt = Rhino.Geometry.Polyline(points)
+    # Index of the neighbours of every agent, from the centre and vertices of their lots
+    # An agent is a neighbour when one of its vertices is inside the circle of radius
+    # NeighRadius around the centre of my lot
+    def BuildNeighIndex(self):
+        centres = []
+        vertices = []
+        for agent in self.Agents:
+            my_vertices = agent.VertixLots[:-1]  # the last one closes the polyline
+            ctr_x = sum([vert.X for vert in my_vertices]) / len(my_vertices)
+            ctr_y = sum([vert.Y for vert in my_vertices]) / len(my_vertices)
+            centres.append((ctr_x, ctr_y))
+            vertices.append([(vert.X, vert.Y) for vert in my_vertices])
+        return spatial_index.NeighbourIndex(centres, vertices, self.NeighRadius)
 
-        # Get the centre point of my buildable area and a circle from there        
-        if my_lt.IsClosed:
-            my_lt_ctr = my_lt.CenterPoint()
-            my_circle = Rhino.Geometry.Circle(my_lt_ctr, self.NeighRadius)
-            my_curve = Rhino.Geometry.ArcCurve(my_circle)
-            if my_curve.IsClosed:
-                matches = []
-                my_plane = Rhino.Geometry.Plane.WorldXY
-                # iterate through the vertices of all other agents
-                for key, value in vertix.items():
-                    for vert2 in value:
-                        cntment = my_curve.Contains(vert2, my_plane, 0.0)
-                        # Inside (1)
-                        if cntment == Rhino.Geometry.PointContainment(1):
-                            matches.append(key)
-                # delete duplicates
-                matches = list(dict.fromkeys(matches))
-                
-                return matches
-            else:
-                print ("Curve not closed - IdNeighs")
-        else:
-            print ("Polyline not closed - IdNeighs")
+    # Identify the neighbours of one agent by ID string
+    def IDNeighNeighbours(self, ag_ng_id):
+        neighbours = self.NeighIndex.Neighbours(self.AgIndex[ag_ng_id])
+        return [self.AgInNeigh[idx] for idx in neighbours]
         
     # Returns a list of the index of agents within the range of view of every agent
     def RangeViewN(self):
         onRange = {}
-        for ag_id in self.AgInNeigh:
-            neigh_IDs = self.IDNeighNeighbours(ag_id)
+        for idx, ag_id in enumerate(self.AgInNeigh):
+            neigh_IDs = [self.AgInNeigh[nidx] for nidx in self.NeighIndex.Neighbours(idx)]
             onRange[ag_id] = neigh_IDs
 
         return onRange
+
+    # Groups (lists of IDs) of the participants that never interact with another group, so
+    # each group can learn on its own. In individual mode a participant only interacts with
+    # those in its range of view, in cooperative mode (coop) also with the neighbours of its
+    # neighbours, as its reward takes in the performance of its neighbours
+    def InteractionGroupsN(self, participants, coop=False):
+        marked = np.zeros(len(self.Agents), dtype=bool)
+        marked[self.RowsN(participants)] = True
+        labels = spatial_index.InteractionLabels(self.NeighIndex.Indptr, self.NeighIndex.Indices,
+                                                 marked, 2 if coop else 1)
+        groups = [[] for _ in range(int(labels.max()) + 1 if len(participants) > 0 else 0)]
+        for ag_id in participants:
+            groups[labels[self.AgIndex[ag_id]]].append(ag_id)
+        return groups
         
+    # Show output (only built when read)
+    @property
+    def BrepsN(self):
+        return self.GetBrepsN().values()
+
     # Gets the Breps of all the agents in the neighbourhood
     def GetBrepsN(self):
         breps = {}
@@ -193,87 +401,159 @@ class Neighbourhood:
             breps[ag_id] = brep
         return breps
         
-    # Get current individual states for all agents in the neigh
+    # Get current individual states for all agents in the neigh, read from OccupancyN
     def GetIStatesN(self):
-        states = {}  # This only contains the single-states
-        for ag_id in self.AgInNeigh:
-            agent = self.GetAgentbyID(ag_id)
-            c_state = agent.C_state
-            states[ag_id] = c_state
-        return states
+        modules = self.OccupancyN.reshape(len(self.AgInNeigh), -1)
+        if self.StateEncoding == "Bits":
+            states = voxel_geom.StatesBitsOf(modules)
+        else:
+            states = voxel_geom.StateStringsOf(modules)
+        return dict(zip(self.AgInNeigh, states))
+
+    # Current individual state of an agent in the state encoding of the neighbourhood
+    def IState(self, agent):
+        return agent.C_bits if self.StateEncoding == "Bits" else agent.C_state
     
+    # Joint state of an agent as a key of the q-values: its own state is the smallest of its
+    # mirrors when the agent uses the symmetry of its lot (see HHagent.KeyAction for its actions)
+    def KeyJState(self, ag_id, jstate):
+        agent = self.GetAgentbyID(ag_id)
+        if not agent.Mirrors or jstate == self.NullJState:
+            return jstate
+        if self.StateEncoding == "Bits":
+            state = voxel_geom.BitsState(jstate[0], len(agent.InitState))
+            return (voxel_geom.StateBits(agent.Template.CanonicalState(state)[0]),) + jstate[1:]
+        state, sep, neigh_states = jstate.partition('_')
+        return agent.Template.CanonicalState(state)[0] + sep + neigh_states
+
+    # Owner of the q-values and performance records of an agent (see QStore.AddState): the agent
+    # itself, or with symmetry the template of its lot, shared by the lots of the same dimensions
+    def KeyOwner(self, ag_id):
+        agent = self.GetAgentbyID(ag_id)
+        if self.Symmetry and agent.Backend == "Voxel":
+            return agent.Template.Key
+        return ag_id
+
+    # Rows of the arrays of the neighbourhood (AgIndex) of some agents
+    def RowsN(self, agents_ids):
+        return np.fromiter((self.AgIndex[ag_id] for ag_id in agents_ids), dtype=np.int64, count=len(agents_ids))
+
     # Gets the avail acts of all the agents in the Neighbourhood
     def GetAvailActsN(self, agents_ids):
-        list_availacts = {}
-        #for ag_id in self.AgInNeigh:
-        for ag_id in agents_ids:
-            agent = self.GetAgentbyID(ag_id)
-            c_avail_acts = agent.Poss_act
-            list_availacts[ag_id] = c_avail_acts
+        list_availacts = dict(zip(agents_ids, self.PossActN[self.RowsN(agents_ids)].tolist()))
         return list_availacts
         
-    # This function returns a list of combined current states per agent as string
+    # This function returns a list of combined current states per agent
+    # Only the joint states including an agent that changed since the last call are built again
     def GetJStatesN(self, agents_ids):
-        ind_states = self.GetIStatesN()  # Get all current states as dict
-        neighs_pera = self.EveryNeigh # gets the agents neighbouring each agent
+        if self.DirtyAgents:
+            for dirty_id in self.DirtyAgents:
+                for reader_id in self.JStateReaders[dirty_id]:
+                    self.JStates.pop(reader_id, None)
+            self.DirtyAgents.clear()
+
         combo_states = {} #Fill with combo states
         # For each agent
-        #for ag_id in self.AgInNeigh:
         for ag_id in agents_ids:
-            neigh_ids = neighs_pera[ag_id] #Neighs of the current ag
-            if len(neigh_ids) > 1:
-                neigh_ids.sort()
-            my_istate = ind_states[ag_id]  # Get my current state
-
-            # Getting the current state of my neighbours
-            my_neighstates = []
-            for id in neigh_ids:
-                neigh_state = ind_states[id]
-                my_neighstates.append(neigh_state)
-
-            # The following detects if my state or their state is null
-            my_anyTs = my_istate.count('T')
-            neigh_noTs = []
-            for neigh_state in my_neighstates:
-                counT = neigh_state.count('T')
-                if counT == 0:
-                    neigh_noTs.append(neigh_state)
-
-            if my_anyTs == 0 or len(neigh_noTs) > 0:
-                my_istate = 'F'  # THIS IS THE ABSOLUTE NULL STATE
-            else:
-                # Joining my state and their state in a str
-                for state in my_neighstates:
-                    tup = (my_istate, state)  # a tuples with two strings
-                    stri = '_'.join(tup)  # Join the two string on the tuple
-                    my_istate = stri  # replace initial list for list of joined tuples
-
-            # append to list of joined states
-            combo_states[ag_id] = my_istate
+            my_jstate = self.JStates.get(ag_id)
+            if my_jstate is None:
+                my_jstate = self.BuildJState(ag_id)
+                self.JStates[ag_id] = my_jstate
+            combo_states[ag_id] = my_jstate
 
         return combo_states
+
+    # Joint state of one agent from the current states of the agent and its neighbours
+    def BuildJState(self, ag_id):
+        my_istate = self.IState(self.GetAgentbyID(ag_id))  # Get my current state
+
+        # Getting the current state of my neighbours
+        my_neighstates = []
+        for id_n in self.SortedNeigh[ag_id]:
+            neigh_state = self.IState(self.GetAgentbyID(id_n))
+            my_neighstates.append(neigh_state)
+
+        return self.JoinStates(my_istate, my_neighstates)
+
+    # Joint state from my individual state and those of my neighbours (sorted by id)
+    def JoinStates(self, my_istate, my_neighstates):
+        if self.StateEncoding == "Bits":
+            # A null state has no occupied module, so its bitmask is 0
+            if my_istate == 0 or 0 in my_neighstates:
+                return self.NullJState
+            return (my_istate,) + tuple(my_neighstates)
+
+        # The following detects if my state or their state is null
+        my_anyTs = my_istate.count('T')
+        neigh_noTs = []
+        for neigh_state in my_neighstates:
+            counT = neigh_state.count('T')
+            if counT == 0:
+                neigh_noTs.append(neigh_state)
+
+        if my_anyTs == 0 or len(neigh_noTs) > 0:
+            my_istate = 'F'  # THIS IS THE ABSOLUTE NULL STATE
+        else:
+            # Joining my state and their state in a str
+            for state in my_neighstates:
+                tup = (my_istate, state)  # a tuples with two strings
+                stri = '_'.join(tup)  # Join the two string on the tuple
+                my_istate = stri  # replace initial list for list of joined tuples
+        return my_istate
+
+    # Joint state of an agent as written in the csv files (the "String" encoding)
+    def JStateString(self, ag_id, jstate):
+        if self.StateEncoding == "String" or jstate is None:
+            return jstate
+        if jstate == self.NullJState:
+            return 'F'
+        neighbours_ids = sorted(self.EveryNeigh[ag_id])
+        sizes = [len(self.GetAgentbyID(id_ag).InitState) for id_ag in [ag_id] + neighbours_ids]
+        return '_'.join(voxel_geom.BitsState(bits, size) for bits, size in zip(jstate, sizes))
         
     # Get the size of each agent in the neighbourhood
     def GetOccupiedPN(self):
-        ocuppiedp = {}
-        for ag_id in self.AgInNeigh:
-            agent = self.GetAgentbyID(ag_id)
-            c_occupied = agent.NOccupiedPts
-            ocuppiedp[ag_id] = c_occupied
+        ocuppiedp = dict(zip(self.AgInNeigh, self.OccupiedN.tolist()))
         return ocuppiedp
 
+    # Modules each agent still needs to reach its size in a dict by agent id (negative when it is
+    # over it), for all the agents of the neighbourhood
+    def NeedsN(self, dict_of_sizes):
+        sizes = np.array([dict_of_sizes[ag_id] for ag_id in self.AgInNeigh], dtype=np.int64)
+        return dict(zip(self.AgInNeigh, (sizes - self.OccupiedN).tolist()))
+
+    # Agents (as a boolean array in the order of agents_ids) occupying at least their target modules
+    def FilledN(self, agents_ids, targets):
+        return self.OccupiedN[self.RowsN(agents_ids)] >= np.asarray(targets)
+
     def GetExtCost_BalanceN(self):
-        extcost = {}
-        balance = {}
-        for ag_id in self.AgInNeigh:
-            agent = self.GetAgentbyID(ag_id)
-            my_extcost = agent.WallAreaExtCost + agent.RoofAreaExtCost
-            my_balance = BUDGET - my_extcost  # Budget is a global component input
-            extcost[ag_id] = my_extcost
-            balance[ag_id] = my_balance
+        my_extcost = self.WallCostN + self.RoofCostN
+        my_balance = BUDGET - my_extcost  # Budget is a global component input
+        extcost = dict(zip(self.AgInNeigh, my_extcost.tolist()))
+        balance = dict(zip(self.AgInNeigh, my_balance.tolist()))
 
         return [extcost, balance]
         
+    # Snapshots of the agents (all by default) to restore them later without replaying their actions
+    def SnapshotN(self, agents_ids=None):
+        if agents_ids is None:
+            agents_ids = self.AgInNeigh
+        return {ag_id: self.GetAgentbyID(ag_id).Snapshot() for ag_id in agents_ids}
+
+    # Restore the agents (all those in the snapshot by default) to a SnapshotN
+    def RestoreN(self, snapshot, agents_ids=None):
+        if agents_ids is None:
+            agents_ids = snapshot.keys()
+        for ag_id in agents_ids:
+            self.GetAgentbyID(ag_id).Restore(snapshot[ag_id])
+
+    # After loading (see LoadNeighbourhood) the voxel agents grow their slice of OccupancyN again
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for idx, agent in enumerate(self.Agents):
+            if agent.Backend == "Voxel":
+                agent.Occupancy = self.OccupancyN[idx]
+
     # This function massively applies the actions to all the agents
     def TakeActionsN(self, dict_of_actions):
         for ag_id in self.AgInNeigh:
@@ -291,7 +571,7 @@ class Neighbourhood:
         sja_tables = {}
         #for ag_id in self.AgInNeigh:
         for ag_id in agents_ids:
-            my_initial_state = initial_jstates[ag_id]  # joint state string
+            my_initial_state = self.KeyJState(ag_id, initial_jstates[ag_id])  # joint state string
             my_initial_actions = initial_poss_acts[ag_id]  # possible acts on my initial state
             agent = self.GetAgentbyID(ag_id)
 
@@ -312,10 +592,10 @@ class Neighbourhood:
             my_qtab = {}
             my_qtab[my_initial_state] = {}
             my_qtab[
-                'F'] = None  # This is the absolute null state, if one individual state is non-manifold, joint_state = F
+                self.NullJState] = None  # This is the absolute null state, if one individual state is non-manifold
             my_JAstate = {}
             my_JAstate[my_initial_state] = {}
-            my_JAstate['F'] = None  # This is the absolute null state
+            my_JAstate[self.NullJState] = None  # This is the absolute null state
             for combo in combos:
                 my_qtab[my_initial_state][combo] = [0 for k in range(0, my_initial_actions + 2)]
                 my_JAstate[my_initial_state][combo] = 0
@@ -338,7 +618,7 @@ class Neighbourhood:
         neighs_pera = self.EveryNeigh # neighbours for every agent
         #for ag_id in self.AgInNeigh:
         for ag_id in agents_ids:
-            my_jstate = dict_of_jstates[ag_id]  # current joint state for this agent
+            my_jstate = self.KeyJState(ag_id, dict_of_jstates[ag_id])  # current joint state for this agent
             my_qtab = dict_of_qtables[ag_id]  # current qtable for this agent
             my_SJA = dict_of_SJA_dicts[ag_id]  # Current count state-joint-action dictionary
 
@@ -372,6 +652,65 @@ class Neighbourhood:
             new_dict_of_SJA[ag_id] = my_SJA
 
         return [new_dict_of_qtabs, new_dict_of_SJA]
+
+    # Same as GetMultiQtablesN with the q-tables of all the agents in one q_store.QStore
+    def GetQStoreN(self, initial_poss_acts, initial_jstates, agents_ids):
+        qstore = q_store.QStore()
+        self.CheckQStoreN(qstore, initial_jstates, initial_poss_acts, agents_ids)
+        return qstore
+
+    # Same as CheckQtableN, adding the current joint state of each agent to the QStore (for its
+    # KeyOwner) when it is not there yet. The radix of a neighbour is its number of actions
+    # (including 0 and the one after the last)
+    def CheckQStoreN(self, qstore, dict_of_jstates, dict_of_possibleacts, agents_ids):
+        for ag_id in agents_ids:
+            owner = self.KeyOwner(ag_id)
+            my_jstate = self.KeyJState(ag_id, dict_of_jstates[ag_id])
+            if qstore.StateId(owner, my_jstate) is None:
+                radices = [dict_of_possibleacts[id_n] + 2 for id_n in self.SortedNeigh[ag_id]]
+                qstore.AddState(owner, my_jstate, dict_of_possibleacts[ag_id] + 2, radices)
+        return qstore
+
+    # Same as HHagent.GetActionMulti2 for several agents with their q-tables in a QStore: with
+    # probability 1 - epsilon the action with the highest expected q-value ("From Table", chosen
+    # for all the greedy agents at once), otherwise a random one. The random numbers are drawn
+    # agent by agent in the order of agents_ids. Returns a dict of (action, flag) by agent
+    def GetActionsQStoreN(self, qstore, dict_of_epsilons, dict_of_jstates, agents_ids):
+        selected = {}
+        greedy = []
+        for ag_id in agents_ids:
+            if random.random() > dict_of_epsilons[ag_id]:
+                greedy.append(ag_id)
+            else:
+                selected[ag_id] = (random.randint(1, int(self.GetAgentbyID(ag_id).Poss_act)), "Random")
+
+        sids = self.StateIdsN(qstore, dict_of_jstates, greedy)
+        for ag_id, key_action in zip(greedy, qstore.ArgmaxMany(sids).tolist()):
+            # Action numbered as in the q-table, which is keyed by the mirror of the state
+            selected[ag_id] = (self.GetAgentbyID(ag_id).OwnAction(key_action), "From Table")
+
+        return {ag_id: selected[ag_id] for ag_id in agents_ids}
+
+    # Ids in the QStore of the joint states of some agents (None for those not added), as a list
+    def StateIdsN(self, qstore, dict_of_jstates, agents_ids):
+        return [qstore.StateId(self.KeyOwner(ag_id), self.KeyJState(ag_id, dict_of_jstates[ag_id]))
+                for ag_id in agents_ids]
+
+    # Actions of the neighbours of some agents (sorted by id) as the rows of an array, 0 for None
+    # and after the last neighbour (see QStore.JointActionIds)
+    def JointActionArrayN(self, dict_of_actions, agents_ids):
+        all_actions = np.zeros(len(self.AgInNeigh) + 1, dtype=np.int64)  # the last one for the padding
+        all_actions[self.RowsN(list(dict_of_actions.keys()))] = [0 if action is None else action
+                                                                 for action in dict_of_actions.values()]
+        return all_actions[self.SortedNeighRows[self.RowsN(agents_ids)]]
+
+    # Actions of the neighbours of each agent (sorted by id) as a tuple, 0 for None
+    def JointActionsN(self, dict_of_actions, agents_ids):
+        jactions = {}
+        for ag_id in agents_ids:
+            jactions[ag_id] = tuple(0 if dict_of_actions[id_n] is None else dict_of_actions[id_n]
+                                    for id_n in self.SortedNeigh[ag_id])
+        return jactions
     
     # this function allows starting the very initial q table
     def GetInitPossActsN(self, agent_ids):
@@ -379,7 +718,7 @@ class Neighbourhood:
         #for ag_id in self.AgInNeigh:
         for ag_id in agent_ids:
             agent = self.GetAgentbyID(ag_id) 
-            mypossacts = agent.AvailActs(agent.BrepCore)
+            mypossacts = agent.InitPossAct
             possible_acts[ag_id] = mypossacts
         return possible_acts
     
@@ -388,7 +727,7 @@ class Neighbourhood:
         #for ag_id in self.AgInNeigh:
         for ag_id in agent_ids:
             agent = self.GetAgentbyID(ag_id)
-            my_istate = agent.InitState
+            my_istate = agent.InitBits if self.StateEncoding == "Bits" else agent.InitState
 
             # Identify my neighbours
             neighs_pera = self.EveryNeigh
@@ -398,28 +737,88 @@ class Neighbourhood:
             my_neigh_strs = []
             for id_ag in neighbours_ids:
                 oth_ag = self.GetAgentbyID(id_ag)
-                neigh_str = oth_ag.InitState  # gets the string of their individual init state
+                # gets their individual init state
+                neigh_str = oth_ag.InitBits if self.StateEncoding == "Bits" else oth_ag.InitState
                 my_neigh_strs.append(neigh_str)
 
-            # Join my string with theirs
-            for state in my_neigh_strs:
-                tup = (my_istate, state)  # a tuples with two strings
-                stri = '_'.join(tup)  # Join the two string on the tuple
-                my_istate = stri  # replace initial list for list of joined tuples
-
-            # append to list
-            joint_states[ag_id] = my_istate
+            # Join my state with theirs (initial states are never null)
+            joint_states[ag_id] = self.JoinStates(my_istate, my_neigh_strs)
 
         return joint_states
-    
+
+
+# Version of the files of SaveNeighbourhood, files of other versions are not loaded
+NEIGH_FILE_VERSION = 1
+
+# Modules with the classes of the objects saved with a Neighbourhood
+NEIGH_MODULES = (__file__, voxel_geom.__file__, spatial_index.__file__, q_store.__file__)
+_SOURCES_HASH = []
+
+
+# Hash of the sources of NEIGH_MODULES (read once), so the files saved by other code are not loaded
+def SourcesHash():
+    if not _SOURCES_HASH:
+        digest = hashlib.sha1()
+        for module_file in NEIGH_MODULES:
+            with open(module_file, "rb") as src_file:
+                digest.update(src_file.read())
+        _SOURCES_HASH.append(digest.hexdigest())
+    return _SOURCES_HASH[0]
+
+
+# Path of the file of a Neighbourhood built with these arguments and this code (hash of both)
+def NeighbourhoodFile(folder, args, kwargs):
+    key = repr((NEIGH_FILE_VERSION, SourcesHash(), args, sorted(kwargs.items())))
+    return os.path.join(folder, "neigh_" + hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pkl")
+
+
+# Write a Neighbourhood of the "Voxel" backend to a file (Rhino breps can not be saved)
+def SaveNeighbourhood(neigh, path):
+    if neigh.Backend != "Voxel":
+        print ("Only neighbourhoods of the Voxel backend can be saved")
+        return False
+    with open(path, "wb") as out_file:
+        pickle.dump(neigh, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+    return True
+
+
+def LoadNeighbourhood(path):
+    with open(path, "rb") as in_file:
+        return pickle.load(in_file)
+
+
+# Same as Neighbourhood(*args, **kwargs), but loaded from the folder when an earlier run saved
+# one with the same arguments (built and saved otherwise, also when the file can not be loaded)
+# Only "Voxel" neighbourhoods are saved, the "Rhino" ones are built on every call
+def CachedNeighbourhood(folder, *args, **kwargs):
+    path = NeighbourhoodFile(folder, args, kwargs)
+    if os.path.isfile(path):
+        try:
+            return LoadNeighbourhood(path)
+        except Exception as e:  # truncated file or objects of other code
+            print ("Could not load the neighbourhood in {} ({}), building it again".format(path, e))
+
+    neigh = Neighbourhood(*args, **kwargs)
+    if neigh.Backend == "Voxel":
+        os.makedirs(folder, exist_ok=True)
+        SaveNeighbourhood(neigh, path)
+    else:
+        print ("Only neighbourhoods of the Voxel backend are cached, the {} one is not saved".format(neigh.Backend))
+    return neigh
+
 
 # SPACE NEEDED MUST BE A LIST OF SIZE NR_OF AGENTS!, Add a budget input of the same format!
 class BlockOfAgents:
     # Initializer with plot location
     def __init__(self, blockorigx, blockorigy, lotsizex, lotsizey, module, coreorigx, coreorigy, coresizex, coresizey,
-                 maxheight, NrlotsOnSide, doubleside, mainsideXorY, radius_neigh, space_needed, w_cost, r_cost):
+                 maxheight, NrlotsOnSide, doubleside, mainsideXorY, radius_neigh, space_needed, w_cost, r_cost,
+                 geom_backend="Rhino", transitions=None):
         self.WallsCost = w_cost
         self.RoofCost = r_cost
+        self.Backend = geom_backend
+        if transitions is None:
+            transitions = TransitionCache()
+        self.Transitions = transitions  # shared by the lots of the block
         self.BlockOrigX = blockorigx
         self.BlockOrigY = blockorigy
         self.LotsOnSide = NrlotsOnSide
@@ -439,7 +838,8 @@ class BlockOfAgents:
         if self.LotsOnSide <= 1:  # Single agent
             self.Lots = HHagent(self.BlockOrigX, self.BlockOrigY, self.LotsSizeX, self.LotsSizeY, self.LotsModule,
                                 self.LotsCoresOrigX, self.LotsCoresOrigY, self.LotsCoresSizeX, self.LotsCoresSizeY,
-                                self.LotsMaxH, self.SpaceNeeded, self.WallsCost, self.RoofCost)
+                                self.LotsMaxH, self.SpaceNeeded, self.WallsCost, self.RoofCost, self.Backend,
+                                self.Transitions)
             self.Breps = self.Lots.BrepCore
             # The following is looking for sc.sticky["q_tab_mem"]
             self.Qtables = self.Lots.MyQTable()  # On q-table update this variable must be replaced
@@ -482,12 +882,25 @@ class BlockOfAgents:
             else:
                 MaxY += self.LotsModule
             
-        pt1 = Rhino.Geometry.Point3d(MinX, MinY, 0.0)
-        pt2 = Rhino.Geometry.Point3d(MinX, MaxY, 0.0)
-        pt3 = Rhino.Geometry.Point3d(MaxX, MaxY, 0.0)
-        pt4 = Rhino.Geometry.Point3d(MaxX, MinY, 0.0)
+        pt1 = Point3d(MinX, MinY, 0.0)
+        pt2 = Point3d(MinX, MaxY, 0.0)
+        pt3 = Point3d(MaxX, MaxY, 0.0)
+        pt4 = Point3d(MaxX, MinY, 0.0)
         
         return [pt1, pt2, pt3, pt4]
+
+    # Saved with plain points, and without the core brep of a single agent
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["BlockVerts"] = PlainPoints(self.BlockVerts)
+        state.pop("Breps", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.BlockVerts = PointsFromPlain(self.BlockVerts)
+        if not isinstance(self.Lots, list):
+            self.Breps = self.Lots.BrepCore
     
     # Multiply the lots on side
     def MutiplyLotsSide(self):
@@ -535,7 +948,7 @@ class BlockOfAgents:
         for pairs in origincoords:
             agents = HHagent(pairs[0], pairs[1], self.LotsSizeX, self.LotsSizeY, self.LotsModule, self.LotsCoresOrigX,
                              self.LotsCoresOrigY, self.LotsCoresSizeX, self.LotsCoresSizeY, self.LotsMaxH,
-                             self.SpaceNeeded, self.WallsCost, self.RoofCost)
+                             self.SpaceNeeded, self.WallsCost, self.RoofCost, self.Backend, self.Transitions)
             lots.append(agents)
         
         return lots
@@ -773,7 +1186,7 @@ class BlockOfAgents:
     def GetInitPossActs(self):
         possible_acts = []
         for i in range(len(self.Lots)):
-            mypossacts = self.Lots[i].AvailActs(self.Lots[i].BrepCore)
+            mypossacts = self.Lots[i].InitPossAct
             possible_acts.append(mypossacts)
         return possible_acts
 
@@ -1271,14 +1684,29 @@ class BlockOfAgents:
 class HHagent:
     ' The agent can only construct growable modules on positive coordinates '
 
+    # Attributes of the agents, without a __dict__ per agent (see "Memory" in the README)
+    # The points of the lot and core are computed when read
+    __slots__ = ("MaxHeightFl", "LotOrigX", "LotOrigY", "WCost", "RCost", "Backend", "Transitions",
+                 "LotSizeX", "LotSizeY", "Module", "CoreOrigX", "CoreOrigY", "CoreSizeX", "CoreSizeY",
+                 "SpaceNeeded", "LotShape", "Template", "TemplateKey", "Neighbours", "CoreOccupancy",
+                 "CoreExposed", "InitInsidePtIdx", "InitState", "InitBits", "CentreModulePtsBuilt",
+                 "QTableBuilt", "Neighbourhood", "NeighID", "NeighRow", "CoreGrowFaces", "Occupancy",
+                 "Exposed", "GrowFaces", "BrepCoreBuilt", "VertixCore", "C_state", "C_bits", "BrepStale",
+                 "BrepToMove", "BrepBuilt", "Poss_act", "InitPossAct", "NOccupiedPts", "WallAreaExtCost",
+                 "RoofAreaExtCost", "C_Area", "Mirrors")
+
     # Initializer with plot location
     def __init__(self, lotorigx, lotorigy, lotsizex, lotsizey, module, coreorigx, coreorigy, coresizex, coresizey, maxh,
-                 space_needed, walls_c, roof_c):
+                 space_needed, walls_c, roof_c, backend="Rhino", transitions=None):
         self.MaxHeightFl = maxh
         self.LotOrigX = lotorigx
         self.LotOrigY = lotorigy
         self.WCost = walls_c
         self.RCost = roof_c
+        self.Backend = backend  # "Rhino" extrudes Breps, "Voxel" grows a boolean array of modules
+        if transitions is None:
+            transitions = TransitionCache()
+        self.Transitions = transitions  # results of Extend, can be shared with other lots
 
         if lotsizex <= 0:
             print ("lot size x must be greater than 0")
@@ -1319,37 +1747,125 @@ class HHagent:
         else:
             self.CoreSizeY = coresizey
 
-        self.CentreModulePts = self.TestPtsSt()
-        self.VertixLots = self.vertix(self.LotOrigX, self.LotOrigY, self.LotSizeX, self.LotSizeY, self.Module)
-        self.CoreOrigPt = self.coreorig(self.LotOrigX, self.LotOrigY, self.LotSizeX, self.LotSizeY, self.Module,
-                                        self.CoreOrigX, self.CoreOrigY, self.CoreSizeX, self.CoreSizeY)
-        self.VertixCore = self.vertix2(self.CoreOrigPt, self.CoreSizeX, self.CoreSizeY, self.Module)
-        self.BrepCore = self.startingbrep(self.VertixCore)  # Keep in memory to retrieve
-
-        self.InitInsidePt = self.InsidePts(self.BrepCore)[0]
-        self.InitInsidePtIdx = self.InsidePts(self.BrepCore)[1]
-        self.InitState = self.GetStateString(self.InitInsidePtIdx)
-        self.MaxStates = self.FutStatesStr(space_needed)  # space needed is an input
-        self.MyQTable = self.CreateQTable(self.MaxStates, self.MaxActions())
+        self.SpaceNeeded = space_needed
+        lot_shape = (int(self.LotSizeX), int(self.LotSizeY), int(self.MaxHeightFl))  # in modules
+        core_orig = self.CoreOrigPt
+        # Position of the core relative to the lot (in modules)
+        corex = int(round((core_orig.X - self.LotOrigX) / self.Module))
+        corey = int(round((core_orig.Y - self.LotOrigY) / self.Module))
+
+        # What only depends on the dimensions is shared with the other lots of the same template
+        self.Template = GetLotTemplate(lot_shape, self.Module, corex, corey, self.CoreSizeX, self.CoreSizeY,
+                                       self.Backend)
+        self.LotShape = self.Template.Shape
+        # Lots with the same template and costs can also share transitions
+        self.TemplateKey = self.Template.Key + (self.WCost, self.RCost)
+        self.Neighbours = self.Template.Neighbours  # neighbours of each of the points of TestPtsSt
+        self.CoreOccupancy = self.Template.CoreOccupancy
+        self.CoreExposed = self.Template.CoreExposed  # exposed (walls, roofs, floor) faces
+        self.InitInsidePtIdx = self.Template.InitInsidePtIdx  # tuple
+        self.InitState = self.Template.InitState
+        self.InitBits = self.Template.InitBits  # same state as an integer bitmask
+
+        # Built when first needed
+        self.CentreModulePtsBuilt = None
+        self.QTableBuilt = None
+
+        # Set by the Neighbourhood, which keeps the joint states and the arrays of all the agents
+        self.Neighbourhood = None
+        self.NeighID = None
+        self.NeighRow = None
+        self.Mirrors = ()  # mirrors of the lot for the keys of the states (see KeyAction)
+
+        if self.Backend == "Voxel":
+            self.CoreGrowFaces = self.Template.CoreGrowFaces
+            self.Occupancy = self.CoreOccupancy.copy()
+            self.Exposed = self.CoreExposed
+            self.GrowFaces = list(self.CoreGrowFaces)  # ordered keys of the growable faces
+            self.BrepCoreBuilt = None  # built from CoreOccupancy when read
+        else:
+            self.VertixCore = self.vertix2(core_orig, self.CoreSizeX, self.CoreSizeY, self.Module)
+            self.BrepCore = self.startingbrep(self.VertixCore)  # Keep in memory to retrieve
 
         # On initial stage
-        self.OutBrep = self.BrepCore
         self.C_state = self.InitState
-        self.Poss_act = self.AvailActs(self.OutBrep)
-        self.NOccupiedPts = len(self.InsidePts(self.BrepCore)[0])
+        self.C_bits = self.InitBits
+        if self.Backend == "Voxel":
+            self.BrepStale = True  # built from the occupancy when read
+            self.BrepToMove = None
+            self.BrepBuilt = None
+            self.Poss_act = len(self.CoreGrowFaces)
+        else:
+            self.OutBrep = self.BrepCore
+            if self.Template.InitPossAct is None:
+                self.Template.InitPossAct = self.AvailActs(self.OutBrep)
+            self.Poss_act = self.Template.InitPossAct
+        self.InitPossAct = self.Poss_act
+        self.NOccupiedPts = len(self.InitInsidePtIdx)
         self.WallAreaExtCost = 0  # as we havent extended
         self.RoofAreaExtCost = 0  # as we havent extended
+        self.C_Area = int(round(sum(self.CoreExposed) * self.Module ** 2))
+
+    # Vertices of the lot (closed polyline) and origin of the core, computed when read
+    @property
+    def VertixLots(self):
+        return self.vertix(self.LotOrigX, self.LotOrigY, self.LotSizeX, self.LotSizeY, self.Module)
+
+    @property
+    def CoreOrigPt(self):
+        return self.coreorig(self.LotOrigX, self.LotOrigY, self.LotSizeX, self.LotSizeY, self.Module,
+                             self.CoreOrigX, self.CoreOrigY, self.CoreSizeX, self.CoreSizeY)
+
+    # Points of TestPtsSt, only built when needed (the voxel backend never needs them)
+    @property
+    def CentreModulePts(self):
+        if self.CentreModulePtsBuilt is None:
+            self.CentreModulePtsBuilt = self.TestPtsSt()
+        return self.CentreModulePtsBuilt
+
+    @property
+    def InitInsidePt(self):
+        return [self.CentreModulePts[idx] for idx in self.InitInsidePtIdx]
+
+    # Brep of the core, on the voxel backend only built when read
+    @property
+    def BrepCore(self):
+        if self.BrepCoreBuilt is None and self.Backend == "Voxel":
+            self.BrepCoreBuilt = self.VoxelBrep(self.CoreOccupancy)  # None when Rhino is not loaded
+        return self.BrepCoreBuilt
+
+    @BrepCore.setter
+    def BrepCore(self, brep):
+        self.BrepCoreBuilt = brep
+
+    # Possible future states, enumerated once per template
+    # (plus the null state, that CreateQTable used to append on init)
+    @property
+    def MaxStates(self):
+        states = self.Template.FutStates.get(self.SpaceNeeded)
+        if states is None:
+            states = self.FutStatesStr(self.SpaceNeeded)  # space needed is an input
+            states.append(self.GetNullState())
+            self.Template.FutStates[self.SpaceNeeded] = states
+        return states
+
+    @property
+    def MyQTable(self):
+        if self.QTableBuilt is None:
+            # CreateQTable appends the null state, so it gets a copy of the shared list
+            self.QTableBuilt = self.CreateQTable(list(self.MaxStates), self.MaxActions())
+        return self.QTableBuilt
 
     # Returns the points inside the voxels to test the state of the brep
     def TestPtsSt(self):
-        first_pt = Rhino.Geometry.Point3d(self.LotOrigX + self.Module / 2, self.LotOrigY + self.Module / 2, self.Module / 2)
+        first_pt = Point3d(self.LotOrigX + self.Module / 2, self.LotOrigY + self.Module / 2, self.Module / 2)
 
         pt_cloud = []
 
         for i in range(int(self.LotSizeX)):
             for j in range(int(self.LotSizeY)):
                 for k in range(int(self.MaxHeightFl)):
-                    pt = Rhino.Geometry.Point3d(first_pt.X + self.Module * i, first_pt.Y + self.Module * j,
+                    pt = Point3d(first_pt.X + self.Module * i, first_pt.Y + self.Module * j,
                                     first_pt.Z + self.Module * k)
                     pt_cloud.append(pt)
 
@@ -1358,51 +1874,39 @@ class HHagent:
         # Find the index of the points inside the brep
 
     def InsidePts(self, brep):
-        p_cloud = self.TestPtsSt()
+        p_cloud = self.CentreModulePts
         pts_inside = []
         index_inside = []
-        for point in p_cloud:
+        for idx, point in enumerate(p_cloud):
             bol = brep.IsPointInside(point, Rhino.RhinoMath.SqrtEpsilon, False)
             if bol:
                 pts_inside.append(point)
-                index_inside.append(p_cloud.index(point))
+                index_inside.append(idx)
 
         return (pts_inside, index_inside)
 
-    # Find the index of the points that can be possibly occupied on the next stage
-    def PossPointsIndex(self, brep):
-        p_cloud = self.TestPtsSt()
-        pts_inside = self.InsidePts(brep)[0]
-        index_inside = self.InsidePts(brep)[1]
-
-        index_of_possible = []
-        for pts in pts_inside:
-            for pt in p_cloud:
-                if pts.DistanceTo(pt) == self.Module:
-                    index_of_possible.append(p_cloud.index(pt))
-
-        # Delete duplicates
-        index_of_possible = list(dict.fromkeys(index_of_possible))
+    # State string of a brep with a single sweep of the test points
+    def StateFromBrep(self, brep):
+        bolstr = []
+        for point in self.CentreModulePts:
+            if brep.IsPointInside(point, Rhino.RhinoMath.SqrtEpsilon, False):
+                bolstr.append("T")
+            else:
+                bolstr.append("F")
 
-        # Delete indices of the ones initially inside the brep
-        ind_possible = list(set(index_of_possible) - set(index_inside))
+        return ''.join(bolstr)
 
-        return ind_possible
+    # Find the index of the points that can be possibly occupied on the next stage
+    def PossPointsIndex(self, brep):
+        return self.PossPointsIndex2(self.InsidePts(brep)[1])
 
     # Does the same as above but the input is a list of indices inside an initial brep
     def PossPointsIndex2(self, inside_idx):
-        p_cloud = self.TestPtsSt()
-        pts_inside = []
-
-        for idx in inside_idx:
-            pt = p_cloud[idx]
-            pts_inside.append(pt)
+        neighbours = self.Neighbours
 
         index_of_possible = []
-        for pts in pts_inside:
-            for pt in p_cloud:
-                if pts.DistanceTo(pt) == self.Module:
-                    index_of_possible.append(p_cloud.index(pt))
+        for idx in inside_idx:
+            index_of_possible.extend(neighbours[idx])
 
         # Delete duplicates
         index_of_possible = list(dict.fromkeys(index_of_possible))
@@ -1470,7 +1974,7 @@ class HHagent:
 
     # Get possible next states from pre-defined initial state
     def FutStatesStr(self, generations):
-        idx_next_mods = self.MultipleGenSt(self.InitInsidePtIdx,
+        idx_next_mods = self.MultipleGenSt(list(self.InitInsidePtIdx),
                                            int(generations))  # For the said number of generations
         Poss_st = []  # List of strings with the possible future states
 
@@ -1488,11 +1992,11 @@ class HHagent:
 
     # Forms four vertices from coordinates of origin and size
     def vertix(self, xorig, yorig, xsize, ysize, module):
-        lot1 = Rhino.Geometry.Point3d(xorig, yorig, 0)
-        lot2 = Rhino.Geometry.Point3d(xorig + (xsize * module), yorig, 0)
-        lot3 = Rhino.Geometry.Point3d(xorig + (xsize * module), yorig + (ysize * module), 0)
-        lot4 = Rhino.Geometry.Point3d(xorig, yorig + (ysize * module), 0)
-        lot5 = Rhino.Geometry.Point3d(xorig, yorig, 0)
+        lot1 = Point3d(xorig, yorig, 0)
+        lot2 = Point3d(xorig + (xsize * module), yorig, 0)
+        lot3 = Point3d(xorig + (xsize * module), yorig + (ysize * module), 0)
+        lot4 = Point3d(xorig, yorig + (ysize * module), 0)
+        lot5 = Point3d(xorig, yorig, 0)
 
         lotverts = [lot1, lot2, lot3, lot4, lot5]
         return lotverts
@@ -1516,7 +2020,7 @@ class HHagent:
         else:
             absy = y3abs
 
-        coreorig = Rhino.Geometry.Point3d(absx, absy, 0)
+        coreorig = Point3d(absx, absy, 0)
         return coreorig
 
     # Same as vertix() but with fewer inputs
@@ -1552,25 +2056,7 @@ class HHagent:
         return outbrep
 
     def startingstate(self):
-        p_cloud = self.TestPtsSt()
-        list_of_bool = []
-
-        for point in p_cloud:
-            bol = self.BrepCore.IsPointInside(point, Rhino.RhinoMath.SqrtEpsilon, False)
-            list_of_bool.append(bol)
-
-        my_bolstr_list = []
-        for bol in list_of_bool:
-            if bol:
-                st = "T"
-                my_bolstr_list.append(st)
-            else:
-                st = "F"
-                my_bolstr_list.append(st)
-
-        c_state = ''.join(my_bolstr_list)
-
-        return c_state
+        return self.StateFromBrep(self.BrepCore)
 
     # Classify vertices in sublists according to the index of the face they belong to
     def ClassifyVertix(self, inbrep):
@@ -1600,8 +2086,10 @@ class HHagent:
         return vertices
 
     # Classify index in walls, roof and floor
-    def ClassifyFaces(self, inbrep):
-        vertices = self.ClassifyVertix(inbrep)
+    # (vertices can be given if ClassifyVertix was already called on inbrep)
+    def ClassifyFaces(self, inbrep, vertices=None):
+        if vertices is None:
+            vertices = self.ClassifyVertix(inbrep)
 
         roofs = []
         wandr = []
@@ -1635,57 +2123,30 @@ class HHagent:
 
         return [walls, roofs, floor, walls_up]
 
-    def WallsAreasExtension(self, initialbrep, finalbrep):
-        classed_init = list(set(self.ClassifyFaces(initialbrep)[0] + self.ClassifyFaces(initialbrep)[3]))
-        classed_end = list(set(self.ClassifyFaces(finalbrep)[0] + self.ClassifyFaces(finalbrep)[3]))
-
-        my_areas_init = []
-        my_areas_end = []
-
-        for idx in classed_init:
-            srf_brp = initialbrep.Faces[idx].ToBrep()
-            my_area = srf_brp.GetArea()
-            my_areas_init.append(my_area)
-
-        for idx in classed_end:
-            srf_brp = finalbrep.Faces[idx].ToBrep()
-            my_area = srf_brp.GetArea()
-            my_areas_end.append(my_area)
+    # Sum of the areas of the walls (any floor) of a brep
+    def WallsArea(self, inbrep):
+        classed = self.ClassifyFaces(inbrep)
+        return sum(inbrep.Faces[idx].ToBrep().GetArea() for idx in set(classed[0] + classed[3]))
 
-        walls_area_init = sum(my_areas_init)
-        walls_area_end = sum(my_areas_end)
+    # Sum of the areas of the roofs of a brep
+    def RoofsArea(self, inbrep):
+        classed = self.ClassifyFaces(inbrep)
+        return sum(inbrep.Faces[idx].ToBrep().GetArea() for idx in classed[1])
 
-        extension_wall_a = int(round(walls_area_end - walls_area_init))
+    def WallsAreasExtension(self, initialbrep, finalbrep):
+        extension_wall_a = int(round(self.WallsArea(finalbrep) - self.WallsArea(initialbrep)))
 
         return extension_wall_a
 
     def RoofsAreasExtension(self, initialbrep, finalbrep):
-        classed_init = self.ClassifyFaces(initialbrep)[1]
-        classed_end = self.ClassifyFaces(finalbrep)[1]
-
-        my_areas_init = []
-        my_areas_end = []
-
-        for idx in classed_init:
-            srf_brp = initialbrep.Faces[idx].ToBrep()
-            my_area = srf_brp.GetArea()
-            my_areas_init.append(my_area)
-
-        for idx in classed_end:
-            srf_brp = finalbrep.Faces[idx].ToBrep()
-            my_area = srf_brp.GetArea()
-            my_areas_end.append(my_area)
-
-        roofs_area_init = sum(my_areas_init)
-        roofs_area_end = sum(my_areas_end)
-
-        extension_roof_a = int(round(roofs_area_end - roofs_area_init))
+        extension_roof_a = int(round(self.RoofsArea(finalbrep) - self.RoofsArea(initialbrep)))
 
         return extension_roof_a
 
     # Filter the index of the walls that are on a plot boundary (cannot extend)
-    def FilterWalls(self, inbrep):
-        vertices = self.ClassifyVertix(inbrep)
+    def FilterWalls(self, inbrep, vertices=None):
+        if vertices is None:
+            vertices = self.ClassifyVertix(inbrep)
 
         # Set the size of the lot
         minx = self.LotOrigX
@@ -1715,7 +2176,7 @@ class HHagent:
                 FacesOnBorders.append(vertices.index(faceindex))
 
         # Compare index of faces on borders with walls, and delete walls on borders
-        walls = self.ClassifyFaces(inbrep)[0]
+        walls = self.ClassifyFaces(inbrep, vertices)[0]
         if len(FacesOnBorders) > 0:
             for i in FacesOnBorders:
                 for j in walls:
@@ -1725,8 +2186,9 @@ class HHagent:
         return walls
 
     # Filter the roofs so only those under the max height are elegible to grow
-    def FilterRoofs(self, inbrep):
-        vertices = self.ClassifyVertix(inbrep)
+    def FilterRoofs(self, inbrep, vertices=None):
+        if vertices is None:
+            vertices = self.ClassifyVertix(inbrep)
 
         # Select the index of the faces that cannot grow
         FacesOnTop = []
@@ -1740,7 +2202,7 @@ class HHagent:
                 FacesOnTop.append(vertices.index(faceindex))
 
         # Compare index of roofs on maxheight with roofs, and delete roofs on maxheight
-        roofs = self.ClassifyFaces(inbrep)[1]
+        roofs = self.ClassifyFaces(inbrep, vertices)[1]
         if len(FacesOnTop) > 0:
             for i in FacesOnTop:
                 for j in roofs:
@@ -1751,15 +2213,23 @@ class HHagent:
 
     # Return number of available actions at the current state
     def AvailActs(self, inbrep):
-        walls = self.FilterWalls(inbrep)
-        roofs = self.FilterRoofs(inbrep)
+        # On the voxel backend inbrep is the boolean array of modules
+        if self.Backend == "Voxel":
+            return len(voxel_geom.GrowableFacesOf(voxel_geom.StateString(inbrep), inbrep.shape))
+
+        vertices = self.ClassifyVertix(inbrep)
+        walls = self.FilterWalls(inbrep, vertices)
+        roofs = self.FilterRoofs(inbrep, vertices)
         availopts = len(walls) + len(roofs)  # When we run out of options this sum is 0
 
         return availopts
 
     # reconvert input action to available number of growable surfaces
     def BoundInputAction(self, action, inbrep):
-        availopts = self.AvailActs(inbrep)
+        return self.BoundAction(action, self.AvailActs(inbrep))
+
+    # Same as above when the number of available actions is already known
+    def BoundAction(self, action, availopts):
         INaction = int(action)
 
         if availopts > 0:
@@ -1782,47 +2252,59 @@ class HHagent:
         return OUTaction
 
         # Keep the same order of actions so everytime we hit a state, an action leads to the same future state
+    # Pairs (inside module, growable face) sorted, a face is paired with the modules whose centre is
+    # at half a module (+ tolerance) of it. For the rectangles aligned to the lattice (most faces)
+    # the distance is measured to the box of their vertices instead of calling ClosestPoint
+    def OrderActions(self, inbrep, tolerance, vertices=None, state=None):
+        if vertices is None:
+            vertices = self.ClassifyVertix(inbrep)
+        if state is None:
+            state = self.StateFromBrep(inbrep)
 
-    def OrderActions(self, inbrep, tolerance):
         AllPts = self.CentreModulePts
-        IdxptsInside = self.InsidePts(inbrep)[1]
-        IdxptsInside.sort()
-        available = self.FilterWalls(inbrep) + self.FilterRoofs(inbrep)
+        IdxptsInside = [idx for idx, st in enumerate(state) if st == "T"]
+        available = self.FilterWalls(inbrep, vertices) + self.FilterRoofs(inbrep, vertices)
 
-        brepFaces = inbrep.Faces
+        maxdist = self.Module / 2 + tolerance
 
         all_faces = []
 
-        for idx in IdxptsInside:
-            pt = AllPts[idx]
-            close_faces = []
-            for face in brepFaces:
-                if face.FaceIndex in available:  # Check if in growable faces
+        for faceidx in set(available):
+            # The box of a rectangle aligned with the axes is the face itself. Other faces (e.g.
+            # L-shaped after merging) have boxes over other modules, they use ClosestPoint
+            box = AlignedRectangleBox(vertices[faceidx], tolerance)
+            face = inbrep.Faces[faceidx]
+            for idx in IdxptsInside:
+                pt = AllPts[idx]
+                if box is not None:
+                    near = BoxDistance2(box, pt) <= maxdist ** 2
+                else:
                     facepts = face.ClosestPoint(pt)
-                    pt3d = face.PointAt(facepts[1], facepts[2])
-                    if pt3d.DistanceTo(pt) <= self.Module / 2 + tolerance:
-                        close_faces.append(face.FaceIndex)
-                    for faceidx in close_faces:
-                        all_faces.append((idx, faceidx))
+                    near = face.PointAt(facepts[1], facepts[2]).DistanceTo(pt) <= maxdist
+                if near:
+                    all_faces.append((idx, faceidx))
 
-        all_faces = list(dict.fromkeys(all_faces))  # Delete duplicates
         all_faces.sort()  # Sort list in increasing order
         return all_faces
 
     # Output vectors
-    def VectorExt(self, action, inbrep):
-        OUTaction = self.BoundInputAction(action, inbrep)
-        walls = self.FilterWalls(inbrep)  # indices of BREP faces that are walls
-        roofs = self.FilterRoofs(inbrep)
+    # (vertices and ordered_idx can be given if ClassifyVertix and OrderActions were already called)
+    def VectorExt(self, action, inbrep, vertices=None, ordered_idx=None):
+        if vertices is None:
+            vertices = self.ClassifyVertix(inbrep)  # all BREP vertices ordered in subgroups according to face index
+        allvertices = vertices
+
+        walls = self.FilterWalls(inbrep, allvertices)  # indices of BREP faces that are walls
+        roofs = self.FilterRoofs(inbrep, allvertices)
         # roofs = self.ClassifyFaces(inbrep)[1] # indices of BREP faces that are roof
-        floor = self.ClassifyFaces(inbrep)[2]  # indices of BREP faces that are floo
+        floor = self.ClassifyFaces(inbrep, allvertices)[2]  # indices of BREP faces that are floo
+        OUTaction = self.BoundAction(action, len(walls) + len(roofs))
 
         allfaces = inbrep.Faces
 
-        allvertices = self.ClassifyVertix(inbrep)  # all BREP vertices ordered in subgroups according to face index
-
         # Get face according to ordered list
-        ordered_idx = self.OrderActions(inbrep, 0.05)
+        if ordered_idx is None:
+            ordered_idx = self.OrderActions(inbrep, 0.05, allvertices)
 
         idxFace2move = ordered_idx[OUTaction - 1][1]  # Face to move
 
@@ -1909,6 +2391,27 @@ class HHagent:
 
         # What happens when the OutAction is beyond the avail number of faces?
 
+    # Closed Brep (one face per exposed module face) from a boolean array of modules
+    def VoxelBrep(self, occupancy):
+        if Rhino is None:
+            return None
+
+        mymesh = Rhino.Geometry.Mesh()
+        for direction, corners in voxel_geom.ExposedQuads(occupancy):
+            first = mymesh.Vertices.Count
+            for i, j, k in corners:
+                mymesh.Vertices.Add(self.LotOrigX + i * self.Module, self.LotOrigY + j * self.Module, k * self.Module)
+            mymesh.Faces.AddFace(first, first + 1, first + 2, first + 3)
+        mymesh.Vertices.CombineIdentical(True, True)
+        mymesh.Normals.ComputeNormals()
+        mymesh.Compact()
+
+        outbrep = Rhino.Geometry.Brep.CreateFromMesh(mymesh, True)
+        if outbrep.SolidOrientation == Rhino.Geometry.BrepSolidOrientation.Inward:
+            outbrep.Flip()
+
+        return outbrep
+
     # Identify duplicated faces
     def IdDuplicated(self, inbrep):
         vertices = self.ClassifyVertix(inbrep)
@@ -2063,6 +2566,30 @@ class HHagent:
 
         return (action, flag)
 
+    # Action of the current state as numbered in the key of the state (Neighbourhood.KeyJState),
+    # which is the same action when the key is not a mirror of the state
+    def KeyAction(self, action):
+        order = self.KeyActionOrder()
+        if order is None or action <= 0:
+            return action
+        return order[self.BoundAction(action, self.Poss_act)]
+
+    # Action of the current state from an action numbered as in the key of the state
+    def OwnAction(self, key_action):
+        order = self.KeyActionOrder()
+        if order is None or key_action <= 0:
+            return key_action
+        return order.index(self.BoundAction(key_action, self.Poss_act))
+
+    # Numbers in the key of the actions of the current state (None when they are the same)
+    def KeyActionOrder(self):
+        if not self.Mirrors or self.Poss_act == 0:
+            return None
+        mirror = self.Template.CanonicalState(self.C_state)[1]
+        if mirror is None:
+            return None
+        return voxel_geom.MirroredActions(self.GrowFaces, self.Mirrors[mirror][1])
+
     # This function gets actions according to the code I downloaded
     # Allows inputing only EPSILON in case you need a fully random action
     def GetActionMulti2(self, epsi, q_tab=None, state_jaction_visited=None, current_jstate=None):
@@ -2107,8 +2634,8 @@ class HHagent:
             if len(flatenzero) < 1:
                 flatenzero.append(new_expectedq.index(max(new_expectedq)))
 
-            # Get action
-            action = random.choice(flatenzero)
+            # Get action (numbered as in the q-table, which is keyed by the mirror of the state)
+            action = self.OwnAction(random.choice(flatenzero))
             flag = "From Table"
 
         else:
@@ -2187,8 +2714,217 @@ class HHagent:
 
     ##### Function to extend #####
 
-    # Extrude face of BREP with vector resulting from previous step
+    # Same as Extend() but growing the boolean array of modules (no Rhino calls)
+    # Only the change caused by the new module is applied to the attributes
+    def ExtendVoxel(self, action):
+        if action <= -1:
+            self.Occupancy[...] = self.CoreOccupancy
+            self.Exposed = self.CoreExposed
+            self.GrowFaces = list(self.CoreGrowFaces)
+            self.C_state = self.InitState
+            self.C_bits = self.InitBits
+            self.NOccupiedPts = len(self.InitInsidePtIdx)
+            self.BrepStale = True  # back to the core, built from the occupancy when read
+            self.BrepToMove = None
+        elif action > 0:
+            outaction = self.BoundAction(action, len(self.GrowFaces))  # index of available faces
+            if outaction > 0:
+                # Occupy the module behind the selected face
+                idx = voxel_geom.GrownIndex(self.Occupancy.shape, self.GrowFaces[outaction - 1])
+                delta, removed, added = voxel_geom.AddModuleDelta(self.Occupancy, idx)
+                self.Occupancy.flat[idx] = True
+
+                # Update the growable faces, keeping their order
+                for face in removed:
+                    del self.GrowFaces[bisect.bisect_left(self.GrowFaces, face)]
+                for face in added:
+                    bisect.insort(self.GrowFaces, face)
+
+                self.Exposed = tuple(old + new for old, new in zip(self.Exposed, delta))
+                self.C_state = self.C_state[:idx] + "T" + self.C_state[idx + 1:]
+                self.C_bits |= 1 << idx
+                self.NOccupiedPts += 1
+
+                # Export closed brep for analysis
+                self.BrepStale = True  # built from the occupancy when OutBrep is read
+
+        # Inform about the current state
+        self.Poss_act = len(self.GrowFaces)
+        self.SetAreaCosts(self.Exposed)
+
+    # Area and extension costs from the number of exposed (walls, roofs, floor) module faces
+    # The geometry is a lattice of modules, so every area is a multiple of Module ** 2
+    def SetAreaCosts(self, exposed):
+        walls, roofs, floor = exposed
+        face_area = self.Module ** 2
+        self.C_Area = int(round((walls + roofs + floor) * face_area))
+
+        extWallArea = int(round((walls - self.CoreExposed[0]) * face_area))
+        extRoofArea = int(round((roofs - self.CoreExposed[1]) * face_area))
+        self.WallAreaExtCost = extWallArea * float(self.WCost)
+        self.RoofAreaExtCost = extRoofArea * float(self.RCost)
+
+    # Same as above from the state string (Rhino backend)
+    def SetAreaCostsFromState(self, state):
+        self.SetAreaCosts(voxel_geom.ExposedFaces(voxel_geom.OccupancyFromState(state, self.LotShape)))
+
+    # Extend with an action, reusing the result if this template already did it from this state
     def Extend(self, action):
+        old_state = self.C_state
+        if action <= -1:
+            self.ExtendGeometry(action)  # back to the core, nothing to reuse
+        else:
+            outaction = self.BoundAction(action, self.Poss_act)
+            key = (self.TemplateKey, self.C_state, outaction)
+            transition = self.Transitions.Get(key)
+            if transition is None:
+                self.ExtendGeometry(outaction)
+                self.Transitions.Put(key, self.GetTransition())
+            else:
+                self.SetTransition(transition)
+
+        if self.C_state != old_state:
+            self.StateChanged()
+
+    # Keep the state of this agent in row idx of the arrays of a Neighbourhood
+    # The voxel occupancy becomes a view of the occupancy of the neighbourhood
+    def JoinNeighbourhood(self, neigh, idx):
+        self.Neighbourhood = neigh
+        self.NeighID = neigh.AgInNeigh[idx]
+        self.NeighRow = idx
+        if self.Backend == "Voxel":
+            neigh.OccupancyN[idx] = self.Occupancy
+            self.Occupancy = neigh.OccupancyN[idx]
+        self.StateChanged()
+
+    # Tell the neighbourhood (if any) that the joint states including this agent changed and
+    # write the new values in its arrays
+    def StateChanged(self):
+        neigh = self.Neighbourhood
+        if neigh is None:
+            return
+        row = self.NeighRow
+        neigh.DirtyAgents.add(self.NeighID)
+        if self.Backend != "Voxel":
+            neigh.OccupancyN[row] = voxel_geom.OccupancyFromState(self.C_state, self.LotShape)
+        neigh.OccupiedN[row] = self.NOccupiedPts
+        neigh.PossActN[row] = self.Poss_act
+        neigh.WallCostN[row] = self.WallAreaExtCost
+        neigh.RoofCostN[row] = self.RoofAreaExtCost
+
+    # The current state is not a valid building, known without building or simulating a model of
+    # it. With the Voxel backend any problem of voxel_geom.OccupancyProblems (checked once per
+    # state and lot shape), with Rhino only the null state, as its breps are simulated as they are
+    @property
+    def NonManifold(self):
+        if self.Backend != "Voxel":
+            return self.C_state == self.GetNullState()
+        return len(voxel_geom.StateProblems(self.C_state, self.LotShape)) > 0
+
+    # Compute the result of the action with the geometry backend
+    def ExtendGeometry(self, action):
+        if self.Backend == "Voxel":
+            self.ExtendVoxel(action)
+        else:
+            self.ExtendRhino(action)
+
+    # Attributes set by Extend (geometry, state, possible actions and costs), to go back to them
+    # with Restore instead of replaying the actions from the core
+    def Snapshot(self):
+        snapshot = {"C_state": self.C_state, "C_bits": self.C_bits, "C_Area": self.C_Area,
+                    "Poss_act": self.Poss_act, "NOccupiedPts": self.NOccupiedPts,
+                    "WallAreaExtCost": self.WallAreaExtCost, "RoofAreaExtCost": self.RoofAreaExtCost,
+                    "OutBrep": self.BrepBuilt, "BrepStale": self.BrepStale, "BrepToMove": self.BrepToMove}
+        if self.Backend == "Voxel":
+            snapshot["Occupancy"] = self.Occupancy.copy()
+            snapshot["Exposed"] = self.Exposed
+            snapshot["GrowFaces"] = tuple(self.GrowFaces)
+        return snapshot
+
+    # Set the attributes stored by Snapshot (breps are never modified, so they are not copied)
+    # A brep that was not built yet is still built only when read
+    def Restore(self, snapshot):
+        changed = snapshot["C_state"] != self.C_state
+        self.SetSnapshot(snapshot)
+        if changed:
+            self.StateChanged()
+
+    # Same as Restore without telling the neighbourhood (Extend does it once at the end)
+    def SetSnapshot(self, snapshot):
+        self.C_state = snapshot["C_state"]
+        self.C_bits = snapshot["C_bits"]
+        self.C_Area = snapshot["C_Area"]
+        self.Poss_act = snapshot["Poss_act"]
+        self.NOccupiedPts = snapshot["NOccupiedPts"]
+        self.WallAreaExtCost = snapshot["WallAreaExtCost"]
+        self.RoofAreaExtCost = snapshot["RoofAreaExtCost"]
+        self.BrepBuilt = snapshot["OutBrep"]
+        self.BrepStale = snapshot["BrepStale"]
+        self.BrepToMove = snapshot["BrepToMove"]
+        if self.Backend == "Voxel":
+            self.Occupancy[...] = snapshot["Occupancy"]
+            self.Exposed = snapshot["Exposed"]
+            self.GrowFaces = list(snapshot["GrowFaces"])
+
+    # Saved without points, voxel agents also without breps, which are built again when read
+    def __getstate__(self):
+        state = {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+        state["CentreModulePtsBuilt"] = None
+        if self.Backend == "Voxel":
+            state["BrepCoreBuilt"] = None
+            state["BrepBuilt"] = None
+            state["BrepToMove"] = None
+            state["BrepStale"] = True
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    # Same as Snapshot with the brep moved to the origin of the lot (the voxel brep is not kept,
+    # it is built again from the occupancy)
+    def GetTransition(self):
+        transition = self.Snapshot()
+        transition["OutBrep"] = None
+        transition["BrepStale"] = True
+        if self.Backend == "Voxel":
+            transition["BrepToMove"] = None
+        else:
+            transition["BrepToMove"] = self.MoveBrep(self.OutBrep, -self.LotOrigX, -self.LotOrigY)
+        return transition
+
+    # Set the attributes stored by GetTransition on this lot, the brep is moved when read
+    def SetTransition(self, transition):
+        self.SetSnapshot(transition)
+
+    # Brep of the current state, only built (or moved from the transition cache) when read, as most
+    # steps only need the state string
+    @property
+    def OutBrep(self):
+        if self.BrepStale:
+            if self.BrepToMove is None:
+                self.BrepBuilt = self.VoxelBrep(self.Occupancy)
+            else:
+                self.BrepBuilt = self.MoveBrep(self.BrepToMove, self.LotOrigX, self.LotOrigY)
+            self.BrepStale = False
+        return self.BrepBuilt
+
+    @OutBrep.setter
+    def OutBrep(self, brep):
+        self.BrepBuilt = brep
+        self.BrepStale = False
+        self.BrepToMove = None
+
+    # Copy of a brep translated on the plane (None stays None)
+    def MoveBrep(self, brep, dx, dy):
+        if brep is None:
+            return None
+        moved = brep.DuplicateBrep()
+        moved.Transform(Rhino.Geometry.Transform.Translation(dx, dy, 0))
+        return moved
+
+    # Extrude face of BREP with vector resulting from previous step
+    def ExtendRhino(self, action):
         # If sticky of the brep does not exist yet, upload brep.Core
         # if not sc.sticky.has_key("brep_mem") or sc.sticky["brep_mem"] == None:
         # sc.sticky["brep_mem"] = self.BrepCore
@@ -2198,81 +2934,44 @@ class HHagent:
             # sc.sticky["brep_mem"] = self.BrepCore # save core to memory
             self.OutBrep = self.BrepCore  # This will not work when input external BREP
 
-            # Inform about the current state
-            p_cloud = self.TestPtsSt()
-            list_of_bool = []
-            for point in p_cloud:
-                bol = self.OutBrep.IsPointInside(point, Rhino.RhinoMath.SqrtEpsilon, False)
-                list_of_bool.append(bol)
-
-            my_bolstr_list = []
-            for bol in list_of_bool:
-                if bol:
-                    st = "T"
-                    my_bolstr_list.append(st)
-                else:
-                    st = "F"
-                    my_bolstr_list.append(st)
-
-            self.C_state = ''.join(my_bolstr_list)
-            self.C_Area = int(round(self.BrepCore.GetArea()))
+            # Inform about the current state (one sweep of the test points)
+            self.C_state = self.StateFromBrep(self.OutBrep)
+            self.C_bits = voxel_geom.StateBits(self.C_state)
             self.Poss_act = self.AvailActs(self.OutBrep)
 
-            # Calculate extension costs (as there is no extension, no cost)
-            self.WallAreaExtCost = 0
-            self.RoofAreaExtCost = 0
+            # Area of the core (as there is no extension, no cost)
+            self.SetAreaCosts(self.CoreExposed)
 
-            # How many points is occupying the resulting BREP?
-            self.NOccupiedPts = len(self.InsidePts(self.OutBrep)[0])
+            # How many points is occupying the resulting BREP? (same sweep as the state)
+            self.NOccupiedPts = self.C_state.count("T")
 
         elif action == 0:  # On 0, we keep the state
-            # Inform about the current state
-            p_cloud = self.TestPtsSt()
-            list_of_bool = []
-            for point in p_cloud:
-                bol = self.OutBrep.IsPointInside(point, Rhino.RhinoMath.SqrtEpsilon, False)
-                list_of_bool.append(bol)
-
-            my_bolstr_list = []
-            for bol in list_of_bool:
-                if bol:
-                    st = "T"
-                    my_bolstr_list.append(st)
-                else:
-                    st = "F"
-                    my_bolstr_list.append(st)
-
-            self.C_state = ''.join(my_bolstr_list)
-            self.C_Area = int(round(self.OutBrep.GetArea()))
+            # Inform about the current state (one sweep of the test points)
+            self.C_state = self.StateFromBrep(self.OutBrep)
+            self.C_bits = voxel_geom.StateBits(self.C_state)
             self.Poss_act = self.AvailActs(self.OutBrep)
 
-            # Calculate extension costs
-            extWallArea = self.WallsAreasExtension(self.BrepCore, self.OutBrep)
-            extRoofArea = self.RoofsAreasExtension(self.BrepCore, self.OutBrep)
-            self.WallAreaExtCost = extWallArea * float(self.WCost)
-            self.RoofAreaExtCost = extRoofArea * float(self.RCost)
+            # Calculate area and extension costs
+            self.SetAreaCostsFromState(self.C_state)
 
-            # How many points is occupying the resulting BREP?
-            self.NOccupiedPts = len(self.InsidePts(self.OutBrep)[0])
+            # How many points is occupying the resulting BREP? (same sweep as the state)
+            self.NOccupiedPts = self.C_state.count("T")
 
         else:
             # recover brep from memory
             # inbrep = sc.sticky["brep_mem"]
             inbrep = self.OutBrep
 
-            outaction = self.BoundInputAction(action, inbrep)  # index of available faces
-
-            # transform recovered brep
-            availablefaces = self.FilterWalls(inbrep) + self.FilterRoofs(inbrep)
+            # Classify the faces of the brep only once for this step
+            vertices = self.ClassifyVertix(inbrep)
+            outaction = self.BoundAction(action, self.Poss_act)  # index of available faces
 
             # Get face to move
-            insd_pts = self.InsidePts(inbrep)[1]
-
-            ordered_idx = self.OrderActions(inbrep, 0.05)
+            ordered_idx = self.OrderActions(inbrep, 0.05, vertices, self.C_state)
             idxFace2move = ordered_idx[outaction - 1][1]  # Index of face to move
             facetomove = inbrep.Faces[idxFace2move]
 
-            curve = self.VectorExt(action, inbrep)
+            curve = self.VectorExt(action, inbrep, vertices, ordered_idx)
             newbrep = facetomove.CreateExtrusion(curve, True)
 
             # Remove extruded face
@@ -2316,31 +3015,13 @@ class HHagent:
             # Export closed brep for analysis
             self.OutBrep = myOutmesh
 
-            # Inform about the current state
-            p_cloud = self.TestPtsSt()
-            list_of_bool = []
-            for point in p_cloud:
-                bol = self.OutBrep.IsPointInside(point, Rhino.RhinoMath.SqrtEpsilon, False)
-                list_of_bool.append(bol)
-
-            my_bolstr_list = []
-            for bol in list_of_bool:
-                if bol:
-                    st = "T"
-                    my_bolstr_list.append(st)
-                else:
-                    st = "F"
-                    my_bolstr_list.append(st)
-
-            self.C_state = ''.join(my_bolstr_list)
-            self.C_Area = int(round(myOutmesh.GetArea()))
+            # Inform about the current state (one sweep of the test points)
+            self.C_state = self.StateFromBrep(self.OutBrep)
+            self.C_bits = voxel_geom.StateBits(self.C_state)
             self.Poss_act = self.AvailActs(self.OutBrep)
 
-            # Calculate extension costs
-            extWallArea = self.WallsAreasExtension(self.BrepCore, self.OutBrep)
-            extRoofArea = self.RoofsAreasExtension(self.BrepCore, self.OutBrep)
-            self.WallAreaExtCost = extWallArea * float(self.WCost)
-            self.RoofAreaExtCost = extRoofArea * float(self.RCost)
+            # Calculate area and extension costs
+            self.SetAreaCostsFromState(self.C_state)
 
-            # How many points is occupying the resulting BREP?
-            self.NOccupiedPts = len(self.InsidePts(self.OutBrep)[0])
+            # How many points is occupying the resulting BREP? (same sweep as the state)
+            self.NOccupiedPts = self.C_state.count("T")
@@ -2,15 +2,12 @@
 GRASSHOPPER DEPENDENCIES, SO THEY ARE ABLE TO WORK ON CPYTHON WITH rhino.inside()"""
 
 # Import dependencies
-import Rhino
 import os
 import re
 import json
 
 from ladybug.epw import EPW
 from ladybug.futil import preparedir, nukedir
-from ladybug_rhino.config import tolerance, angle_tolerance, conversion_to_meters, \
-    units_system
 #from ladybug_rhino.grasshopper import all_required_inputs
 
 import honeybee.config as hb_config
@@ -29,7 +26,21 @@ from ladybug_geometry.geometry3d.polyface import Polyface3D
 from ladybug_geometry.geometry3d.face import Face3D
 from ladybug_geometry.geometry3d.pointvector import Vector3D, Point3D
 from ladybug_geometry.geometry3d.plane import Plane
-import ladybug_rhino.planarize as _planar
+
+# Rhino is only needed to convert Breps, voxel geometries are converted directly
+try:
+    import Rhino
+    from ladybug_rhino.config import tolerance, angle_tolerance, conversion_to_meters, \
+        units_system
+    import ladybug_rhino.planarize as _planar
+except ImportError:
+    Rhino = None
+    tolerance = 0.01  # default ladybug_rhino values for a model in meters
+    angle_tolerance = 1.0
+    conversion_to_meters = 1.0
+    units_system = 'Meters'
+
+from herp import voxel_geom
 
 from honeybee_energy.constructionset import ConstructionSet
 from honeybee_energy.construction.opaque import OpaqueConstruction
@@ -76,6 +87,19 @@ def to_polyface3d(geo, meshing_parameters=None):
     mesh_par = meshing_parameters or Rhino.Geometry.MeshingParameters.Default  # default
     return Polyface3D.from_faces(to_face3d(geo, mesh_par), tolerance)
 
+def voxel_to_polyface3d(occupancy, origin, module):
+    """Closed Polyface3D of the boolean array of modules of a lot, merging coplanar faces.
+
+    The faces keep the collinear lattice points on their edges on purpose: they are the
+    vertices of the neighbouring faces, without them the edges would not match and the
+    Polyface3D would not be solid."""
+    faces = []
+    for _, loop in voxel_geom.MergedFaces(occupancy):
+        verts = tuple(Point3D(origin[0] + i * module, origin[1] + j * module, k * module)
+                      for i, j, k in loop)
+        faces.append(Face3D(verts))
+    return Polyface3D.from_faces(faces, tolerance)
+
 def to_vector3d(vector):
     return Vector3D(vector.X, vector.Y, vector.Z)
 
@@ -490,14 +514,20 @@ def RoomSolid(_geo, _name_, _mod_set_, _constr_set_, _program_, conditioned_, _r
             if len(_name_) != len(_geo) else longest_list(_name_, i)
         name = clean_and_id_string(display_name)
 
-        # create the Room
+        # create the Room (voxel geometries already come as a Polyface3D, their faces
+        # have collinear points where they meet smaller faces, see voxel_to_polyface3d)
+        polyface = geo if isinstance(geo, Polyface3D) else to_polyface3d(geo)
         room = Room.from_polyface3d(
-            name, to_polyface3d(geo), roof_angle=roof_angle,
+            name, polyface, roof_angle=roof_angle,
             floor_angle=floor_angle, ground_depth=tolerance)
         room.display_name = display_name
 
         # check that the Room geometry is closed.
-        if room.check_solid(tolerance, angle_tolerance, False) != '':
+        if isinstance(geo, Polyface3D):
+            not_closed = not polyface.is_solid  # only with modules touching by an edge
+        else:
+            not_closed = room.check_solid(tolerance, angle_tolerance, False) != ''
+        if not_closed:
             msg = 'Input _geo is not a closed volume.\n' \
                   'Room volume must be closed to access most honeybee features.\n' \
                   'Preview the output Room to see the holes in your model.'
@@ -760,7 +790,7 @@ def ApertByRatio(_hb_objs, _ratio, _subdivide_, _win_height_, _sill_height_, _ho
 
 
 ''' SHADE COMPONENT'''
-meshing_parameters = Rhino.Geometry.MeshingParameters.FastRenderMesh
+meshing_parameters = Rhino.Geometry.MeshingParameters.FastRenderMesh if Rhino is not None else None
 
 
 def Shd(_geo, _name_, attached_, ep_constr_, ep_trans_sch_, rad_mod_):
@@ -774,7 +804,10 @@ def Shd(_geo, _name_, attached_, ep_constr_, ep_trans_sch_, rad_mod_):
             name = clean_and_id_string(display_name)
         is_detached = not longest_list(attached_, j) if len(attached_) != 0 else True
 
-        lb_faces = to_face3d(geo, meshing_parameters)
+        if isinstance(geo, Polyface3D):
+            lb_faces = geo.faces
+        else:
+            lb_faces = to_face3d(geo, meshing_parameters)
         for i, lb_face in enumerate(lb_faces):
             shd_name = '{}_{}'.format(name, i) if len(lb_faces) > 1 else name
             hb_shd = Shade(shd_name, lb_face, is_detached)
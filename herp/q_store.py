@@ -0,0 +1,408 @@
+'''This module keeps the q-tables of the agents in NumPy arrays instead of nested dicts.
+The joint state of an agent is interned into an integer id (a dict lookup, as joint states are
+strings or tuples) together with its owner, the agent itself or a key shared by several agents
+that learn on the same states (see Neighbourhood.KeyOwner). A joint action (the actions of the neighbours sorted by id, as in
+Neighbourhood.SortedNeigh) is a mixed-radix integer, the radix of each neighbour being its
+number of actions (Poss_act + 2) when the state was added, and each state owns a range of keys
+as long as its number of joint actions. A joint action only gets a row of q-values (float32)
+and visits (int32) when it is first written or visited, reading any other one gives 0 as if it
+had a row of zeros. The rows of all the states are in one array and found by searching the
+sorted keys, so the rows of many (state, joint action) are looked up, written and visited with
+one NumPy operation. Each state also keeps the sum of its q-values weighted by the visits (per
+action) and its total visits, changed with every value and visit, so its expected q-values
+are read without going through its rows. The eligibility traces of an episode are kept the
+same way, as arrays of (agent, state id, joint action id, action, trace). LearnMany updates all
+the agents of a step with these operations. Nothing here depends on Rhino.'''
+
+import numpy as np
+
+# Rows of a new QStore, they double when they are used up
+FIRST_ROWS = 64
+
+# States with room for their sums and visits, the room doubles when it is used up
+FIRST_STATES = 64
+
+# Traces of a new TraceStore, the arrays double when they are used up
+FIRST_TRACES = 16
+
+# The own actions of a state are fewer than this and the rows of a QStore fewer than ROW_SPAN (the
+# keys of the traces are (agent * ROW_SPAN + row) * ACTION_SPAN + action, in 63 bits)
+ACTION_SPAN = 1 << 16
+ROW_SPAN = 1 << 30
+MAX_AGENTS = 1 << 17
+
+# Expected q-values this close to 0 (and not 0) are computed again from the rows of their state,
+# as the sums changed with every value and visit can keep a round-off residue where they cancel
+NEAR_ZERO = 1e-6
+
+
+# Array with the first n items of array and room for at least size (doubled when needed)
+def Grown(array, n, size):
+    if size <= len(array):
+        return array
+    new_array = np.zeros((max(size, 2 * len(array)),) + array.shape[1:], dtype=array.dtype)
+    new_array[:n] = array[:n]
+    return new_array
+
+
+# Array with more columns (of zeros) up to width
+def Widened(array, width):
+    if width <= array.shape[1]:
+        return array
+    return np.concatenate([array, np.zeros((len(array), width - array.shape[1]), dtype=array.dtype)], axis=1)
+
+
+# Keys and positions (sorted by key) with the new keys (unique and not in keys) added
+def Merged(keys, positions, new_keys, new_positions):
+    order = np.argsort(new_keys)
+    at = np.searchsorted(keys, new_keys[order])
+    return np.insert(keys, at, new_keys[order]), np.insert(positions, at, new_positions[order])
+
+
+class QStore:
+    def __init__(self):
+        self.StateIds = {}  # (owner, joint state) -> state id
+        self.AgentNrs = {}  # agent id -> number of the agent in the traces
+        self.NStates = 0
+        self.NActions = np.zeros(FIRST_STATES, dtype=np.int64)  # actions of every state (the rest of its columns is 0)
+        self.Offsets = np.zeros(FIRST_STATES, dtype=np.int64)  # first key of the joint actions of every state
+        self.Places = np.zeros((FIRST_STATES, 0), dtype=np.int64)  # place value of the action of each neighbour
+        self.Sums = np.zeros((FIRST_STATES, 0))  # sum of q-values * visits over the rows of every state, per action
+        self.Totals = np.zeros(FIRST_STATES, dtype=np.int64)  # visits of every state
+        self.NextOffset = 0
+
+        self.NRows = 0
+        self.Values = np.zeros((FIRST_ROWS, 0), dtype=np.float32)  # q-values of every row (rows, actions)
+        self.Visits = np.zeros(FIRST_ROWS, dtype=np.int32)  # visits of the joint action of every row
+        self.Keys = np.zeros(0, dtype=np.int64)  # keys of the rows, sorted
+        self.KeyRows = np.zeros(0, dtype=np.int64)  # row of each key
+
+    def __len__(self):
+        return self.NStates
+
+    # Id of the joint state of an owner (None when it was never added)
+    def StateId(self, owner, jstate):
+        return self.StateIds.get((owner, jstate))
+
+    # Add the joint state of an owner (an agent id, or a key shared by several agents) with
+    # n_actions own actions and the radix of each neighbour, without rows yet. Returns its id
+    # (the old one if it was added)
+    def AddState(self, owner, jstate, n_actions, radices):
+        key = (owner, jstate)
+        sid = self.StateIds.get(key)
+        if sid is None:
+            sid = self.NStates
+            self.StateIds[key] = sid
+            self.NStates += 1
+            for name in ("NActions", "Offsets", "Places", "Sums", "Totals"):
+                setattr(self, name, Grown(getattr(self, name), sid, sid + 1))
+            self.Places = Widened(self.Places, len(radices))
+            self.Sums = Widened(self.Sums, n_actions)
+            self.Values = Widened(self.Values, n_actions)
+
+            place = 1
+            for nr in range(len(radices) - 1, -1, -1):
+                self.Places[sid, nr] = place
+                place *= radices[nr]
+            self.NActions[sid] = n_actions
+            self.Offsets[sid] = self.NextOffset
+            self.NextOffset += place  # number of joint actions of the state
+            if self.NextOffset >= 2 ** 62:
+                raise OverflowError("Too many joint actions for 64-bit keys")
+        return sid
+
+    # Numbers of some agents in the traces (given to them the first time)
+    def AgentNrsMany(self, agents_ids):
+        nrs = np.fromiter((self.AgentNrs.setdefault(ag_id, len(self.AgentNrs)) for ag_id in agents_ids),
+                          dtype=np.int64, count=len(agents_ids))
+        if len(self.AgentNrs) > MAX_AGENTS:
+            raise OverflowError("Too many agents for 64-bit trace keys")
+        return nrs
+
+    # Id of a joint action (tuple with an action per neighbour) of a state
+    def JointActionId(self, sid, jactions):
+        places = self.Places[sid]
+        return int(sum(action * place for action, place in zip(jactions, places.tolist())))
+
+    # Same as JointActionId for several states, the actions of the neighbours being the rows
+    # of an array (0 after the last neighbour of each state)
+    def JointActionIds(self, sids, jactions):
+        jactions = np.asarray(jactions, dtype=np.int64).reshape(len(sids), -1)
+        places = self.Places[np.asarray(sids, dtype=np.int64)]
+        width = min(jactions.shape[1], places.shape[1])
+        return (places[:, :width] * jactions[:, :width]).sum(axis=1)
+
+    # Rows of several joint actions of states, added (with zeros) to those without one, or
+    # -1 for them when add is False
+    def RowsMany(self, sids, jactions, add=True):
+        keys = self.Offsets[np.asarray(sids, dtype=np.int64)] + np.asarray(jactions, dtype=np.int64)
+        at = np.searchsorted(self.Keys, keys)
+        found = at < len(self.Keys)
+        found[found] = self.Keys[at[found]] == keys[found]
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        rows[found] = self.KeyRows[at[found]]
+        if add and not found.all():
+            new_keys, inverse = np.unique(keys[~found], return_inverse=True)
+            new_rows = self.NRows + np.arange(len(new_keys))
+            if self.NRows + len(new_keys) > ROW_SPAN:
+                raise OverflowError("Too many rows for 64-bit trace keys")
+            self.Values = Grown(self.Values, self.NRows, self.NRows + len(new_keys))
+            self.Visits = Grown(self.Visits, self.NRows, self.NRows + len(new_keys))
+            self.NRows += len(new_keys)
+            self.Keys, self.KeyRows = Merged(self.Keys, self.KeyRows, new_keys, new_rows)
+            rows[~found] = new_rows[inverse]
+        return rows
+
+    # Row of a joint action of a state, added (with zeros) when it has none
+    def Row(self, sid, jaction):
+        return int(self.RowsMany([sid], [jaction])[0])
+
+    def Get(self, sid, jaction, action):
+        return float(self.GetMany([sid], [jaction], [action])[0])
+
+    def Set(self, sid, jaction, action, value):
+        self.SetMany([sid], [jaction], [action], [value])
+
+    # Count one more visit of a joint action of a state
+    def Visit(self, sid, jaction):
+        self.VisitMany([sid], [jaction])
+
+    # Q-values of several (state, joint action, action)
+    def GetMany(self, sids, jactions, actions):
+        rows = self.RowsMany(sids, jactions, add=False)
+        values = np.zeros(len(rows))
+        found = rows >= 0
+        values[found] = self.Values[rows[found], np.asarray(actions, dtype=np.int64)[found]]
+        return values
+
+    # Write (or add to, with add) the q-values of several (state, joint action, action), each
+    # one at most once, keeping the sums of their states
+    def SetMany(self, sids, jactions, actions, values, add=False):
+        sids = np.asarray(sids, dtype=np.int64)
+        actions = np.asarray(actions, dtype=np.int64)
+        rows = self.RowsMany(sids, jactions)
+        old_values = self.Values[rows, actions].astype(np.float64)
+        new_values = np.asarray(values, dtype=np.float64)
+        self.Values[rows, actions] = old_values + new_values if add else new_values
+        changes = (self.Values[rows, actions].astype(np.float64) - old_values) * self.Visits[rows]
+        np.add.at(self.Sums, (sids, actions), changes)
+
+    # Add amounts to the q-values of several (state, joint action, action), each one at most once
+    def AddMany(self, sids, jactions, actions, amounts):
+        self.SetMany(sids, jactions, actions, amounts, add=True)
+
+    # Count one more visit of several joint actions of states
+    def VisitMany(self, sids, jactions):
+        sids = np.asarray(sids, dtype=np.int64)
+        rows = self.RowsMany(sids, jactions)
+        np.add.at(self.Visits, rows, 1)
+        np.add.at(self.Sums, sids, self.Values[rows].astype(np.float64))
+        np.add.at(self.Totals, sids, 1)
+
+    # Sums of a state computed again from its rows, replacing those changed with every value and visit
+    def ExactSums(self, sid):
+        end = self.Offsets[sid + 1] if sid + 1 < self.NStates else self.NextOffset
+        rows = self.KeyRows[np.searchsorted(self.Keys, self.Offsets[sid]):np.searchsorted(self.Keys, end)]
+        values = self.Values[rows, :self.Sums.shape[1]].astype(np.float64)
+        self.Sums[sid] = (values * self.Visits[rows][:, None]).sum(axis=0)
+        return self.Sums[sid]
+
+    # Q-value of each own action averaged over the joint actions, weighted by their visits
+    # (the sums are returned as they are while the state was never visited)
+    def ExpectedQ(self, sid):
+        return self.ExpectedQMany([sid])[0, :self.NActions[sid]]
+
+    # Same as ExpectedQ for several states, as rows of one array with -inf after the actions
+    # of each state. States with a value near 0 get exact sums first (see NEAR_ZERO)
+    def ExpectedQMany(self, sids):
+        sids = np.asarray(sids, dtype=np.int64)
+        totals = np.maximum(self.Totals[sids], 1)[:, None]
+        expected = self.Sums[sids] / totals
+        near = np.flatnonzero(((expected != 0) & (np.abs(expected) <= NEAR_ZERO)).any(axis=1))
+        if len(near) > 0:
+            for sid in np.unique(sids[near]).tolist():
+                self.ExactSums(sid)
+            expected[near] = self.Sums[sids[near]] / totals[near]
+        expected[np.arange(self.Sums.shape[1]) >= self.NActions[sids][:, None]] = -np.inf
+        return expected
+
+    # Own action with the highest expected q-value (the first one on ties)
+    def Argmax(self, sid):
+        return int(np.argmax(self.ExpectedQ(sid)))
+
+    # Same as Argmax for several states
+    def ArgmaxMany(self, sids):
+        if len(sids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.argmax(self.ExpectedQMany(sids), axis=1)
+
+    # Highest expected q-value that is not 0 (0 when all of them are 0)
+    def MaxFutureQ(self, sid):
+        expected = self.ExpectedQ(sid)
+        nonzero = expected[expected != 0]
+        if len(nonzero) == 0:
+            return 0
+        return float(nonzero.max())
+
+    # Same as MaxFutureQ for several states
+    def MaxFutureQMany(self, sids):
+        if len(sids) == 0:
+            return np.zeros(0)
+        expected = self.ExpectedQMany(sids)
+        expected[expected == 0] = -np.inf
+        best = expected.max(axis=1)
+        best[np.isinf(best)] = 0
+        return best
+
+    # One step of the q-learning of several agents (one entry per agent), doing for all of them
+    # at once what the update of a single agent does in this order: read the q-value of its
+    # action, kill action 0, write the new q-value, add 1 to its trace or back up its traces,
+    # and count the visit. A reward of -goal_reward loses (the new q-value is the reward), one of
+    # goal_reward or more wins (the new q-value is the reward and the traces of the agent are
+    # backed up with its rate times reward - old q-value) and any other goes on from the highest
+    # expected q-value of the next state. The result is the same as updating the agents one by
+    # one in the order given, also when they share states (see Rounds). traces is the
+    # TraceStore of the episode. Returns the old, future (nan when lost) and new q-values
+    def LearnMany(self, agents_ids, sids, jactions, actions, rewards, next_sids, rates, traces, goal_reward,
+                  discount):
+        agents = self.AgentNrsMany(agents_ids)
+        sids = np.asarray(sids, dtype=np.int64)
+        jactions = np.asarray(jactions, dtype=np.int64)
+        actions = np.asarray(actions, dtype=np.int64)
+        rewards = np.asarray(rewards, dtype=np.float64)
+        next_sids = np.asarray(next_sids, dtype=np.int64)
+        rates = np.asarray(rates, dtype=np.float64)
+
+        current_q = np.zeros(len(sids))
+        future_q = np.full(len(sids), np.nan)
+        new_q = np.zeros(len(sids))
+        for entries in self.Rounds(agents, sids, next_sids, rewards >= goal_reward, traces):
+            current_q[entries], future_q[entries], new_q[entries] = self.LearnRound(
+                agents[entries], sids[entries], jactions[entries], actions[entries], rewards[entries],
+                next_sids[entries], rates[entries], traces, goal_reward, discount)
+        return current_q, future_q, new_q
+
+    # Entries of LearnMany (slices, in order) that can be learnt together: an entry goes to a new
+    # round when its state or next state was written by an earlier entry of the round, or is
+    # in the traces of an earlier entry of the round that won. Agents with states of their own
+    # only start new rounds when a winner shares traces with them, so a step is usually one round
+    def Rounds(self, agents, sids, next_sids, won, traces):
+        rounds = []
+        start = 0
+        written = set()
+        for nr, (sid, next_sid) in enumerate(zip(sids.tolist(), next_sids.tolist())):
+            if sid in written or next_sid in written:
+                rounds.append(slice(start, nr))
+                start = nr
+                written = set()
+            written.add(sid)
+            if won[nr]:
+                written.update(traces.StatesOf(agents[nr]).tolist())
+        rounds.append(slice(start, len(sids)))
+        return rounds
+
+    # Same as LearnMany for entries that do not read or write the states of each other
+    def LearnRound(self, agents, sids, jactions, actions, rewards, next_sids, rates, traces, goal_reward, discount):
+        current_q = self.GetMany(sids, jactions, actions)
+
+        # Kill action 0
+        self.SetMany(sids, jactions, np.zeros_like(actions), np.full(len(sids), -goal_reward * 4.0))
+
+        lost = rewards == -goal_reward
+        won = rewards >= goal_reward
+        going = (rewards > -goal_reward) & ~won
+        future_q = np.full(len(sids), np.nan)
+        future_q[going] = self.MaxFutureQMany(next_sids[going])
+        future_q[won] = 0
+
+        new_q = current_q.copy()
+        new_q[lost | won] = rewards[lost | won]
+        new_q[going] = (1 - rates[going]) * current_q[going] + rates[going] * (
+                rewards[going] + discount * future_q[going])
+        moved = lost | won | going
+        self.SetMany(sids[moved], jactions[moved], actions[moved], new_q[moved])
+
+        traces.IncrementMany(self, agents[going], sids[going], jactions[going], actions[going])
+        if won.any():
+            # Scale of the traces of each agent, 0 for those that did not win
+            scales = np.zeros(len(self.AgentNrs))
+            from_current_state = (rewards[won] + discount * future_q[won]) - current_q[won]
+            scales[agents[won]] = rates[won] * from_current_state
+            traces.Backup(self, scales)
+
+        self.VisitMany(sids, jactions)
+        return current_q, future_q, new_q
+
+
+# Eligibility traces of agents on the (state, joint action, action) of a QStore, as parallel
+# arrays in the order the traces were added. The traces of each agent are kept apart (also on
+# the states it shares with others), so one TraceStore keeps those of all the agents
+class TraceStore:
+    def __init__(self):
+        self.N = 0
+        self.Keys = np.zeros(0, dtype=np.int64)  # (agent * ROW_SPAN + row) * ACTION_SPAN + action of every trace, sorted
+        self.Positions = np.zeros(0, dtype=np.int64)  # position of each key
+        self.Agents = np.zeros(FIRST_TRACES, dtype=np.int64)  # number of the agent (QStore.AgentNrs)
+        self.States = np.zeros(FIRST_TRACES, dtype=np.int64)
+        self.JActions = np.zeros(FIRST_TRACES, dtype=np.int64)
+        self.Actions = np.zeros(FIRST_TRACES, dtype=np.int32)
+        self.Traces = np.zeros(FIRST_TRACES, dtype=np.float64)
+
+    def __len__(self):
+        return self.N
+
+    # Add amount to the traces of several agents (by their numbers in qstore.AgentNrs) on
+    # (state, joint action, action) of qstore, each one at most once, starting them at 0
+    def IncrementMany(self, qstore, agents, sids, jactions, actions, amount=1.0):
+        agents = np.asarray(agents, dtype=np.int64)
+        sids = np.asarray(sids, dtype=np.int64)
+        jactions = np.asarray(jactions, dtype=np.int64)
+        actions = np.asarray(actions, dtype=np.int64)
+        keys = (agents * ROW_SPAN + qstore.RowsMany(sids, jactions)) * ACTION_SPAN + actions
+        at = np.searchsorted(self.Keys, keys)
+        found = at < len(self.Keys)
+        found[found] = self.Keys[at[found]] == keys[found]
+        positions = np.zeros(len(keys), dtype=np.int64)
+        positions[found] = self.Positions[at[found]]
+
+        new = np.flatnonzero(~found)
+        if len(new) > 0:
+            positions[new] = self.N + np.arange(len(new))
+            for name in ("Agents", "States", "JActions", "Actions", "Traces"):
+                setattr(self, name, Grown(getattr(self, name), self.N, self.N + len(new)))
+            self.Agents[positions[new]] = agents[new]
+            self.States[positions[new]] = sids[new]
+            self.JActions[positions[new]] = jactions[new]
+            self.Actions[positions[new]] = actions[new]
+            self.N += len(new)
+            self.Keys, self.Positions = Merged(self.Keys, self.Positions, keys[new], positions[new])
+        self.Traces[positions] += amount
+
+    # Add amount to the trace of an agent on a (state, joint action, action), starting it at 0
+    def Increment(self, qstore, agent, sid, jaction, action, amount=1.0):
+        self.IncrementMany(qstore, [agent], [sid], [jaction], [action], amount)
+
+    # States with traces of an agent
+    def StatesOf(self, agent):
+        return self.States[:self.N][self.Agents[:self.N] == agent]
+
+    # Multiply every trace by factor
+    def Decay(self, factor):
+        self.Traces[:self.N] *= factor
+
+    # Add scale * trace to the q-value of every trace in qstore. scale is a number or an array
+    # with the scale of each agent (by its number in qstore.AgentNrs), the traces with a scale of
+    # 0 are left as they are. The traces of several agents on the same entry are added together
+    def Backup(self, qstore, scale):
+        scale = np.asarray(scale, dtype=np.float64)
+        if scale.ndim > 0:
+            scale = scale[self.Agents[:self.N]]
+        amounts = scale * self.Traces[:self.N]
+        moved = np.flatnonzero(np.broadcast_to(scale, amounts.shape) != 0)
+        sids = self.States[:self.N][moved]
+        jactions = self.JActions[:self.N][moved]
+        actions = self.Actions[:self.N][moved].astype(np.int64)
+        entries = qstore.RowsMany(sids, jactions) * ACTION_SPAN + actions
+        entries, first, inverse = np.unique(entries, return_index=True, return_inverse=True)
+        qstore.AddMany(sids[first], jactions[first], actions[first],
+                       np.bincount(inverse.ravel(), weights=amounts[moved], minlength=len(entries)))
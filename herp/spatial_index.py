@@ -0,0 +1,130 @@
+'''This module finds the lots in the range of view of each other with NumPy. A lot
+sees another one when any vertex of the other lot is strictly inside the circle of
+radius NeighRadius around its centre (the rule of Neighbourhood.IDNeighNeighbours).
+The vertices are bucketed in a uniform grid, so only the cells around each centre
+are compared. The same pairs give the groups of lots that interact through them.
+Nothing here depends on Rhino.'''
+
+import numpy as np
+
+# Cells compared on each side of the cell of a centre. The cells are as large as the
+# radius, so one would be enough, the second one covers rounding at the cell borders
+CELL_REACH = 2
+
+
+# Neighbours of every lot as a compressed sparse row (CSR) adjacency: the neighbours of
+# lot i are Indices[Indptr[i]:Indptr[i + 1]], in increasing order. Both arrays are read only
+class NeighbourIndex:
+    def __init__(self, centres, vertices, radius):
+        self.Radius = radius
+        centres = np.asarray(centres, dtype=float).reshape(-1, 2)  # (lots, 2)
+        vertices = np.asarray(vertices, dtype=float).reshape(len(centres), -1, 2)  # (lots, vertices, 2)
+
+        self.Indptr, self.Indices = NeighbourCSR(centres, vertices, radius)
+        self.Indptr.flags.writeable = False
+        self.Indices.flags.writeable = False
+
+    # The arrays are read only again after loading a saved index
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.Indptr.flags.writeable = False
+        self.Indices.flags.writeable = False
+
+    def __len__(self):
+        return len(self.Indptr) - 1
+
+    # Indices of the lots seen from lot i
+    def Neighbours(self, i):
+        return self.Indices[self.Indptr[i]:self.Indptr[i + 1]]
+
+
+# Pairs (lot, neighbour) as CSR arrays (indptr, indices)
+def NeighbourCSR(centres, vertices, radius):
+    nlots, nverts = vertices.shape[0], vertices.shape[1]
+    if nlots == 0 or nverts == 0 or radius <= 0:
+        return np.zeros(nlots + 1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    points = vertices.reshape(-1, 2)
+    owners = np.repeat(np.arange(nlots), nverts)  # lot of each vertex
+
+    # Cells of the vertices and centres, shifted so the cells around them stay positive
+    origin = np.minimum(points.min(axis=0), centres.min(axis=0))
+    point_cells = np.floor((points - origin) / radius).astype(np.int64) + CELL_REACH
+    centre_cells = np.floor((centres - origin) / radius).astype(np.int64) + CELL_REACH
+    rows = max(point_cells[:, 1].max(), centre_cells[:, 1].max()) + CELL_REACH + 1
+
+    # Vertices sorted by cell, each cell is a run of this order
+    point_keys = point_cells[:, 0] * rows + point_cells[:, 1]
+    order = np.argsort(point_keys, kind="stable")
+    sorted_keys = point_keys[order]
+
+    pair_lots = []
+    pair_points = []
+    for dx in range(-CELL_REACH, CELL_REACH + 1):
+        for dy in range(-CELL_REACH, CELL_REACH + 1):
+            keys = (centre_cells[:, 0] + dx) * rows + centre_cells[:, 1] + dy
+            starts = np.searchsorted(sorted_keys, keys, side="left")
+            counts = np.searchsorted(sorted_keys, keys, side="right") - starts
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            # Every (lot, vertex in the cell) pair, without a loop over the lots
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            pair_lots.append(np.repeat(np.arange(nlots), counts))
+            pair_points.append(order[np.repeat(starts, counts) + offsets])
+
+    if not pair_lots:
+        return np.zeros(nlots + 1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    lots = np.concatenate(pair_lots)
+    pts = np.concatenate(pair_points)
+
+    # Strictly inside the circle, as the containment test of the Rhino curve
+    dx = points[pts, 0] - centres[lots, 0]
+    dy = points[pts, 1] - centres[lots, 1]
+    inside = (dx ** 2 + dy ** 2 < radius ** 2) & (owners[pts] != lots)
+
+    # One pair per (lot, neighbour), sorted by lot and then by neighbour
+    pairs = np.unique(lots[inside] * nlots + owners[pts[inside]])
+    indptr = np.zeros(nlots + 1, dtype=np.int64)
+    np.cumsum(np.bincount(pairs // nlots, minlength=nlots), out=indptr[1:])
+    return indptr, pairs % nlots
+
+
+# Group of every lot (-1 when it is not marked) when two marked lots are in the same group
+# if there is a path of at most hops (1 or 2) pairs between them, in either direction. The
+# groups are numbered from 0 in the order of their first lot
+def InteractionLabels(indptr, indices, marked, hops):
+    if hops not in (1, 2):
+        raise ValueError("Only paths of 1 or 2 pairs are supported, not {}".format(hops))
+    nlots = len(indptr) - 1
+    marked = np.asarray(marked, dtype=bool)
+    lots = np.repeat(np.arange(nlots), np.diff(indptr))
+    seen = np.asarray(indices, dtype=np.int64)
+
+    if hops == 1:
+        # Marked lots joined directly
+        keep = marked[lots] & marked[seen]
+        ends_a, ends_b = lots[keep], seen[keep]
+    else:
+        # Marked lots joined to a hub (lot nlots + h) for every lot h they touch or are, so
+        # two marked lots sharing a hub are at most two pairs apart
+        marked_lots = np.flatnonzero(marked)
+        to_seen, to_lot = marked[seen], marked[lots]
+        ends_a = np.concatenate([seen[to_seen], lots[to_lot], marked_lots])
+        ends_b = nlots + np.concatenate([lots[to_seen], seen[to_lot], marked_lots])
+
+    # Every node takes the lowest label around it until nothing changes. The lowest label
+    # of a group is always one of its marked lots, the hubs come after them
+    labels = np.arange(2 * nlots)
+    while True:
+        new_labels = labels.copy()
+        np.minimum.at(new_labels, ends_a, labels[ends_b])
+        np.minimum.at(new_labels, ends_b, labels[ends_a])
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+
+    groups = np.full(nlots, -1, dtype=np.int64)
+    _, groups[marked] = np.unique(labels[:nlots][marked], return_inverse=True)
+    return groups
@@ -0,0 +1,449 @@
+'''This module has the voxel version of the lot geometry of HHagent. The lot is
+a boolean array of (LotSizeX, LotSizeY, MaxHeightFl) modules flattened in the
+same order as HHagent.TestPtsSt(), so the state string of an agent is this array
+written with "T" and "F". Nothing here depends on Rhino.'''
+
+import collections
+import math
+
+import numpy as np
+
+# Directions of the six faces of a module. The order is fixed, so the same
+# occupancy always gives the same numbering of actions
+FACE_DIRS = ((-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 1, 0), (0, 0, -1), (0, 0, 1))
+WALL_DIRS = (0, 1, 2, 3)
+ROOF_DIR = 5
+
+# Codes of the "T" and "F" characters of the state strings
+T_CODE = ord("T")
+F_CODE = ord("F")
+
+
+# Light replacement of Rhino.Geometry.Point3d when Rhino is not loaded
+class Point3(collections.namedtuple("Point3", ["X", "Y", "Z"])):
+    __slots__ = ()
+
+    def DistanceTo(self, other):
+        return math.sqrt((self.X - other.X) ** 2 + (self.Y - other.Y) ** 2 + (self.Z - other.Z) ** 2)
+
+
+#### Occupancy arrays #####
+# Boolean array with the modules of the core (always on the ground floor)
+def CoreOccupancy(lotsizex, lotsizey, maxh, corex, corey, coresizex, coresizey):
+    occ = np.zeros((int(lotsizex), int(lotsizey), int(maxh)), dtype=bool)
+    occ[int(corex):int(corex + coresizex), int(corey):int(corey + coresizey), 0] = True
+    return occ
+
+
+# From occupancy array to state string (same format as HHagent.GetStateString)
+def StateString(occ):
+    return np.where(occ.ravel(), T_CODE, F_CODE).astype(np.uint8).tobytes().decode("ascii")
+
+
+# From state string to occupancy array
+def OccupancyFromState(state, shape):
+    return (np.frombuffer(state.encode("ascii"), dtype=np.uint8) == T_CODE).reshape(shape)
+
+
+# Translation of state strings to binary digits and back, to read them as integers
+_STATE_TO_DIGITS = str.maketrans("TF", "10")
+_DIGITS_TO_STATE = str.maketrans("10", "TF")
+
+
+# From state string to integer bitmask (bit idx is set when module idx is occupied)
+def StateBits(state):
+    return int(state.translate(_STATE_TO_DIGITS)[::-1], 2)
+
+
+# From integer bitmask to the state string of a lot of n modules
+def BitsState(bits, n):
+    return format(bits, "0{}b".format(n))[::-1].translate(_DIGITS_TO_STATE)
+
+
+# State strings of the rows of a (lots, modules) boolean array, built with one conversion
+def StateStringsOf(modules):
+    size = modules.shape[1]
+    text = np.where(modules, T_CODE, F_CODE).astype(np.uint8).tobytes().decode("ascii")
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+# Integer bitmasks of the rows of a (lots, modules) boolean array (Python integers, as a lot can
+# have more than 63 modules)
+def StatesBitsOf(modules):
+    if modules.shape[1] < 63:
+        return (modules.astype(np.int64) @ (1 << np.arange(modules.shape[1], dtype=np.int64))).tolist()
+    return [StateBits(state) for state in StateStringsOf(modules)]
+
+
+# Indices (as in HHagent.TestPtsSt) of the occupied modules
+def OccupiedIndices(occ):
+    return [int(idx) for idx in np.flatnonzero(occ)]
+
+
+# Index of the module next to idx in one of the FACE_DIRS (None if out of the lot)
+def NextIndex(shape, idx, direction):
+    nx, ny, nz = shape
+    k = idx % nz
+    j = (idx // nz) % ny
+    i = idx // (ny * nz)
+    dx, dy, dz = FACE_DIRS[direction]
+    i, j, k = i + dx, j + dy, k + dz
+    if 0 <= i < nx and 0 <= j < ny and 0 <= k < nz:
+        return (i * ny + j) * nz + k
+    return None
+
+
+# Tables of neighbours already built, by lot shape (lots of the same size share them)
+_ADJACENCY = {}
+_NEIGHBOURS = {}
+
+
+# Table (modules, 6) with the index of the module next to each one in the FACE_DIRS
+# (-1 if out of the lot). It is read only, as it is shared by every lot of that shape
+def Adjacency(shape):
+    shape = tuple(int(size) for size in shape)
+    table = _ADJACENCY.get(shape)
+    if table is None:
+        nx, ny, nz = shape
+        idx = np.arange(nx * ny * nz).reshape(shape)
+        table = np.full(shape + (6,), -1, dtype=np.int64)
+        table[1:, :, :, 0] = idx[:-1, :, :]
+        table[:-1, :, :, 1] = idx[1:, :, :]
+        table[:, 1:, :, 2] = idx[:, :-1, :]
+        table[:, :-1, :, 3] = idx[:, 1:, :]
+        table[:, :, 1:, 4] = idx[:, :, :-1]
+        table[:, :, :-1, 5] = idx[:, :, 1:]
+        table = table.reshape(-1, 6)
+        table.flags.writeable = False
+        _ADJACENCY[shape] = table
+    return table
+
+
+# Same as Adjacency but as a tuple with the ascending indices of the neighbours of
+# each module (the order of HHagent.TestPtsSt)
+def Neighbours(shape):
+    shape = tuple(int(size) for size in shape)
+    neighbours = _NEIGHBOURS.get(shape)
+    if neighbours is None:
+        neighbours = tuple(tuple(sorted(int(nxt) for nxt in row if nxt >= 0)) for row in Adjacency(shape))
+        _NEIGHBOURS[shape] = neighbours
+    return neighbours
+
+
+# Number of exposed faces classified as in HHagent.ClassifyFaces
+# walls (any floor), roofs (horizontal faces above the ground) and floor
+def ExposedFaces(occ):
+    pad = np.pad(occ, 1, mode="constant", constant_values=False)
+    inner = pad[1:-1, 1:-1, 1:-1]
+
+    walls = int((inner & ~pad[:-2, 1:-1, 1:-1]).sum() + (inner & ~pad[2:, 1:-1, 1:-1]).sum() +
+                (inner & ~pad[1:-1, :-2, 1:-1]).sum() + (inner & ~pad[1:-1, 2:, 1:-1]).sum())
+    tops = int((inner & ~pad[1:-1, 1:-1, 2:]).sum())
+    overhangs = int((occ[:, :, 1:] & ~occ[:, :, :-1]).sum())
+    floor = int(occ[:, :, 0].sum())
+
+    return (walls, tops + overhangs, floor)
+
+
+# Mirrors of a lot of this shape in x, in y and in both, and in square lots also across its diagonal
+# alone and followed by each of them (the turns of the lot), as pairs of read only arrays: the
+# index of the module of the lot taken by every module of the mirror, and the key in the mirror
+# of every face of the lot
+def LotMirrors(shape):
+    shape = tuple(int(size) for size in shape)
+    nx, ny, nz = shape
+    i, j, k = np.indices(shape).reshape(3, -1)
+    # Direction of each of the FACE_DIRS after each mirror
+    x_dirs = np.array([1, 0, 2, 3, 4, 5])
+    y_dirs = np.array([0, 1, 3, 2, 4, 5])
+    diagonal_dirs = np.array([2, 3, 0, 1, 4, 5])
+    mirrors = []
+    for transpose in ((False, True) if nx == ny else (False,)):
+        for flip_x, flip_y in ((False, False), (True, False), (False, True), (True, True)):
+            if not (transpose or flip_x or flip_y):
+                continue  # the lot itself
+            # Where each module and each direction of its faces go
+            new_i, new_j = (j, i) if transpose else (i, j)
+            dirs = diagonal_dirs if transpose else np.arange(6)
+            if flip_x:
+                new_i = nx - 1 - new_i
+                dirs = x_dirs[dirs]
+            if flip_y:
+                new_j = ny - 1 - new_j
+                dirs = y_dirs[dirs]
+            moved = (new_i * ny + new_j) * nz + k
+            modules = np.empty_like(moved)
+            modules[moved] = np.arange(len(moved))
+            faces = (moved[:, None] * 6 + dirs).ravel()
+            modules.flags.writeable = False
+            faces.flags.writeable = False
+            mirrors.append((modules, faces))
+    return mirrors
+
+
+# Mirrors of LotMirrors leaving the core where it is, the only ones that keep a lot reachable
+# from the core (the rules of growth are the same on both sides of a mirror)
+def CoreMirrors(core):
+    flat = core.ravel()
+    return [mirror for mirror in LotMirrors(core.shape) if (flat[mirror[0]] == flat).all()]
+
+
+# Smallest of a state string and its mirrors (one key for all of them) and the number of the
+# mirror giving it, None when it is the state itself
+def CanonicalState(state, mirrors):
+    best, best_mirror = state, None
+    if mirrors:
+        codes = np.frombuffer(state.encode("ascii"), dtype=np.uint8)
+        for nr, (modules, faces) in enumerate(mirrors):
+            mirrored = codes[modules].tobytes().decode("ascii")
+            if mirrored < best:
+                best, best_mirror = mirrored, nr
+    return (best, best_mirror)
+
+
+# Numbers of the actions of a state (its growable face keys in order) in the mirrored state:
+# action a of the state is action order[a] of the mirror (0, do nothing, stays 0)
+def MirroredActions(faces, face_map):
+    mirrored = sorted(int(face_map[face]) for face in faces)
+    position = {face: nr + 1 for nr, face in enumerate(mirrored)}
+    return [0] + [position[int(face_map[face])] for face in faces]
+
+
+# Occupied and free cells of the 2x2x2 modules around a lattice point, as an 8 bit code (bit
+# dx * 4 + dy * 2 + dz). The union of the modules is a manifold at the point when the occupied
+# cells are joined by faces and so are the free ones, otherwise they only touch by an edge or
+# by the point itself
+def _ManifoldCodes():
+    codes = np.zeros(256, dtype=bool)
+    for code in range(256):
+        joined = True
+        for cells in ([b for b in range(8) if code >> b & 1], [b for b in range(8) if not code >> b & 1]):
+            if not cells:
+                continue
+            reached = {cells[0]}
+            stack = [cells[0]]
+            while stack:
+                cell = stack.pop()
+                for axis in (1, 2, 4):
+                    nxt = cell ^ axis
+                    if nxt in cells and nxt not in reached:
+                        reached.add(nxt)
+                        stack.append(nxt)
+            joined = joined and len(reached) == len(cells)
+        codes[code] = joined
+    codes.flags.writeable = False
+    return codes
+
+
+MANIFOLD_CODES = _ManifoldCodes()
+
+
+# Problems of an occupancy as a building, empty when it is valid: "empty" (no module, the null
+# state), "contact" (modules only touching by an edge or a vertex, where their union is not a
+# manifold), "floating" (modules not joined by faces to the rest) and "unsupported" (modules
+# above a free one)
+def OccupancyProblems(occ):
+    if not occ.any():
+        return ("empty",)
+    problems = []
+
+    nx, ny, nz = occ.shape
+    pad = np.pad(occ, 1, mode="constant", constant_values=False).astype(np.uint8)
+    codes = np.zeros((nx + 1, ny + 1, nz + 1), dtype=np.uint8)
+    for bit in range(8):
+        dx, dy, dz = bit >> 2 & 1, bit >> 1 & 1, bit & 1
+        codes |= pad[dx:dx + nx + 1, dy:dy + ny + 1, dz:dz + nz + 1] << bit
+    if not MANIFOLD_CODES[codes].all():
+        problems.append("contact")
+
+    # Modules reached by faces from the first one
+    flat = occ.ravel()
+    adjacency = Adjacency(occ.shape)
+    first = int(np.flatnonzero(flat)[0])
+    reached = {first}
+    stack = [first]
+    while stack:
+        for nxt in adjacency[stack.pop()]:
+            nxt = int(nxt)
+            if nxt >= 0 and flat[nxt] and nxt not in reached:
+                reached.add(nxt)
+                stack.append(nxt)
+    if len(reached) < int(flat.sum()):
+        problems.append("floating")
+
+    if (occ[:, :, 1:] & ~occ[:, :, :-1]).any():
+        problems.append("unsupported")
+    return tuple(problems)
+
+
+# Problems already found, by lot shape and state string
+_PROBLEMS = {}
+
+
+# Same as OccupancyProblems but from a state string, checked once per state
+def StateProblems(state, shape):
+    key = (tuple(int(size) for size in shape), state)
+    problems = _PROBLEMS.get(key)
+    if problems is None:
+        problems = OccupancyProblems(OccupancyFromState(state, key[0]))
+        _PROBLEMS[key] = problems
+    return problems
+
+
+# Key of one face of a module, its order is the order of the actions
+def FaceKey(idx, direction):
+    return idx * 6 + direction
+
+
+# Ordered list of growable face keys (module index * 6 + direction)
+# Walls only grow on the ground floor and towards free modules of the lot (not on
+# its borders), roofs only grow under the max height
+def GrowableFaces(occ):
+    free = ~occ
+    ground = occ[:, :, 0]
+
+    candidates = np.zeros(occ.shape + (6,), dtype=bool)
+    candidates[1:, :, 0, 0] = ground[1:, :] & free[:-1, :, 0]
+    candidates[:-1, :, 0, 1] = ground[:-1, :] & free[1:, :, 0]
+    candidates[:, 1:, 0, 2] = ground[:, 1:] & free[:, :-1, 0]
+    candidates[:, :-1, 0, 3] = ground[:, :-1] & free[:, 1:, 0]
+    candidates[:, :, :-1, ROOF_DIR] = occ[:, :, :-1] & free[:, :, 1:]
+
+    # flat index = module index * 6 + direction, so it is already in order
+    return [int(flat) for flat in np.flatnonzero(candidates)]
+
+
+# Growable face keys already enumerated, by lot shape and state string
+_GROWABLE = {}
+
+
+# Same as GrowableFaces but from a state string, computed once per state
+def GrowableFacesOf(state, shape):
+    key = (tuple(int(size) for size in shape), state)
+    faces = _GROWABLE.get(key)
+    if faces is None:
+        faces = tuple(GrowableFaces(OccupancyFromState(state, key[0])))
+        _GROWABLE[key] = faces
+    return faces
+
+
+# Module occupied when growing the face with this key
+def GrownIndex(shape, face_key):
+    return NextIndex(shape, face_key // 6, face_key % 6)
+
+
+# Changes caused by occupying module idx, looking only at its six neighbours
+# Returns the change of exposed (walls, roofs, floor) and the growable face keys
+# that disappear and appear
+def AddModuleDelta(occ, idx):
+    shape = occ.shape
+    flat = occ.ravel()
+    ground = idx % shape[2] == 0
+    neighbours = [NextIndex(shape, idx, direction) for direction in range(6)]
+    occupied = [nxt is not None and bool(flat[nxt]) for nxt in neighbours]
+
+    walls, roofs, floor = 0, 0, 0
+    removed = []
+    added = []
+
+    # My walls are exposed unless they touch a module, which loses its own wall
+    for direction in WALL_DIRS:
+        if occupied[direction]:
+            walls -= 1
+            if ground:
+                removed.append(FaceKey(neighbours[direction], direction ^ 1))
+        else:
+            walls += 1
+            if ground and neighbours[direction] is not None:
+                added.append(FaceKey(idx, direction))
+
+    # Roof on top (or covering the overhang of the module above)
+    if occupied[ROOF_DIR]:
+        roofs -= 1
+    else:
+        roofs += 1
+        if neighbours[ROOF_DIR] is not None:
+            added.append(FaceKey(idx, ROOF_DIR))
+
+    # Floor on the ground, or covering the roof of the module below
+    if ground:
+        floor += 1
+    elif occupied[4]:
+        roofs -= 1
+        removed.append(FaceKey(neighbours[4], ROOF_DIR))
+    else:
+        roofs += 1
+
+    return ((walls, roofs, floor), removed, added)
+
+
+# Corners (in modules, outward winding) of every exposed face of the occupancy
+def ExposedQuads(occ):
+    nx, ny, nz = occ.shape
+    quads = []
+    for i, j, k in zip(*np.nonzero(occ)):
+        i, j, k = int(i), int(j), int(k)
+        for direction, (dx, dy, dz) in enumerate(FACE_DIRS):
+            ni, nj, nk = i + dx, j + dy, k + dz
+            if 0 <= ni < nx and 0 <= nj < ny and 0 <= nk < nz and occ[ni, nj, nk]:
+                continue
+            quads.append((direction, FaceCorners(i, j, k, direction)))
+    return quads
+
+
+# Four corners of one face of module (i, j, k), counterclockwise seen from outside
+def FaceCorners(i, j, k, direction):
+    if direction == 0:
+        return ((i, j, k), (i, j, k + 1), (i, j + 1, k + 1), (i, j + 1, k))
+    if direction == 1:
+        return ((i + 1, j, k), (i + 1, j + 1, k), (i + 1, j + 1, k + 1), (i + 1, j, k + 1))
+    if direction == 2:
+        return ((i, j, k), (i + 1, j, k), (i + 1, j, k + 1), (i, j, k + 1))
+    if direction == 3:
+        return ((i, j + 1, k), (i, j + 1, k + 1), (i + 1, j + 1, k + 1), (i + 1, j + 1, k))
+    if direction == 4:
+        return ((i, j, k), (i, j + 1, k), (i + 1, j + 1, k), (i + 1, j, k))
+    return ((i, j, k + 1), (i + 1, j, k + 1), (i + 1, j + 1, k + 1), (i, j + 1, k + 1))
+
+
+# Exposed faces merged into coplanar rectangles, as (direction, loop of lattice points)
+# The loops are counterclockwise seen from outside and keep every lattice point on their
+# edges, so the edges of neighbouring rectangles always match and the solid stays closed
+def MergedFaces(occ):
+    nx, ny, nz = occ.shape
+    pad = np.pad(occ, 1, mode="constant", constant_values=False)
+    faces = []
+    for direction, (dx, dy, dz) in enumerate(FACE_DIRS):
+        axis = direction // 2
+        positive = direction % 2 == 1
+        exposed = occ & ~pad[1 + dx:1 + dx + nx, 1 + dy:1 + dy + ny, 1 + dz:1 + dz + nz]
+        # the other two axes in increasing order, u x v is +axis except for y
+        u_axis, v_axis = [other for other in range(3) if other != axis]
+        ccw = (axis != 1) == positive
+        for layer in range(occ.shape[axis]):
+            mask = np.take(exposed, layer, axis=axis).copy()  # indexed by (u, v)
+            plane = layer + 1 if positive else layer
+            for u0, v0 in zip(*np.nonzero(mask)):
+                if not mask[u0, v0]:
+                    continue  # already in a rectangle
+                v1 = v0 + 1
+                while v1 < mask.shape[1] and mask[u0, v1]:
+                    v1 += 1
+                u1 = u0 + 1
+                while u1 < mask.shape[0] and mask[u1, v0:v1].all():
+                    u1 += 1
+                mask[u0:u1, v0:v1] = False
+
+                loop = ([(u, v0) for u in range(u0, u1)] + [(u1, v) for v in range(v0, v1)] +
+                        [(u, v1) for u in range(u1, u0, -1)] + [(u0, v) for v in range(v1, v0, -1)])
+                if not ccw:
+                    loop.reverse()
+                points = []
+                for u, v in loop:
+                    point = [0, 0, 0]
+                    point[axis] = plane
+                    point[u_axis] = int(u)
+                    point[v_axis] = int(v)
+                    points.append(tuple(point))
+                faces.append((direction, points))
+    return faces
@@ -0,0 +1,7 @@
+'''The tests import the herp modules from the root of the repository. Only the "Voxel"
+backend is used, so they run without Rhino.'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,53 @@
+'''The Polyface3D of the voxel geometries is closed, has one face per merged rectangle and the
+area of the exposed faces of the modules. herp.honeybee_geom needs honeybee, the faces
+themselves only need ladybug_geometry.'''
+
+import numpy as np
+import pytest
+
+from herp import voxel_geom
+
+Polyface3D = pytest.importorskip("ladybug_geometry.geometry3d.polyface").Polyface3D
+from ladybug_geometry.geometry3d.face import Face3D
+from ladybug_geometry.geometry3d.pointvector import Point3D
+
+MODULE = 3.0
+ORIGIN = (10.0, 5.0)
+
+
+def Occupancy(*modules):
+    occ = np.zeros((3, 3, 3), dtype=bool)
+    for idx in modules:
+        occ[idx] = True
+    return occ
+
+
+CASES = {
+    "single": Occupancy((0, 0, 0)),
+    "L": Occupancy((0, 0, 0), (1, 0, 0), (0, 1, 0)),
+    "stacked": Occupancy((0, 0, 0), (0, 0, 1), (1, 0, 0), (1, 0, 1), (1, 1, 0)),
+}
+
+
+def CheckPolyface(polyface, occ):
+    assert polyface.is_solid
+    assert len(polyface.faces) == len(voxel_geom.MergedFaces(occ))
+    assert polyface.area == pytest.approx(sum(voxel_geom.ExposedFaces(occ)) * MODULE ** 2)
+    assert polyface.volume == pytest.approx(occ.sum() * MODULE ** 3)
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_merged_faces_close_a_polyface(name):
+    occ = CASES[name]
+    faces = [Face3D(tuple(Point3D(ORIGIN[0] + i * MODULE, ORIGIN[1] + j * MODULE, k * MODULE)
+                          for i, j, k in loop))
+             for _, loop in voxel_geom.MergedFaces(occ)]
+    CheckPolyface(Polyface3D.from_faces(faces, 0.01), occ)
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_voxel_to_polyface3d(name):
+    honeybee_geom = pytest.importorskip("herp.honeybee_geom")  # with honeybee installed
+
+    occ = CASES[name]
+    CheckPolyface(honeybee_geom.voxel_to_polyface3d(occ, ORIGIN, MODULE), occ)
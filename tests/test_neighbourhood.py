@@ -0,0 +1,180 @@
+'''Queries of the whole Neighbourhood against reading its agents one by one.'''
+
+import numpy as np
+
+from herp import geo_gen_canvas_wneigh, voxel_geom
+from herp.geo_gen_canvas_wneigh import Neighbourhood
+
+
+def GrownNeighbourhood(state_encoding, seed):
+    rng = np.random.default_rng(seed)
+    neigh = Neighbourhood(0, 0, 2, 1, 11, 3, 3, 2.7, 0, 0, 1, 1, 3, 4, True, True, 2.7 * 4, 0, 200, 500,
+                          "Voxel", state_encoding=state_encoding)
+    for _ in range(6):
+        neigh.TakeActionsN({ag_id: int(rng.integers(0, 5)) for ag_id in neigh.AgInNeigh})
+    return neigh
+
+
+def test_neighbourhood_queries_match_the_agents(monkeypatch):
+    # Global input of the Grasshopper component
+    monkeypatch.setattr(geo_gen_canvas_wneigh, "BUDGET", 10000, raising=False)
+    for state_encoding in ("String", "Bits"):
+        neigh = GrownNeighbourhood(state_encoding, 1)
+        agents = [neigh.GetAgentbyID(ag_id) for ag_id in neigh.AgInNeigh]
+        assert neigh.GetIStatesN() == {ag_id: neigh.IState(agent) for ag_id, agent in zip(neigh.AgInNeigh, agents)}
+        assert neigh.GetOccupiedPN() == {ag_id: agent.NOccupiedPts for ag_id, agent in zip(neigh.AgInNeigh, agents)}
+        assert neigh.GetAvailActsN(neigh.AgInNeigh) == {ag_id: agent.Poss_act
+                                                        for ag_id, agent in zip(neigh.AgInNeigh, agents)}
+        extcost, balance = neigh.GetExtCost_BalanceN()
+        assert extcost == {ag_id: agent.WallAreaExtCost + agent.RoofAreaExtCost
+                           for ag_id, agent in zip(neigh.AgInNeigh, agents)}
+        assert balance == {ag_id: 10000 - extcost[ag_id] for ag_id in neigh.AgInNeigh}
+
+        sizes = {ag_id: 4 for ag_id in neigh.AgInNeigh}
+        needs = neigh.NeedsN(sizes)
+        assert needs == {ag_id: 4 - agent.NOccupiedPts for ag_id, agent in zip(neigh.AgInNeigh, agents)}
+        some = neigh.AgInNeigh[::2]
+        assert neigh.FilledN(some, [sizes[ag_id] for ag_id in some]).tolist() == [needs[ag_id] <= 0 for ag_id in some]
+
+
+def test_states_of_large_lots():
+    rng = np.random.default_rng(2)
+    for size in (5, 62, 63, 100):
+        modules = rng.random((7, size)) < 0.5
+        strings = voxel_geom.StateStringsOf(modules)
+        assert strings == [voxel_geom.StateString(row) for row in modules]
+        assert voxel_geom.StatesBitsOf(modules) == [voxel_geom.StateBits(state) for state in strings]
+
+
+NEIGH_ARGS = (0, 0, 2, 1, 11, 3, 3, 2.7, 0, 0, 1, 1, 3, 4, True, True, 2.7 * 4, 0, 200, 500, "Voxel")
+
+
+# What a saved neighbourhood has to keep: states, arrays, index and neighbours
+def SavedValues(neigh):
+    return (neigh.GetIStatesN(), neigh.GetJStatesN(neigh.AgInNeigh), neigh.OccupancyN.tolist(),
+            neigh.OccupiedN.tolist(), neigh.PossActN.tolist(), neigh.NeighIndex.Indptr.tolist(),
+            neigh.NeighIndex.Indices.tolist(), neigh.EveryNeigh, neigh.AgInNeigh,
+            [agent.GrowFaces for agent in neigh.Agents])
+
+
+def test_cached_neighbourhood_round_trip(tmp_path):
+    built = geo_gen_canvas_wneigh.CachedNeighbourhood(str(tmp_path), *NEIGH_ARGS, state_encoding="Bits")
+    files = list(tmp_path.iterdir())
+    assert len(files) == 1
+    loaded = geo_gen_canvas_wneigh.CachedNeighbourhood(str(tmp_path), *NEIGH_ARGS, state_encoding="Bits")
+    assert loaded is not built and list(tmp_path.iterdir()) == files
+    assert SavedValues(loaded) == SavedValues(built)
+    assert not loaded.NeighIndex.Indices.flags.writeable
+
+    # The agents grow their rows of OccupancyN again, as the built ones
+    for neigh in (built, loaded):
+        assert all(np.shares_memory(agent.Occupancy, neigh.OccupancyN) for agent in neigh.Agents)
+        neigh.TakeActionsN({ag_id: 1 for ag_id in neigh.AgInNeigh})
+    assert SavedValues(loaded) == SavedValues(built)
+
+    # A grown neighbourhood saved by hand
+    path = str(tmp_path / "grown.pkl")
+    assert geo_gen_canvas_wneigh.SaveNeighbourhood(built, path)
+    assert SavedValues(geo_gen_canvas_wneigh.LoadNeighbourhood(path)) == SavedValues(built)
+
+
+def test_unreadable_cached_neighbourhood_is_built_again(tmp_path):
+    geo_gen_canvas_wneigh.CachedNeighbourhood(str(tmp_path), *NEIGH_ARGS)
+    path = next(tmp_path.iterdir())
+    path.write_bytes(path.read_bytes()[:100])
+    neigh = geo_gen_canvas_wneigh.CachedNeighbourhood(str(tmp_path), *NEIGH_ARGS)
+    assert len(neigh.AgInNeigh) == 16
+    assert SavedValues(geo_gen_canvas_wneigh.LoadNeighbourhood(str(path))) == SavedValues(neigh)
+
+
+def test_bits_encoding_matches_the_strings():
+    rng = np.random.default_rng(5)
+    for size in (1, 27, 63, 64, 100):
+        for _ in range(5):
+            state = ''.join(rng.choice(["T", "F"], size))
+            bits = voxel_geom.StateBits(state)
+            assert bits == sum(1 << idx for idx, char in enumerate(state) if char == "T")
+            assert voxel_geom.BitsState(bits, size) == state
+
+    # Same growth with both encodings, the joint states are the same once written as strings
+    strings = GrownNeighbourhood("String", 6)
+    bits = GrownNeighbourhood("Bits", 6)
+    string_jstates = strings.GetJStatesN(strings.AgInNeigh)
+    bits_jstates = bits.GetJStatesN(bits.AgInNeigh)
+    for ag_id in bits.AgInNeigh:
+        assert isinstance(bits_jstates[ag_id], tuple)
+        assert bits.JStateString(ag_id, bits_jstates[ag_id]) == string_jstates[ag_id]
+        assert strings.JStateString(ag_id, string_jstates[ag_id]) == string_jstates[ag_id]
+        agent = bits.GetAgentbyID(ag_id)
+        assert agent.C_bits == voxel_geom.StateBits(agent.C_state)
+
+    # A null state of any agent makes the joint state null
+    agent = bits.Agents[0]
+    assert bits.JoinStates(0, [agent.C_bits]) == bits.NullJState == (0,)
+    assert bits.JoinStates(agent.C_bits, [agent.C_bits, 0]) == bits.NullJState
+    assert bits.JStateString(agent.NeighID, bits.NullJState) == 'F'
+    assert strings.JoinStates(agent.GetNullState(), [agent.C_state]) == 'F'
+    assert strings.JoinStates(agent.C_state, [agent.GetNullState()]) == 'F'
+
+
+def test_joint_states_are_built_again_only_when_changed():
+    rng = np.random.default_rng(7)
+    neigh = GrownNeighbourhood("Bits", 8)
+    built = []
+    build = neigh.BuildJState
+
+    def CountedBuild(ag_id):
+        built.append(ag_id)
+        return build(ag_id)
+
+    neigh.BuildJState = CountedBuild
+    start = neigh.SnapshotN()
+    neigh.GetJStatesN(neigh.AgInNeigh)
+    for _ in range(12):
+        # Some agents change, the others do not (action 0 keeps the state)
+        changed = set()
+        for ag_id in rng.choice(neigh.AgInNeigh, 3, replace=False).tolist():
+            agent = neigh.GetAgentbyID(ag_id)
+            old_state = agent.C_state
+            agent.Extend(int(rng.choice([0, -1, 1, agent.Poss_act])))
+            if agent.C_state != old_state:
+                changed.add(ag_id)
+        assert neigh.DirtyAgents == changed
+
+        # Only the cached joint states that read a changed agent are built again
+        queried = rng.choice(neigh.AgInNeigh, 10, replace=False).tolist()
+        cached = set(neigh.JStates)
+        del built[:]
+        jstates = neigh.GetJStatesN(queried)
+        assert jstates == {ag_id: build(ag_id) for ag_id in queried}
+        stale = {reader for ag_id in changed for reader in neigh.JStateReaders[ag_id]}
+        assert set(built) == set(queried) - (cached - stale)
+        assert not neigh.DirtyAgents
+
+        # Asking again builds nothing
+        del built[:]
+        assert neigh.GetJStatesN(queried) == jstates and built == []
+
+    neigh.RestoreN(start)
+    assert neigh.GetJStatesN(neigh.AgInNeigh) == {ag_id: build(ag_id) for ag_id in neigh.AgInNeigh}
+
+
+def test_dense_index_matches_the_block_ids():
+    neigh = Neighbourhood(0, 0, 3, 2, 11, 3, 3, 2.7, 0, 0, 1, 1, 3, 4, True, True, 2.7 * 4, 0, 200, 500, "Voxel")
+    nagents = len(neigh.AgInNeigh)
+    assert neigh.AgInNeigh == ["{}_{}".format(block, lot) for block in range(6) for lot in range(8)]
+    for idx, ag_id in enumerate(neigh.AgInNeigh):
+        agent = neigh.GetAgentbyID(ag_id)
+        assert neigh.AgIndex[ag_id] == idx
+        assert agent is neigh.Agents[idx] is neigh.AgentFromBlocks(ag_id)
+        assert (agent.NeighID, agent.NeighRow) == (ag_id, idx)
+        assert neigh.IDNeighNeighbours(ag_id) == neigh.EveryNeigh[ag_id]
+
+        # Rows of the sorted neighbours, padded with the number of agents
+        rows = [neigh.AgIndex[id_n] for id_n in sorted(neigh.EveryNeigh[ag_id])]
+        padding = [nagents] * (neigh.SortedNeighRows.shape[1] - len(rows))
+        assert neigh.SortedNeighRows[idx].tolist() == rows + padding
+
+    some = neigh.AgInNeigh[::-3]
+    assert neigh.RowsN(some).tolist() == [neigh.AgInNeigh.index(ag_id) for ag_id in some]
+    assert neigh.RowsN([]).tolist() == []
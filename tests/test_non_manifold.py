@@ -0,0 +1,57 @@
+'''The problems of voxel_geom.OccupancyProblems and HHagent.NonManifold for a table of small
+occupancies.'''
+
+import numpy as np
+import pytest
+
+from herp import voxel_geom
+from herp.geo_gen_canvas_wneigh import HHagent
+
+SHAPE = (3, 3, 3)
+
+# Occupied modules and the problems of the occupancy
+TABLE = [
+    ((), ("empty",)),
+    (((0, 0, 0),), ()),
+    (((0, 0, 0), (1, 0, 0), (0, 1, 0)), ()),
+    (((0, 0, 0), (0, 0, 1), (0, 0, 2)), ()),
+    (((1, 1, 0), (0, 1, 0), (2, 1, 0), (1, 0, 0), (1, 2, 0), (1, 1, 1)), ()),
+    # Two modules only touching by an edge, or by a vertex
+    (((0, 0, 0), (1, 1, 0)), ("contact", "floating")),
+    (((0, 0, 0), (1, 1, 1)), ("contact", "floating", "unsupported")),
+    # Apart
+    (((0, 0, 0), (2, 0, 0)), ("floating",)),
+    # Over a free module, joined by its side
+    (((0, 0, 0), (0, 0, 1), (1, 0, 1)), ("unsupported",)),
+    # Touching by an edge but joined through the floor above
+    (((0, 0, 0), (1, 1, 0), (0, 0, 1), (1, 0, 1), (1, 1, 1)), ("contact", "unsupported")),
+    # A ring of modules around a free one on the ground has a hole, but is a manifold
+    ((tuple((i, j, 0) for i in range(3) for j in range(3) if (i, j) != (1, 1))), ()),
+]
+
+
+def Occupancy(modules):
+    occ = np.zeros(SHAPE, dtype=bool)
+    for idx in modules:
+        occ[idx] = True
+    return occ
+
+
+@pytest.mark.parametrize("modules, problems", TABLE)
+def test_occupancy_problems(modules, problems):
+    occ = Occupancy(modules)
+    assert voxel_geom.OccupancyProblems(occ) == problems
+    assert voxel_geom.StateProblems(voxel_geom.StateString(occ), SHAPE) == problems
+
+
+@pytest.mark.parametrize("modules, problems", TABLE)
+def test_non_manifold_agents(modules, problems):
+    agent = HHagent(0, 0, SHAPE[0], SHAPE[1], 3, 0, 0, 1, 1, SHAPE[2], 6, 200, 500, "Voxel")
+    assert not agent.NonManifold
+    agent.C_state = voxel_geom.StateString(Occupancy(modules))
+    assert agent.NonManifold == (len(problems) > 0)
+
+    # Rhino breps are simulated as they are, only their null state is flagged
+    agent.Backend = "Rhino"
+    assert agent.NonManifold == (agent.C_state == agent.GetNullState())
+    assert agent.NonManifold == (problems == ("empty",))
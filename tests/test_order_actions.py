@@ -0,0 +1,110 @@
+'''HHagent.OrderActions (Rhino backend) against the ClosestPoint pairing of the baseline, with
+faces that stand in for the faces of a brep.'''
+
+from herp.geo_gen_canvas_wneigh import AlignedRectangleBox, BoxDistance2, HHagent
+from herp.voxel_geom import Point3
+
+MODULE = 2
+
+
+# Closest point of a segment of the plane to a point of the plane
+def SegmentClosest(start, end, point):
+    du, dv = end[0] - start[0], end[1] - start[1]
+    t = ((point[0] - start[0]) * du + (point[1] - start[1]) * dv) / (du * du + dv * dv)
+    t = min(max(t, 0.0), 1.0)
+    return (start[0] + t * du, start[1] + t * dv)
+
+
+# Planar face of constant x, y or z with a polygon as outline, with the ClosestPoint and PointAt
+# of a Rhino BrepFace (the parameters are the two other coordinates)
+class PolygonFace:
+    def __init__(self, vertices):
+        self.Vertices = vertices
+        coords = [(vertex.X, vertex.Y, vertex.Z) for vertex in vertices]
+        self.Axis = next(axis for axis in range(3) if len(set(coord[axis] for coord in coords)) == 1)
+        self.Plane = coords[0][self.Axis]
+        self.Polygon = [self.InPlane(coord) for coord in coords]
+
+    def InPlane(self, coord):
+        return tuple(coord[axis] for axis in range(3) if axis != self.Axis)
+
+    def ClosestPoint(self, pt):
+        point = self.InPlane((pt.X, pt.Y, pt.Z))
+        inside = False
+        for start, end in zip(self.Polygon, self.Polygon[1:] + self.Polygon[:1]):
+            if (start[1] > point[1]) != (end[1] > point[1]):
+                if point[0] < start[0] + (point[1] - start[1]) * (end[0] - start[0]) / (end[1] - start[1]):
+                    inside = not inside
+        if inside:
+            return (True,) + point
+        closest = [SegmentClosest(start, end, point)
+                   for start, end in zip(self.Polygon, self.Polygon[1:] + self.Polygon[:1])]
+        best = min(closest, key=lambda uv: (uv[0] - point[0]) ** 2 + (uv[1] - point[1]) ** 2)
+        return (True,) + best
+
+    def PointAt(self, u, v):
+        coords = [u, v]
+        coords.insert(self.Axis, self.Plane)
+        return Point3(*coords)
+
+
+class PolygonBrep:
+    def __init__(self, faces):
+        self.Faces = faces
+
+
+def Points(*coords):
+    return [Point3(*coord) for coord in coords]
+
+
+# Modules (0, 0), (1, 0), (0, 1) and (1, 1) on the ground and (1, 1) again on top: the roof of the
+# first three is one L-shaped face, whose box covers the two modules of (1, 1)
+def LShapedState():
+    faces = [PolygonFace(Points((4, 0, 0), (4, 2, 0), (4, 2, 2), (4, 0, 2))),  # wall of (1, 0, 0)
+             PolygonFace(Points((0, 0, 2), (4, 0, 2), (4, 2, 2), (2, 2, 2), (2, 4, 2), (0, 4, 2))),
+             PolygonFace(Points((2, 2, 4), (4, 2, 4), (4, 4, 4), (2, 4, 4)))]
+    occupied = [(0, 0, 0), (1, 0, 0), (0, 1, 0), (1, 1, 0), (1, 1, 1)]
+    state = ["F"] * 27
+    for i, j, k in occupied:
+        state[(i * 3 + j) * 3 + k] = "T"
+    return PolygonBrep(faces), "".join(state)
+
+
+# Pairs of the baseline: ClosestPoint of every growable face
+def ClosestPointPairs(agent, brep, state, tolerance):
+    pairs = set()
+    for idx, st in enumerate(state):
+        if st != "T":
+            continue
+        pt = agent.CentreModulePts[idx]
+        for faceidx, face in enumerate(brep.Faces):
+            facepts = face.ClosestPoint(pt)
+            if face.PointAt(facepts[1], facepts[2]).DistanceTo(pt) <= agent.Module / 2 + tolerance:
+                pairs.add((idx, faceidx))
+    return sorted(pairs)
+
+
+def test_l_shaped_faces_keep_the_closest_point_order(monkeypatch):
+    brep, state = LShapedState()
+    monkeypatch.setattr(HHagent, "FilterWalls", lambda self, inbrep, vertices=None: [0])
+    monkeypatch.setattr(HHagent, "FilterRoofs", lambda self, inbrep, vertices=None: [1, 2])
+    agent = HHagent(0, 0, 3, 3, MODULE, 0, 0, 1, 1, 3, 6, 200, 500, "Voxel")
+    vertices = [face.Vertices for face in brep.Faces]
+
+    expected = ClosestPointPairs(agent, brep, state, 0.05)
+    assert agent.OrderActions(brep, 0.05, vertices, state) == expected
+    assert expected == [(0, 1), (3, 1), (9, 0), (9, 1), (13, 2)]
+
+    # The box of the L would also pair it with both modules of (1, 1)
+    l_box = ([0, 0, 2], [4, 4, 2])
+    for idx in (12, 13):
+        assert BoxDistance2(l_box, agent.CentreModulePts[idx]) <= (agent.Module / 2 + 0.05) ** 2
+
+
+def test_aligned_rectangle_box():
+    box = AlignedRectangleBox(Points((4, 0, 0), (4, 2, 0), (4, 2, 2), (4, 0, 2)), 0.01)
+    assert box == ([4, 0, 0], [4, 2, 2])
+    assert AlignedRectangleBox(Points((0, 0, 2), (4, 0, 2), (4, 2, 2), (2, 2, 2), (2, 4, 2), (0, 4, 2)), 0.01) is None
+    assert AlignedRectangleBox(Points((0, 0, 2), (4, 0, 2), (4, 4, 2)), 0.01) is None
+    assert AlignedRectangleBox(Points((0, 0, 2), (4, 0, 2), (3, 4, 2), (0, 4, 2)), 0.01) is None  # trapezoid
+    assert AlignedRectangleBox(Points((0, 0, 0), (4, 0, 0), (4, 4, 2), (0, 4, 2)), 0.01) is None  # sloped
@@ -0,0 +1,363 @@
+'''The QStore against the nested-dict q-tables it replaced (GetMultiQtablesN, CheckQtableN,
+HHagent.GetActionMulti2, HHagent.GetMaxFutureQ and the update of MARL_cloud).'''
+
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+from herp.geo_gen_canvas_wneigh import Neighbourhood
+from herp.q_store import QStore, TraceStore
+
+GOAL_REWARD = 25
+DISCOUNT = 0.9
+
+
+# Two blocks of eight lots of 3 x 3 modules, up to three floors
+def SmallNeighbourhood():
+    return Neighbourhood(0, 0, 2, 1, 11, 3, 3, 2.7, 0, 0, 1, 1, 3, 4, True, True, 2.7 * 4, 0, 200, 500,
+                         "Voxel", state_encoding="Bits")
+
+
+# Random growth of some agents, with the dict q-tables and a QStore of the same states
+def RandomEpisodes(seed):
+    random.seed(seed)
+    neigh = SmallNeighbourhood()
+    part = random.sample(neigh.AgInNeigh, 5)
+    everyone = list(dict.fromkeys(part + [id_n for ag_id in part for id_n in neigh.EveryNeigh[ag_id]]))
+    poss_acts = neigh.GetInitPossActsN(everyone)
+    jstates = neigh.GetInitJStatesN(everyone)
+    q_tabs, sja = neigh.GetMultiQtablesN(poss_acts, jstates, part)
+    qstore = neigh.GetQStoreN(poss_acts, jstates, part)
+    start = neigh.SnapshotN()
+
+    for episode in range(4):
+        neigh.RestoreN(start)
+        for step in range(3):
+            states_0 = neigh.GetJStatesN(part)
+            actions = {ag_id: None for ag_id in everyone}
+            for ag_id in part:
+                agent = neigh.GetAgentbyID(ag_id)
+                actions[ag_id] = random.randint(1, agent.Poss_act)
+                agent.Extend(actions[ag_id])
+            states_1 = neigh.GetJStatesN(everyone)
+            poss_acts = neigh.GetAvailActsN(everyone)
+            q_tabs, sja = neigh.CheckQtableN(q_tabs, sja, states_1, poss_acts, part)
+            neigh.CheckQStoreN(qstore, states_1, poss_acts, part)
+            yield neigh, part, states_0, states_1, actions, q_tabs, sja, qstore
+
+
+def test_values_and_expected_q_match_dict_tables():
+    for neigh, part, states_0, states_1, actions, q_tabs, sja, qstore in RandomEpisodes(4):
+        for ag_id in part:
+            agent = neigh.GetAgentbyID(ag_id)
+            jact = neigh.JointActionsN(actions, [ag_id])[ag_id]
+            value = random.randint(-40, 40) / 8  # exact in float32
+
+            q_tabs[ag_id][states_0[ag_id]][jact][actions[ag_id]] = value
+            sja[ag_id][states_0[ag_id]][jact] += 1
+            sid = qstore.StateId(ag_id, states_0[ag_id])
+            jaid = qstore.JointActionId(sid, jact)
+            qstore.Set(sid, jaid, actions[ag_id], value)
+            qstore.Visit(sid, jaid)
+            assert qstore.Get(sid, jaid, actions[ag_id]) == value
+
+            for state in (states_0[ag_id], states_1[ag_id]):
+                assert qstore.MaxFutureQ(qstore.StateId(ag_id, state)) == \
+                       agent.GetMaxFutureQ(q_tabs[ag_id], sja[ag_id], state)
+            action, flag = agent.GetActionMulti2(-1, q_tabs[ag_id], sja[ag_id], states_0[ag_id])
+            assert flag == "From Table"
+            assert qstore.Argmax(sid) == action
+
+
+def test_actions_of_a_step_match_one_by_one():
+    for neigh, part, states_0, states_1, actions, q_tabs, sja, qstore in RandomEpisodes(5):
+        for ag_id in part:
+            jact = neigh.JointActionsN(actions, [ag_id])[ag_id]
+            value = random.randint(-40, 40) / 8
+            q_tabs[ag_id][states_0[ag_id]][jact][actions[ag_id]] = value
+            sja[ag_id][states_0[ag_id]][jact] += 1
+            sid = qstore.StateId(ag_id, states_0[ag_id])
+            jaid = qstore.JointActionId(sid, jact)
+            qstore.Set(sid, jaid, actions[ag_id], value)
+            qstore.Visit(sid, jaid)
+
+        # Greedy agents choose the action of the dict q-tables
+        selected = neigh.GetActionsQStoreN(qstore, {ag_id: -1 for ag_id in part}, states_0, part)
+        assert list(selected) == part
+        for ag_id in part:
+            agent = neigh.GetAgentbyID(ag_id)
+            assert selected[ag_id] == agent.GetActionMulti2(-1, q_tabs[ag_id], sja[ag_id], states_0[ag_id])
+
+        # Random numbers drawn agent by agent, the greedy ones all chosen at once
+        epsilons = {ag_id: random.choice([0, 0.5, 1]) for ag_id in part}
+        state = random.getstate()
+        selected = neigh.GetActionsQStoreN(qstore, epsilons, states_0, part)
+        random.setstate(state)
+        for ag_id in part:
+            agent = neigh.GetAgentbyID(ag_id)
+            if random.random() > epsilons[ag_id]:
+                sid = qstore.StateId(ag_id, states_0[ag_id])
+                assert selected[ag_id] == (qstore.Argmax(sid), "From Table")
+            else:
+                assert selected[ag_id] == (random.randint(1, agent.Poss_act), "Random")
+
+
+def test_unwritten_joint_actions_read_zero_without_rows():
+    qstore = QStore()
+    sid = qstore.AddState("0_0", "TF_TF", 4, [3, 5])
+    assert qstore.Get(sid, qstore.JointActionId(sid, (2, 4)), 1) == 0
+    assert qstore.NRows == 0
+    qstore.Set(sid, qstore.JointActionId(sid, (2, 4)), 1, 3.5)
+    assert qstore.NRows == 1
+    assert qstore.Get(sid, qstore.JointActionId(sid, (2, 3)), 1) == 0
+    assert qstore.ExpectedQ(sid).tolist() == [0, 0, 0, 0]  # weighted by visits
+    qstore.Visit(sid, qstore.JointActionId(sid, (2, 4)))
+    assert qstore.ExpectedQ(sid).tolist() == [0, 3.5, 0, 0]
+
+
+def test_rows_grow_with_used_joint_actions_only():
+    rng = random.Random(3)
+    agent = SmallNeighbourhood().Agents[0]
+    qstore = QStore()
+    # Six neighbours with 12 actions each, almost three million joint actions and no row
+    crowded = qstore.AddState("0_0", "crowded", 5, [12] * 6)
+    assert qstore.NextOffset == 12 ** 6 and qstore.NRows == 0
+    sid = qstore.AddState("0_0", "small", 4, [5, 5, 5])
+
+    # The dict q-tables of CheckQtableN, with a list of q-values and visits for every joint action
+    q_tab = {"small": {jact: [0, 0, 0, 0] for jact in itertools.product(range(5), repeat=3)}}
+    sja = {"small": {jact: 0 for jact in q_tab["small"]}}
+    used = set()
+    for _ in range(60):
+        jact = tuple(rng.randrange(3) for _ in range(3))
+        used.add(jact)
+        jaid = qstore.JointActionId(sid, jact)
+        if rng.random() < 0.5:
+            action = rng.randrange(4)
+            value = rng.randint(-40, 40) / 8
+            q_tab["small"][jact][action] = value
+            qstore.Set(sid, jaid, action, value)
+        else:
+            sja["small"][jact] += 1
+            qstore.Visit(sid, jaid)
+        assert qstore.NRows == len(used)
+        assert qstore.MaxFutureQ(sid) == agent.GetMaxFutureQ(q_tab, sja, "small")
+        assert np.allclose(qstore.ExpectedQ(sid), [sum(q_tab["small"][jact][action] * sja["small"][jact]
+                                                       for jact in used) / max(sum(sja["small"].values()), 1)
+                                                   for action in range(4)])
+    qstore.Visit(crowded, qstore.JointActionId(crowded, (11, 0, 3, 7, 2, 11)))
+    assert qstore.NRows == len(used) + 1
+
+
+def test_joint_action_ids_match_one_by_one():
+    qstore = QStore()
+    sids = [qstore.AddState(nr, "S", 3, radices) for nr, radices in enumerate([[3, 4, 5], [6], [2, 2]])]
+    jactions = np.array([[2, 3, 4], [5, 0, 0], [1, 1, 0]])
+    expected = [qstore.JointActionId(sid, row[:len(radices)])
+                for sid, row, radices in zip(sids, jactions.tolist(), [[3, 4, 5], [6], [2, 2]])]
+    assert qstore.JointActionIds(sids, jactions).tolist() == expected == [59, 5, 3]
+
+
+# The update of the q-values of MARL_cloud before the QStore, with the dict q-tables
+def DictUpdate(agent, q_tab, sja, traces, state0, jactions, action, reward, state1, learning_rate):
+    current_q = q_tab[state0][jactions][action]
+    q_tab[state0][jactions][0] = -GOAL_REWARD * 4
+    if reward == -GOAL_REWARD:
+        new_qvalue = reward
+        future_q = None
+        q_tab[state0][jactions][action] = new_qvalue
+    elif -GOAL_REWARD < reward < GOAL_REWARD:
+        future_q = agent.GetMaxFutureQ(q_tab, sja, state1)
+        new_qvalue = (1 - learning_rate) * current_q + learning_rate * (reward + DISCOUNT * future_q)
+        q_tab[state0][jactions][action] = new_qvalue
+        traces_id = str(state0) + ":" + str(jactions) + ":" + str(action)
+        traces[traces_id] = traces.get(traces_id, 0.0) + 1
+    else:
+        new_qvalue = reward
+        q_tab[state0][jactions][action] = new_qvalue
+        future_q = 0
+        from_current_state = (reward + DISCOUNT * future_q) - current_q
+        for key, trace in traces.items():
+            trace_state, trace_jact, trace_act = key.split(":")
+            trace_state = next(state for state in q_tab if str(state) == trace_state)
+            trace_jact = next(jact for jact in q_tab[trace_state] if str(jact) == trace_jact)
+            q_tab[trace_state][trace_jact][int(trace_act)] += learning_rate * trace * from_current_state
+    sja[state0][jactions] += 1
+    return current_q, future_q, new_qvalue
+
+
+def test_learn_many_matches_dict_update():
+    dict_traces = {}
+    traces = TraceStore()
+    for neigh, part, states_0, states_1, actions, q_tabs, sja, qstore in RandomEpisodes(7):
+        rewards = [random.choice([GOAL_REWARD, -GOAL_REWARD, -1, -1, -1]) for ag_id in part]
+        rates = [random.uniform(0.1, 0.9) for ag_id in part]
+        jacts = neigh.JointActionsN(actions, part)
+
+        expected = []
+        for ag_id, reward, rate in zip(part, rewards, rates):
+            expected.append(DictUpdate(neigh.GetAgentbyID(ag_id), q_tabs[ag_id], sja[ag_id],
+                                       dict_traces.setdefault(ag_id, {}), states_0[ag_id], jacts[ag_id],
+                                       actions[ag_id], reward, states_1[ag_id], rate))
+
+        sids0 = neigh.StateIdsN(qstore, states_0, part)
+        jaids = qstore.JointActionIds(sids0, neigh.JointActionArrayN(actions, part))
+        old_qs, future_qs, new_qs = qstore.LearnMany(part, sids0, jaids, [actions[ag_id] for ag_id in part],
+                                                     rewards, neigh.StateIdsN(qstore, states_1, part), rates,
+                                                     traces, GOAL_REWARD, DISCOUNT)
+
+        for nr, (current_q, future_q, new_qvalue) in enumerate(expected):
+            assert abs(old_qs[nr] - current_q) < 1e-3
+            assert abs(new_qs[nr] - new_qvalue) < 1e-3
+            assert (np.isnan(future_qs[nr]) if future_q is None else abs(future_qs[nr] - future_q) < 1e-3)
+
+    # Every q-value of the last tables
+    for ag_id in part:
+        for state, by_jact in q_tabs[ag_id].items():
+            sid = qstore.StateId(ag_id, state)
+            if by_jact is None or sid is None:
+                continue
+            jacts = list(by_jact.keys())
+            values = np.array([by_jact[jact] for jact in jacts])
+            sids = np.full(values.size, sid)
+            jaids = np.repeat(qstore.JointActionIds(sids[:len(jacts)], jacts), values.shape[1])
+            acts = np.tile(np.arange(values.shape[1]), len(jacts))
+            assert np.allclose(qstore.GetMany(sids, jaids, acts), values.ravel(), atol=1e-3)
+
+
+def test_trace_store_decay_and_backup():
+    qstore = QStore()
+    sid_a = qstore.AddState("0_0", "A", 3, [2])
+    sid_b = qstore.AddState("0_1", "B", 3, [2])
+    nr_a, nr_b = qstore.AgentNrsMany(["0_0", "0_1"])
+    traces = TraceStore()
+    traces.Increment(qstore, nr_a, sid_a, 1, 2)
+    traces.IncrementMany(qstore, [nr_a, nr_b], [sid_a, sid_b], [1, 0], [2, 1])
+    assert len(traces) == 2
+    traces.Decay(0.5)
+    assert traces.Traces[:2].tolist() == [1.0, 0.5]
+
+    # One scale for all the traces, then one per agent (only the traces of 0_1 move)
+    traces.Backup(qstore, 2.0)
+    assert qstore.Get(sid_a, 1, 2) == 2.0 and qstore.Get(sid_b, 0, 1) == 1.0
+    scales = np.zeros(len(qstore.AgentNrs))
+    scales[nr_b] = 4.0
+    traces.Backup(qstore, scales)
+    assert qstore.Get(sid_a, 1, 2) == 2.0 and qstore.Get(sid_b, 0, 1) == 3.0
+
+    # Two agents on the same entry keep their own traces
+    traces.Increment(qstore, nr_b, sid_a, 1, 2)
+    assert len(traces) == 3 and traces.StatesOf(nr_b).tolist() == [sid_b, sid_a]
+
+
+def test_trace_store_matches_string_traces():
+    rng = random.Random(9)
+    qstore = QStore()
+    sids = [qstore.AddState("0_{}".format(nr % 3), nr, 4, [3, 3]) for nr in range(6)]
+    agents = ["0_0", "0_1", "0_2"]
+    nrs = qstore.AgentNrsMany(agents).tolist()
+    traces = TraceStore()
+    # The traces of MARL_cloud before the TraceStore, keyed by "state:jact:act" for each agent
+    traces_dicts = {ag_id: {} for ag_id in agents}
+    q_values = {}
+    for _ in range(80):
+        draw = rng.random()
+        if draw < 0.6:
+            # Some agents (each one at most once) increment a trace
+            some = rng.sample(range(3), rng.randint(1, 3))
+            entries = [(rng.choice(sids), rng.randrange(9), rng.randrange(4)) for nr in some]
+            traces.IncrementMany(qstore, [nrs[nr] for nr in some], *zip(*entries))
+            for nr, (sid, jaction, action) in zip(some, entries):
+                key = "{}:{}:{}".format(sid, jaction, action)
+                traces_dicts[agents[nr]][key] = traces_dicts[agents[nr]].get(key, 0.0) + 1
+        elif draw < 0.8:
+            factor = rng.uniform(0.5, 1.0)
+            traces.Decay(factor)
+            for by_key in traces_dicts.values():
+                for key in by_key:
+                    by_key[key] *= factor
+        else:
+            scales = np.zeros(len(qstore.AgentNrs))
+            for nr in rng.sample(range(3), rng.randint(1, 3)):
+                scales[nrs[nr]] = rng.uniform(-2, 2)
+            traces.Backup(qstore, scales)
+            for ag_id, by_key in traces_dicts.items():
+                for key, trace in by_key.items():
+                    sid, jaction, action = map(int, key.split(":"))
+                    q_values[sid, jaction, action] = q_values.get((sid, jaction, action), 0.0) + \
+                                                     scales[qstore.AgentNrs[ag_id]] * trace
+
+        assert len(traces) == sum(len(by_key) for by_key in traces_dicts.values())
+        for ag_id in agents:
+            assert set(traces.StatesOf(qstore.AgentNrs[ag_id]).tolist()) == \
+                   {int(key.split(":")[0]) for key in traces_dicts[ag_id]}
+    assert len(traces) > 16  # past the first arrays
+    by_agent = StoreContents(qstore, traces)[2]
+    assert by_agent == pytest.approx({(qstore.AgentNrs[ag_id],) + tuple(map(int, key.split(":"))): trace
+                                      for ag_id, by_key in traces_dicts.items() for key, trace in by_key.items()})
+    for (sid, jaction, action), value in q_values.items():
+        assert abs(qstore.Get(sid, jaction, action) - value) < 1e-4
+
+
+# Q-values, visits and sums of every (state, joint action) with a row, and the traces by agent
+def StoreContents(qstore, traces):
+    rows = {int(key): qstore.KeyRows[nr] for nr, key in enumerate(qstore.Keys)}
+    values = {key: (qstore.Values[row].tolist(), int(qstore.Visits[row])) for key, row in rows.items()}
+    states = (qstore.Sums[:len(qstore)].tolist(), qstore.Totals[:len(qstore)].tolist())
+    by_agent = {(int(traces.Agents[nr]), int(traces.States[nr]), int(traces.JActions[nr]), int(traces.Actions[nr])):
+                float(traces.Traces[nr]) for nr in range(len(traces))}
+    return values, states, by_agent
+
+
+def test_learn_many_with_shared_states_matches_one_by_one():
+    rng = random.Random(11)
+    stores = [QStore(), QStore()]
+    traces = [TraceStore(), TraceStore()]
+    for qstore in stores:
+        for nr in range(4):
+            qstore.AddState("shared", nr, 4, [3, 3])
+    agents = ["0_{}".format(nr) for nr in range(6)]
+    for _ in range(60):
+        sids = [rng.randrange(4) for ag_id in agents]
+        jactions = [rng.randrange(9) for ag_id in agents]
+        actions = [rng.randrange(1, 4) for ag_id in agents]
+        rewards = [rng.choice([GOAL_REWARD, -GOAL_REWARD, -1, -1, -1, -1]) for ag_id in agents]
+        next_sids = [rng.randrange(4) for ag_id in agents]
+        rates = [rng.uniform(0.1, 0.9) for ag_id in agents]
+        batch = stores[0].LearnMany(agents, sids, jactions, actions, rewards, next_sids, rates, traces[0],
+                                    GOAL_REWARD, DISCOUNT)
+        for nr, ag_id in enumerate(agents):
+            one = stores[1].LearnMany([ag_id], sids[nr:nr + 1], jactions[nr:nr + 1], actions[nr:nr + 1],
+                                      rewards[nr:nr + 1], next_sids[nr:nr + 1], rates[nr:nr + 1], traces[1],
+                                      GOAL_REWARD, DISCOUNT)
+            for got, expected in zip(batch, one):
+                assert np.allclose(got[nr:nr + 1], expected, equal_nan=True)
+    assert StoreContents(stores[0], traces[0]) == StoreContents(stores[1], traces[1])
+
+
+def test_sums_that_cancel_read_zero():
+    rng = random.Random(0)
+    qstore = QStore()
+    sid = qstore.AddState("0_0", "A", 3, [4])
+    other = qstore.AddState("0_1", "B", 3, [4])
+    for _ in range(200):
+        for state in (sid, other):
+            jaction = rng.randrange(4)
+            if rng.random() < 0.5:
+                qstore.Set(state, jaction, rng.randrange(3), rng.choice([1e-3, 0.1, -0.7, 300.0, -2.5e4]) * rng.random())
+            else:
+                qstore.Visit(state, jaction)
+    kept = qstore.Sums[other].copy()
+    assert np.allclose(qstore.ExactSums(other), kept)
+
+    # Every value of A back to 0 after being visited with others
+    for jaction in range(4):
+        for action in range(3):
+            qstore.Set(sid, jaction, action, 0.0)
+    assert qstore.Totals[sid] > 0
+    assert qstore.ExpectedQ(sid).tolist() == [0.0, 0.0, 0.0]
+    assert qstore.MaxFutureQ(sid) == 0 and qstore.Argmax(sid) == 0
+    assert qstore.MaxFutureQMany([sid, sid]).tolist() == [0.0, 0.0]
+    assert qstore.ArgmaxMany([sid]).tolist() == [0]
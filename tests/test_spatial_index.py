@@ -0,0 +1,116 @@
+'''The grid index of herp.spatial_index against the comparison of every pair of lots that
+Neighbourhood.IDNeighNeighbours did with Rhino curves.'''
+
+import numpy as np
+import pytest
+
+from herp.geo_gen_canvas_wneigh import Neighbourhood
+from herp.spatial_index import InteractionLabels, NeighbourCSR, NeighbourIndex
+
+
+# Lots with a vertex strictly inside the circle of radius around the centre of each lot
+def BruteNeighbours(centres, vertices, radius):
+    neighbours = []
+    for lot, (ctr_x, ctr_y) in enumerate(centres):
+        seen = []
+        for other, other_vertices in enumerate(vertices):
+            if other != lot and any((x - ctr_x) ** 2 + (y - ctr_y) ** 2 < radius ** 2 for x, y in other_vertices):
+                seen.append(other)
+        neighbours.append(seen)
+    return neighbours
+
+
+def test_random_lots_match_brute_force():
+    rng = np.random.default_rng(2)
+    for radius in (0.5, 3.0, 12.0):
+        centres = rng.uniform(-20, 40, size=(150, 2))
+        vertices = centres[:, None, :] + rng.uniform(-2, 2, size=(150, 4, 2))
+        index = NeighbourIndex(centres, vertices, radius)
+        expected = BruteNeighbours(centres.tolist(), vertices.tolist(), radius)
+        assert [index.Neighbours(lot).tolist() for lot in range(len(index))] == expected
+
+
+def test_vertices_on_the_circle_are_outside():
+    centres = [(0.0, 0.0), (10.0, 0.0)]
+    vertices = [[(0.0, 0.0)], [(5.0, 0.0)]]
+    assert NeighbourIndex(centres, vertices, 5.0).Neighbours(0).tolist() == []
+    assert NeighbourIndex(centres, vertices, 5.0001).Neighbours(0).tolist() == [1]
+    assert len(NeighbourIndex(centres, vertices, 0).Indices) == 0
+
+
+def test_neighbourhood_matches_brute_force():
+    neigh = Neighbourhood(0, 0, 3, 2, 11, 3, 3, 2.7, 0, 0, 1, 1, 3, 4, True, True, 2.7 * 4, 0, 200, 500, "Voxel")
+    centres = []
+    vertices = []
+    for agent in neigh.Agents:
+        my_vertices = [(vert.X, vert.Y) for vert in agent.VertixLots[:-1]]
+        centres.append((sum(x for x, y in my_vertices) / len(my_vertices),
+                        sum(y for x, y in my_vertices) / len(my_vertices)))
+        vertices.append(my_vertices)
+    expected = BruteNeighbours(centres, vertices, neigh.NeighRadius)
+    for idx, ag_id in enumerate(neigh.AgInNeigh):
+        assert neigh.IDNeighNeighbours(ag_id) == [neigh.AgInNeigh[other] for other in expected[idx]]
+        assert neigh.EveryNeigh[ag_id] == neigh.IDNeighNeighbours(ag_id)
+
+
+# Groups of the marked lots joined one pair at a time, numbered by their first lot
+def UnionFindLabels(neighbours, marked, hops):
+    parents = list(range(len(neighbours)))
+
+    def Root(lot):
+        while parents[lot] != lot:
+            parents[lot] = parents[parents[lot]]
+            lot = parents[lot]
+        return lot
+
+    def Join(lot_a, lot_b):
+        parents[Root(lot_a)] = Root(lot_b)
+
+    touching = [set([lot]) for lot in range(len(neighbours))]
+    for lot, seen in enumerate(neighbours):
+        for other in seen:
+            touching[lot].add(other)
+            touching[other].add(lot)
+    for lot, seen in enumerate(neighbours):
+        for other in seen:
+            if hops == 1 and marked[lot] and marked[other]:
+                Join(lot, other)
+    if hops == 2:
+        # Every marked lot touching the same lot (or being it) is at most two pairs apart
+        for hub in touching:
+            ends = [lot for lot in hub if marked[lot]]
+            for lot in ends[1:]:
+                Join(ends[0], lot)
+
+    groups = {}
+    labels = []
+    for lot in range(len(neighbours)):
+        if not marked[lot]:
+            labels.append(-1)
+        else:
+            labels.append(groups.setdefault(Root(lot), len(groups)))
+    return labels
+
+
+@pytest.mark.parametrize("hops", [1, 2])
+def test_interaction_labels_match_union_find(hops):
+    rng = np.random.default_rng(5)
+    for share in (0.1, 0.4, 0.9):
+        centres = rng.uniform(0, 60, size=(120, 2))
+        vertices = centres[:, None, :] + rng.uniform(-1.5, 1.5, size=(120, 4, 2))
+        indptr, indices = NeighbourCSR(centres, vertices, 4.0)
+        marked = rng.random(120) < share
+        neighbours = [indices[indptr[lot]:indptr[lot + 1]].tolist() for lot in range(120)]
+        labels = InteractionLabels(indptr, indices, marked, hops)
+        assert labels.tolist() == UnionFindLabels(neighbours, marked.tolist(), hops)
+
+
+def test_interaction_labels_on_one_sided_pairs():
+    # 0 sees 1, 2 sees 1 and 3 sees nobody but is seen by 2: only 1 is not marked
+    indptr = np.array([0, 1, 1, 3, 3])
+    indices = np.array([1, 1, 3])
+    marked = [True, False, True, True]
+    assert InteractionLabels(indptr, indices, marked, 1).tolist() == [0, -1, 1, 1]
+    assert InteractionLabels(indptr, indices, marked, 2).tolist() == [0, -1, 0, 0]
+    with pytest.raises(ValueError):
+        InteractionLabels(indptr, indices, marked, 3)
@@ -0,0 +1,75 @@
+'''The symmetry of the lots (Neighbourhood symmetry=True): mirrored and translated buildings
+share their states in the QStore and the actions of a state are numbered as in its key.'''
+
+from herp import voxel_geom
+from herp.geo_gen_canvas_wneigh import Neighbourhood
+from herp.q_store import QStore
+
+
+# Default lot of MARL_cloud: 3x3 modules with a 1x1 core in a corner
+def DefaultNeighbourhood(symmetry=True):
+    return Neighbourhood(0, 0, 3, 2, 11, 3, 3, 2.7, 0, 0, 1, 1, 3, 4, True, True, 2.7 * 4, 0, 200, 500,
+                         "Voxel", state_encoding="Bits", symmetry=symmetry)
+
+
+def test_default_lot_has_its_diagonal():
+    neigh = DefaultNeighbourhood()
+    mirrors = neigh.Agents[0].Template.Mirrors
+    assert len(mirrors) == 1
+    state = voxel_geom.BitsState(1 | 1 << 9, 27)  # core and the module next to it in x
+    mirrored = "".join(state[idx] for idx in mirrors[0][0])
+    assert mirrored != state and voxel_geom.StateBits(mirrored) == 1 | 1 << 3  # next to it in y
+    # A square lot with the core in the middle keeps all its turns and mirrors
+    assert len(voxel_geom.CoreMirrors(voxel_geom.CoreOccupancy(3, 3, 3, 1, 1, 1, 1))) == 7
+
+
+# Id in qstore of the joint state of an agent after growing it with an action from the core
+def GrownStateId(neigh, qstore, ag_id, action):
+    agent = neigh.GetAgentbyID(ag_id)
+    agent.Extend(-1)
+    agent.Extend(action)
+    jstates = neigh.GetJStatesN([ag_id])
+    neigh.CheckQStoreN(qstore, jstates, neigh.GetAvailActsN(neigh.AgInNeigh), [ag_id])
+    sid = neigh.StateIdsN(qstore, jstates, [ag_id])[0]
+    agent.Extend(-1)
+    return sid
+
+
+def test_mirrored_states_share_their_q_store_id():
+    neigh = DefaultNeighbourhood()
+    qstore = QStore()
+    # Two agents with as many neighbours, growing towards x (action 1) and towards y (action 2)
+    ag_a, ag_b = next((ag_a, ag_b) for ag_a in neigh.AgInNeigh for ag_b in neigh.AgInNeigh
+                      if ag_a < ag_b and len(neigh.EveryNeigh[ag_a]) == len(neigh.EveryNeigh[ag_b]))
+    sid_a = GrownStateId(neigh, qstore, ag_a, 1)
+    assert GrownStateId(neigh, qstore, ag_b, 2) == sid_a
+    assert GrownStateId(neigh, qstore, ag_a, 2) == sid_a
+    assert GrownStateId(neigh, qstore, ag_a, 3) != sid_a
+    assert len(qstore) == 2
+
+    # Without symmetry every agent and state has its own id
+    neigh = DefaultNeighbourhood(symmetry=False)
+    qstore = QStore()
+    sids = [GrownStateId(neigh, qstore, ag_a, 1), GrownStateId(neigh, qstore, ag_b, 2),
+            GrownStateId(neigh, qstore, ag_a, 2)]
+    assert len(set(sids)) == 3
+
+
+def test_key_actions_grow_mirrored_states():
+    neigh = DefaultNeighbourhood()
+    agent_a, agent_b = neigh.Agents[0], neigh.Agents[1]
+    agent_a.Extend(1)
+    agent_b.Extend(2)
+    start_a, start_b = agent_a.Snapshot(), agent_b.Snapshot()
+    # The state grown in x is the key of both (the one grown in y is its mirror 0)
+    assert agent_a.Template.CanonicalState(agent_a.C_state) == (agent_a.C_state, None)
+    assert agent_b.Template.CanonicalState(agent_b.C_state) == (agent_a.C_state, 0)
+    for key_action in range(1, agent_a.Poss_act + 1):
+        action_a, action_b = agent_a.OwnAction(key_action), agent_b.OwnAction(key_action)
+        assert agent_a.KeyAction(action_a) == key_action and agent_b.KeyAction(action_b) == key_action
+        agent_a.Extend(action_a)
+        agent_b.Extend(action_b)
+        template = agent_a.Template
+        assert template.CanonicalState(agent_a.C_state)[0] == template.CanonicalState(agent_b.C_state)[0]
+        agent_a.Restore(start_a)
+        agent_b.Restore(start_b)
@@ -0,0 +1,108 @@
+'''The transitions of herp.geo_gen_canvas_wneigh reused between agents of the same lot template,
+against extending every agent again, and the snapshots that replace replaying the actions.'''
+
+import numpy as np
+
+from herp.geo_gen_canvas_wneigh import Neighbourhood, TransitionCache
+
+
+# Cache that never has the transition, so every agent extends its own geometry
+class NoTransitions(TransitionCache):
+    def Get(self, key):
+        self.Misses += 1
+        return None
+
+
+def VoxelNeighbourhood(transitions=None):
+    return Neighbourhood(0, 0, 3, 2, 11, 3, 3, 2.7, 0, 0, 1, 1, 3, 4, True, True, 2.7 * 4, 0, 200, 500,
+                         "Voxel", transitions=transitions, state_encoding="Bits")
+
+
+# Everything Extend sets on an agent
+def AgentValues(agent):
+    return (agent.C_state, agent.C_bits, agent.C_Area, agent.Poss_act, agent.NOccupiedPts,
+            agent.WallAreaExtCost, agent.RoofAreaExtCost, agent.Exposed, list(agent.GrowFaces),
+            agent.Occupancy.tolist())
+
+
+# Everything the agents write in the arrays of the neighbourhood
+def NeighbourhoodValues(neigh):
+    return (neigh.OccupancyN.tolist(), neigh.OccupiedN.tolist(), neigh.PossActN.tolist(),
+            neigh.WallCostN.tolist(), neigh.RoofCostN.tolist(), neigh.GetJStatesN(neigh.AgInNeigh))
+
+
+# Random actions for every agent, going back to the core now and then
+def RandomActions(neigh, rng):
+    actions = {}
+    for ag_id in neigh.AgInNeigh:
+        if rng.random() < 0.1:
+            actions[ag_id] = -1
+        else:
+            actions[ag_id] = int(rng.integers(0, 2 * neigh.GetAgentbyID(ag_id).Poss_act + 1))
+    return actions
+
+
+def test_cached_transitions_match_fresh_extends():
+    rng = np.random.default_rng(4)
+    cached = VoxelNeighbourhood()
+    fresh = VoxelNeighbourhood(NoTransitions())
+    for _ in range(40):
+        actions = RandomActions(cached, rng)
+        cached.TakeActionsN(actions)
+        fresh.TakeActionsN(actions)
+        for ag_id in cached.AgInNeigh:
+            assert AgentValues(cached.GetAgentbyID(ag_id)) == AgentValues(fresh.GetAgentbyID(ag_id))
+        assert NeighbourhoodValues(cached) == NeighbourhoodValues(fresh)
+
+    hits, misses = cached.Transitions.PopCounters()
+    assert hits > 0 and misses > 0
+    assert fresh.Transitions.PopCounters()[0] == 0
+
+
+def test_restore_n_goes_back_to_the_snapshot():
+    rng = np.random.default_rng(6)
+    neigh = VoxelNeighbourhood()
+    for _ in range(10):
+        neigh.TakeActionsN(RandomActions(neigh, rng))
+    snapshot = neigh.SnapshotN()
+    agents = [AgentValues(agent) for agent in neigh.Agents]
+    arrays = NeighbourhoodValues(neigh)
+
+    # The same actions from the snapshot give the same result
+    actions = RandomActions(neigh, rng)
+    neigh.TakeActionsN(actions)
+    next_agents = [AgentValues(agent) for agent in neigh.Agents]
+    next_arrays = NeighbourhoodValues(neigh)
+    for _ in range(10):
+        neigh.TakeActionsN(RandomActions(neigh, rng))
+
+    neigh.RestoreN(snapshot)
+    assert [AgentValues(agent) for agent in neigh.Agents] == agents
+    assert NeighbourhoodValues(neigh) == arrays
+    neigh.TakeActionsN(actions)
+    assert [AgentValues(agent) for agent in neigh.Agents] == next_agents
+    assert NeighbourhoodValues(neigh) == next_arrays
+
+
+def test_restore_n_of_some_agents():
+    rng = np.random.default_rng(7)
+    neigh = VoxelNeighbourhood()
+    snapshot = neigh.SnapshotN()
+    for _ in range(10):
+        neigh.TakeActionsN(RandomActions(neigh, rng))
+    grown = [AgentValues(agent) for agent in neigh.Agents]
+
+    restored = neigh.AgInNeigh[::3]
+    neigh.RestoreN(snapshot, restored)
+    fresh = VoxelNeighbourhood()
+    for idx, ag_id in enumerate(neigh.AgInNeigh):
+        if ag_id in restored:
+            assert AgentValues(neigh.Agents[idx]) == AgentValues(fresh.Agents[idx])
+        else:
+            assert AgentValues(neigh.Agents[idx]) == grown[idx]
+    assert neigh.OccupancyN.tolist() == [agent.Occupancy.tolist() for agent in neigh.Agents]
+    assert neigh.OccupiedN.tolist() == [agent.NOccupiedPts for agent in neigh.Agents]
+    # The joint states kept by the neighbourhood are those built again from the agents
+    jstates = neigh.GetJStatesN(neigh.AgInNeigh)
+    neigh.JStates.clear()
+    assert neigh.GetJStatesN(neigh.AgInNeigh) == jstates
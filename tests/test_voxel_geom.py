@@ -0,0 +1,96 @@
+'''The updates of herp.voxel_geom and of HHagent.ExtendVoxel, which only look at the module
+that is added, against counting the whole lot again, and the voxel state against the test
+points of the Rhino backend.'''
+
+import itertools
+
+import numpy as np
+
+from herp import voxel_geom
+from herp.geo_gen_canvas_wneigh import HHagent
+
+SHAPE = (3, 4, 3)
+
+
+def test_add_module_delta_matches_recount():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        occ = voxel_geom.CoreOccupancy(SHAPE[0], SHAPE[1], SHAPE[2], 1, 1, 1, 1)
+        exposed = voxel_geom.ExposedFaces(occ)
+        faces = voxel_geom.GrowableFaces(occ)
+        # Any free module, not only those behind a growable face
+        for idx in rng.permutation(np.flatnonzero(~occ.ravel())):
+            delta, removed, added = voxel_geom.AddModuleDelta(occ, int(idx))
+            occ.flat[idx] = True
+            exposed = tuple(old + new for old, new in zip(exposed, delta))
+            faces = sorted(set(faces).difference(removed).union(added))
+            assert exposed == voxel_geom.ExposedFaces(occ)
+            assert faces == voxel_geom.GrowableFaces(occ)
+
+
+# Unit cells (direction, plane and lower corner on the other two axes) covered by a face
+def Cells(direction, points):
+    axis = direction // 2
+    lows = [min(point[other] for point in points) for other in range(3)]
+    highs = [max(point[other] for point in points) for other in range(3)]
+    ranges = [range(lows[other], highs[other]) if other != axis else [lows[axis]] for other in range(3)]
+    return [(direction,) + cell for cell in itertools.product(*ranges)]
+
+
+def test_merged_faces_cover_the_exposed_quads_once():
+    rng = np.random.default_rng(1)
+    for _ in range(30):
+        occ = rng.random(SHAPE) < 0.5
+        quads = [cell for direction, corners in voxel_geom.ExposedQuads(occ) for cell in Cells(direction, corners)]
+        merged = [cell for direction, points in voxel_geom.MergedFaces(occ) for cell in Cells(direction, points)]
+        assert len(merged) == len(set(merged))
+        assert sorted(merged) == sorted(quads)
+
+        walls, roofs, floor = voxel_geom.ExposedFaces(occ)
+        assert walls + roofs + floor == len(quads)
+
+
+def test_extend_voxel_matches_recount():
+    rng = np.random.default_rng(3)
+    agent = HHagent(0, 0, SHAPE[0], SHAPE[1], 3, 1, 1, 1, 1, SHAPE[2], 6, 200, 500, "Voxel")
+    core_area = agent.C_Area
+    for _ in range(10):
+        agent.ExtendGeometry(-1)
+        assert agent.C_Area == core_area and agent.C_state == agent.InitState
+        for _ in range(12):
+            agent.ExtendGeometry(int(rng.integers(0, 2 * agent.Poss_act + 1)))
+            occ = agent.Occupancy
+            walls, roofs, floor = voxel_geom.ExposedFaces(occ)
+            assert agent.Exposed == (walls, roofs, floor)
+            assert agent.GrowFaces == voxel_geom.GrowableFaces(occ)
+            assert agent.Poss_act == len(agent.GrowFaces)
+            assert agent.C_state == voxel_geom.StateString(occ)
+            assert agent.C_bits == voxel_geom.StateBits(agent.C_state)
+            assert agent.NOccupiedPts == int(occ.sum())
+            assert agent.C_Area == (walls + roofs + floor) * 9
+
+
+def test_voxel_state_follows_the_test_points():
+    rng = np.random.default_rng(4)
+    module = 3
+    agent = HHagent(30, 12, SHAPE[0], SHAPE[1], module, 1, 2, 1, 1, SHAPE[2], 6, 200, 500, "Voxel")
+    core = agent.CoreOrigPt
+    points = agent.CentreModulePts
+    assert len(points) == len(agent.InitState)
+
+    # The core is the modules of the ground floor inside the rectangle of the core
+    in_core = [core.X < pt.X < core.X + module and core.Y < pt.Y < core.Y + module and pt.Z < module
+               for pt in points]
+    assert agent.InitState == ''.join("T" if inside else "F" for inside in in_core)
+    assert agent.InitState == agent.GetStateString(agent.InitInsidePtIdx)
+
+    for _ in range(10):
+        agent.ExtendGeometry(int(rng.integers(1, 2 * agent.Poss_act + 1)))
+        # Every character of the state is the module around the test point of the same index
+        for idx, pt in enumerate(points):
+            cell = (int((pt.X - agent.LotOrigX) // module), int((pt.Y - agent.LotOrigY) // module),
+                    int(pt.Z // module))
+            assert (agent.C_state[idx] == "T") == agent.Occupancy[cell]
+        walls, roofs, _ = voxel_geom.ExposedFaces(agent.Occupancy)
+        assert agent.WallAreaExtCost == (walls - agent.CoreExposed[0]) * module ** 2 * 200
+        assert agent.RoofAreaExtCost == (roofs - agent.CoreExposed[1]) * module ** 2 * 500